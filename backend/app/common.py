@@ -1,3 +1,4 @@
+import math
 from typing import List, Tuple, Dict, Any
 
 def polygon_centroid(poly: List[Dict[str, float]]) -> Tuple[float, float]:
@@ -23,4 +24,39 @@ def polygon_centroid(poly: List[Dict[str, float]]) -> Tuple[float, float]:
         return (lat, lon)
     cx /= (6.0 * a)
     cy /= (6.0 * a)
-    return (cy, cx)
\ No newline at end of file
+    return (cy, cx)
+
+
+def polygon_area_m2(poly: List[Dict[str, float]]) -> float:
+    """
+    poly: [{'lat': .., 'lng': ..}, ...]
+    مساحة تقريبية بالمتر المربع (إسقاط مستطيل حول متوسط خط العرض) — كافية للمزارع.
+    """
+    if len(poly) < 3:
+        return 0.0
+    lat0 = math.radians(sum(p["lat"] for p in poly) / len(poly))
+    xs = [p["lng"] * 111320.0 * math.cos(lat0) for p in poly]
+    ys = [p["lat"] * 110540.0 for p in poly]
+    xs.append(xs[0]); ys.append(ys[0])
+    a = 0.0
+    for i in range(len(xs) - 1):
+        a += xs[i] * ys[i+1] - xs[i+1] * ys[i]
+    return abs(a) * 0.5
+
+def point_in_polygon(lat: float, lng: float, poly: List[Dict[str, float]]) -> bool:
+    """
+    poly: [{'lat': .., 'lng': ..}, ...]
+    ray casting — النقطة على الحد ممكن تطلع داخل أو برا (ما يفرق للعد).
+    """
+    inside = False
+    n = len(poly)
+    j = n - 1
+    for i in range(n):
+        xi, yi = poly[i]["lng"], poly[i]["lat"]
+        xj, yj = poly[j]["lng"], poly[j]["lat"]
+        if (yi > lat) != (yj > lat):
+            x_cross = xi + (lat - yi) * (xj - xi) / (yj - yi)
+            if lng < x_cross:
+                inside = not inside
+        j = i
+    return inside
@@ -0,0 +1,104 @@
+import os
+import time
+import random
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+from app import profiling
+
+
+# أقصى عدد طلبات GEE/شبكة تشتغل بنفس الوقت (لا ترفعه كثير — حصة EE للطلبات المتزامنة محدودة)
+EE_MAX_CONCURRENCY = int(os.environ.get("EE_MAX_CONCURRENCY", "4"))
+# مهلة كل طلب EE (ثواني): تنضبط كـ deadline في ee.data.setDeadline
+EE_CALL_TIMEOUT_S = float(os.environ.get("EE_CALL_TIMEOUT_S", "100"))
+EE_MAX_RETRIES = int(os.environ.get("EE_MAX_RETRIES", "4"))
+EE_BACKOFF_S = float(os.environ.get("EE_BACKOFF_S", "1.0"))
+# مهلة انتظار نتيجة المهمة (result/run_parallel). 0 = بدون مهلة: الـ deadline ومهلات HTTP هي اللي توقف الطلب،
+# لأن المهمة ممكن تكون في الطابور أو بين محاولات retry وهي شغالة صح
+EE_RESULT_TIMEOUT_S = float(os.environ.get("EE_RESULT_TIMEOUT_S", "0"))
+
+# رسائل أخطاء الحصة/الضغط اللي تستاهل إعادة المحاولة (429 / quota / concurrent aggregations)
+_RETRYABLE_MARKERS = (
+    "429",
+    "too many requests",
+    "too many concurrent",
+    "quota",
+    "rate limit",
+    "resource_exhausted",
+    "resource exhausted",
+)
+
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        with _EXECUTOR_LOCK:
+            if _EXECUTOR is None:
+                _EXECUTOR = ThreadPoolExecutor(
+                    max_workers=max(1, EE_MAX_CONCURRENCY),
+                    thread_name_prefix="ee",
+                )
+    return _EXECUTOR
+
+
+def is_retryable(exc: BaseException) -> bool:
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    if status == 429:
+        return True
+    msg = str(exc).lower()
+    return any(m in msg for m in _RETRYABLE_MARKERS)
+
+
+def call_with_retry(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    ينفذ fn ويعيد المحاولة مع backoff أسي (+ jitter) إذا كان الخطأ 429/quota فقط.
+    باقي الأخطاء ترتفع مباشرة لنفس المستدعي. كل محاولة تنحسب طلب EE في profiling.
+    """
+    return _retrying(fn, args, kwargs, count=True)
+
+
+def _retrying(fn: Callable[..., Any], args: tuple, kwargs: dict, count: bool) -> Any:
+    attempt = 0
+    while True:
+        if count:
+            profiling.count_ee_call()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= EE_MAX_RETRIES or not is_retryable(e):
+                raise
+            delay = EE_BACKOFF_S * (2 ** attempt) * (1.0 + random.random() * 0.25)
+            print(f"[EE] quota/rate error ({type(e).__name__}: {e}) → retry {attempt + 1}/{EE_MAX_RETRIES} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def submit(fn: Callable[..., Any], *args, **kwargs) -> Future:
+    """
+    يرسل fn للـ executor المشترك (مع retry). لا تستدعي submit من داخل مهمة شغالة
+    وتنتظرها — المهام ما تنتظر مهام ثانية عشان ما يصير deadlock لما يمتلئ الـ pool.
+    المهمة تشتغل بنسخة من السياق الحالي (contextvars) عشان مراحل profiling تحسب طلباتها.
+    """
+    ctx = contextvars.copy_context()
+    # المهمة نفسها ما تنحسب طلب — الطلبات الفعلية داخلها تمر على call_with_retry
+    return get_executor().submit(ctx.run, _retrying, fn, args, kwargs, False)
+
+
+def result(future: Future, timeout: Optional[float] = None) -> Any:
+    """نتيجة المهمة؛ TimeoutError لو تعدت المهلة (timeout أو EE_RESULT_TIMEOUT_S لو > 0)."""
+    if timeout is None:
+        timeout = EE_RESULT_TIMEOUT_S if EE_RESULT_TIMEOUT_S > 0 else None
+    return future.result(timeout=timeout)
+
+
+def run_parallel(tasks: Sequence[Tuple[Callable[..., Any], tuple]], timeout: Optional[float] = None) -> List[Any]:
+    """
+    ينفذ [(fn, args), ...] بالتوازي (بحد EE_MAX_CONCURRENCY) ويرجّع النتائج بنفس الترتيب.
+    """
+    futures = [submit(fn, *args) for fn, args in tasks]
+    return [result(f, timeout) for f in futures]
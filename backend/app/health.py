@@ -1,21 +1,26 @@
 import tempfile
 import os
+import threading
 import math
 import warnings
-from typing import Dict, Any, List, Tuple
+from typing import Callable, Dict, Any, List, Set, Tuple
 
 import numpy as np
 import pandas as pd
-import requests
 import joblib
 
 import ee
 import geemap
 
-from requests.adapters import HTTPAdapter, Retry
 from google.cloud import storage
 
-from app.common import polygon_centroid
+from app.common import polygon_centroid, polygon_area_m2
+from app import pixel_history
+from app import ee_executor
+from app import s2_cache
+from app import pixel_cube
+from app import weather_store
+from app import profiling
 
 from datetime import datetime
 
@@ -23,14 +28,27 @@ PROJECT_ID = os.environ.get("GEE_PROJECT_ID", "saaf-97251")
 OUT_ROOT = os.environ.get("HEALTH_OUT_ROOT", "/tmp/saaf_health")
 os.makedirs(OUT_ROOT, exist_ok=True)
 
-TODAY = pd.Timestamp.now(tz="UTC").tz_localize(None).normalize()
-DATE_TO = TODAY
-DATE_FROM = TODAY - pd.Timedelta(weeks=52)
+ANALYSIS_WEEKS = 52
+
+# الأسبوع يعتبر "مقفل" (ما راح تنزل له مشاهد جديدة) بعد نهاية نافذة ±6 أيام + تأخر النشر في GEE
+WEEK_FINAL_LAG_DAYS = int(os.environ.get("WEEK_FINAL_LAG_DAYS", "5"))
 
 S2_COLLECTION = "COPERNICUS/S2_SR_HARMONIZED"
 MAX_CLOUD = 40          
 RESOLUTION = 10         
 
+# "batched": كل الأسابيع بطلبات قليلة (S2_BATCH_WEEKS أسبوع لكل طلب) — "weekly": طلب لكل أسبوع
+S2_FETCH_MODE = os.environ.get("S2_FETCH_MODE", "batched")
+S2_BATCH_WEEKS = int(os.environ.get("S2_BATCH_WEEKS", "13"))
+# analyze_farms_health: كم مزرعة تنجمع في طلب S2/LST واحد
+S2_BATCH_FARMS = int(os.environ.get("S2_BATCH_FARMS", "8"))
+# أقصى عدد بكسلات (10 م) لكل أسبوع — المزرعة الأكبر تنأخذ منها عينة شبكية ثابتة (0 = بدون حد)
+S2_PIXEL_BUDGET = int(os.environ.get("S2_PIXEL_BUDGET", "20000"))
+# "batched": كل أسابيع LST في getInfo واحد — "weekly": load_week_LST_Landsat_GEE لكل أسبوع
+LST_FETCH_MODE = os.environ.get("LST_FETCH_MODE", "batched")
+# "raw": نرسل 10 باندات خام uint16 ونحسب المؤشرات محلياً (S2_INDEX_TABLE) — "indices": المؤشرات تنحسب في GEE
+S2_TRANSFER_MODE = os.environ.get("S2_TRANSFER_MODE", "raw")
+
 IF_MODEL_GS_URI = os.environ.get("IF_MODEL_GS_URI", "")
 
 IF_MEANS_GS_URI = os.environ.get("IF_MEANS_GS_URI", "")
@@ -44,6 +62,94 @@ INDEX_COLS_ALL = [
     "NDMI", "NDWI_Gao", "SIWSI1", "SIWSI2", "SRWI", "NMDI",
 ]
 
+S2_RAW_BANDS = ["B2", "B3", "B4", "B5", "B6", "B7", "B8", "B8A", "B11", "B12"]
+
+# تعريف المؤشرات (نفس معادلات _s2_index_image): (نوع المعادلة, الباندات...)
+#   ratio:  (a - b) / (a + b + 1e-6)
+#   simple: a / (b + 1e-6)
+#   mtci:   (a - b) / (b - c + 1e-6)
+#   nmdi:   (a - (b - c)) / (a + (b - c) + 1e-6)
+S2_INDEX_TABLE = {
+    "NDVI":     ("ratio",  "B8",  "B4"),
+    "GNDVI":    ("ratio",  "B8",  "B3"),
+    "NDRE":     ("ratio",  "B8",  "B5"),
+    "NDRE740":  ("ratio",  "B8",  "B6"),
+    "MTCI":     ("mtci",   "B8A", "B5", "B4"),
+    "NDMI":     ("ratio",  "B8",  "B11"),
+    "NDWI_Gao": ("ratio",  "B8",  "B11"),
+    "SIWSI1":   ("ratio",  "B8",  "B11"),
+    "SIWSI2":   ("ratio",  "B8A", "B11"),
+    "SRWI":     ("simple", "B8",  "B11"),
+    "NMDI":     ("nmdi",   "B8",  "B11", "B12"),
+}
+
+# ──────────────────────────────────────────────
+# أنواع أعمدة df_all: المؤشرات/الميزات/الطقس/الدرجات float32، النصوص المتكررة categorical.
+# x/y تبقى float64 (إحداثيات)، و date تبقى datetime64 (عليها الدمج والترتيب والسجل).
+# ──────────────────────────────────────────────
+RISK_CLASSES = ["Healthy", "Monitor", "Critical"]
+RPW_RULES = [
+    "Healthy",
+    "Monitor_baseline_drop", "Monitor_RPW_tail", "Monitor_IF_outlier",
+    "Critical_baseline_drop", "Critical_RPW_tail", "Critical_IF_outlier",
+]
+CATEGORY_COLS = {
+    "site": None,
+    "wx_source": None,
+    "pixel_risk_class": RISK_CLASSES,
+    "RPW_label_rule": RPW_RULES,
+}
+INT_COLS = {"pixel_id": np.int64, "history_weeks": np.int16, "weekofyear": np.int8, "month": np.int8}
+FLOAT64_COLS = {"x", "y"}
+
+
+def column_dtype(name: str, s: pd.Series):
+    """النوع المخطط لعمود (None = يبقى زي ما هو)."""
+    if name in CATEGORY_COLS:
+        cats = CATEGORY_COLS[name]
+        return pd.CategoricalDtype(cats) if cats else "category"
+    if name in INT_COLS:
+        return INT_COLS[name] if s.notna().all() else None
+    if name in FLOAT64_COLS or s.dtype.kind != "f":
+        return None
+    return np.float32
+
+
+def apply_dtype_plan(df: pd.DataFrame, stage: str | None = None) -> pd.DataFrame:
+    """
+    يطبّق أنواع الأعمدة (column_dtype) في مكانها — الأعمدة اللي نوعها صح ما تنلمس.
+    stage: لو انعطى يطبع ذاكرة الجدول و RSS بعد المرحلة.
+    """
+    for name in df.columns:
+        dtype = column_dtype(name, df[name])
+        if dtype is None:
+            continue
+        if dtype == "category":
+            if not isinstance(df[name].dtype, pd.CategoricalDtype):
+                df[name] = df[name].astype("category")
+        elif df[name].dtype != dtype:
+            df[name] = df[name].astype(dtype)
+    if stage:
+        log_frame_memory(stage, df)
+    return df
+
+
+def _rss_mb() -> float | None:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except Exception:
+        return None
+
+
+def log_frame_memory(stage: str, df: pd.DataFrame) -> None:
+    rss = _rss_mb()
+    print(
+        f"[MEM] stage={stage} rows={len(df)} cols={df.shape[1]} "
+        f"frame_mb={df.memory_usage(deep=True).sum() / 1024 / 1024:.1f} "
+        f"rss_mb={'-' if rss is None else f'{rss:.0f}'}"
+    )
+
 
 
 def _gcs() -> storage.Client:
@@ -147,6 +253,10 @@ def get_forecast_model():
 
     return _FORECAST_MODEL
 
+_EE_READY = False
+_EE_LOCK = threading.Lock()
+
+
 def _init_ee():
     """
     تهيئة Earth Engine باستخدام GEE_PROJECT_ID.
@@ -154,24 +264,39 @@ def _init_ee():
     """
     try:
         ee.Initialize(project=PROJECT_ID)
+        ee.data.setDeadline(int(ee_executor.EE_CALL_TIMEOUT_S * 1000))
     except Exception as e:
         raise RuntimeError(
             f"فشل تهيئة Earth Engine داخل health.py باستخدام المشروع '{PROJECT_ID}': {e}"
         )
 
-_init_ee()
 
-session = requests.Session()
-retries = Retry(
-    total=6,
-    backoff_factor=0.8,
-    status_forcelist=[429, 500, 502, 503, 504],
-)
-adapter = HTTPAdapter(max_retries=retries)
-session.mount("http://", adapter)
-session.mount("https://", adapter)
+def _ensure_ee():
+    """
+    تهيئة EE عند أول استخدام (مو وقت الاستيراد) — آمنة بين الـ threads وتنفذ مرة وحدة.
+    مسارات التقارير/الـ debug اللي ما تلمس GEE ما تدفع تكلفتها أبداً.
+    """
+    global _EE_READY
+    if _EE_READY:
+        return
+    with _EE_LOCK:
+        if not _EE_READY:
+            _init_ee()
+            _EE_READY = True
+
 
-memory = joblib.Memory(location=OUT_ROOT, verbose=0)
+def analysis_window(today: pd.Timestamp | None = None) -> Dict[str, pd.Timestamp]:
+    """
+    نافذة التحليل لكل استدعاء (مو ثابتة وقت الاستيراد، عشان الـ worker اللي يعيش أيام ما يحلل بتاريخ قديم):
+    {"today", "date_from", "date_to"}. بداية النافذة تنثبت على يوم الاثنين عشان حدود الأسابيع
+    ما تتغير من تشغيل لتشغيل (ضروري لسجل البكسلات التراكمي في pixel_history).
+    """
+    if today is None:
+        today = pd.Timestamp.now(tz="UTC").tz_localize(None)
+    today = pd.to_datetime(today).normalize()
+    date_from = today - pd.Timedelta(weeks=ANALYSIS_WEEKS)
+    date_from = date_from - pd.Timedelta(days=date_from.weekday())
+    return {"today": today, "date_from": date_from, "date_to": today}
 
 def week_bins(start: pd.Timestamp, end: pd.Timestamp) -> List[Tuple[pd.Timestamp, pd.Timestamp]]:
     """
@@ -189,102 +314,69 @@ def week_bins(start: pd.Timestamp, end: pd.Timestamp) -> List[Tuple[pd.Timestamp
 
 
 
-def _es_kPa(Tc):
-    return 0.6108 * np.exp((17.27 * Tc) / (Tc + 237.3))
+def week_is_final(wend: pd.Timestamp, today: pd.Timestamp) -> bool:
+    """
+    True إذا كل المشاهد اللي ممكن تدخل نافذة الأسبوع [wstart-6, wend+6) صارت متاحة،
+    يعني نتيجة الأسبوع ما راح تتغير ونقدر نخزنها.
+    """
+    wend = pd.to_datetime(wend).normalize()
+    return wend + pd.Timedelta(days=6 + WEEK_FINAL_LAG_DAYS) <= pd.to_datetime(today).normalize()
 
-@memory.cache
-def _weather_open_meteo(lat: float, lon: float, start_date, end_date):
-  
+
+def _weekly_from_daily(daily: pd.DataFrame, start_date) -> pd.DataFrame:
+    """
+    تجميع الطقس اليومي لأسابيع تبدأ من start_date (نفس week_bins).
+    """
+    w = daily.set_index("date").resample(
+        "7D",
+        origin=pd.to_datetime(start_date),
+        label="left",
+        closed="left",
+    )
+    weekly = pd.DataFrame({
+        "precip_mm": w["precip_mm"].sum(),
+        "t2m_mean":  w["t2m_mean"].mean(),
+        "t2m_max":   w["t2m_max"].max(),
+        "t2m_min":   w["t2m_min"].min(),
+        "ssrd_MJ":   w["ssrd_MJ"].sum(),
+        "wind10_ms": w["wind10_ms"].mean(),
+        "vpd_kPa":   w["vpd_kPa"].mean(),
+        "rh2m_mean": w["rh2m_mean"].mean(),
+    }).reset_index().rename(columns={"date": "date"})
+    weekly["date"] = pd.to_datetime(weekly["date"]).dt.normalize()
+    weekly["wx_source"] = "OpenMeteo_ERA5"
+    return weekly
+
+
+def _weather_open_meteo(lat: float, lon: float, start_date, end_date, today=None):
+    """
+    طقس ERA5 الأسبوعي: الأيام من weather_store (مخزنة لكل خلية 0.25°) والتجميع محلي.
+    """
     try:
-        url = "https://archive-api.open-meteo.com/v1/era5"
-        daily_vars = ",".join([
-            "precipitation_sum",
-            "temperature_2m_mean",
-            "temperature_2m_max",
-            "temperature_2m_min",
-            "shortwave_radiation_sum",
-            "wind_speed_10m_mean",
-            "relative_humidity_2m_mean",
-            "dew_point_2m_mean",
-        ])
-        params = {
-            "latitude": float(lat),
-            "longitude": float(lon),
-            "start_date": str(pd.to_datetime(start_date).date()),
-            "end_date":   str(pd.to_datetime(end_date).date()),
-            "daily": daily_vars,
-            "timezone": "UTC",
-        }
-        r = session.get(url, params=params, timeout=60)
-        r.raise_for_status()
-        js = r.json()
-        if "daily" not in js or not js["daily"].get("time"):
+        daily = weather_store.daily_weather(lat, lon, start_date, end_date, today=today)
+        if daily is None or daily.empty:
             return None
-
-        daily = pd.DataFrame(js["daily"])
-        daily["date"] = pd.to_datetime(daily["time"]).dt.normalize()
-
-        if "relative_humidity_2m_mean" in daily.columns:
-            daily["rh2m_mean"] = daily["relative_humidity_2m_mean"]
-        elif "dew_point_2m_mean" in daily.columns:
-            t = daily["temperature_2m_mean"].astype(float)
-            d = daily["dew_point_2m_mean"].astype(float)
-            es = 6.112 * np.exp((17.67 * t) / (t + 243.5))
-            e = 6.112 * np.exp((17.67 * d) / (d + 243.5))
-            daily["rh2m_mean"] = 100.0 * (e / (es + 1e-6))
-        else:
-            daily["rh2m_mean"] = np.nan
-
-        if "dew_point_2m_mean" in daily.columns:
-            t_C = daily["temperature_2m_mean"].astype(float)
-            d_C = daily["dew_point_2m_mean"].astype(float)
-            daily["vpd_kPa"] = _es_kPa(t_C) - _es_kPa(d_C)
-        else:
-            daily["vpd_kPa"] = np.nan
-
-        daily = daily.rename(columns={
-            "precipitation_sum": "precip_mm",
-            "temperature_2m_mean": "t2m_mean",
-            "temperature_2m_max": "t2m_max",
-            "temperature_2m_min": "t2m_min",
-            "shortwave_radiation_sum": "ssrd_MJ",
-            "wind_speed_10m_mean": "wind10_ms",
-        }).set_index("date")
-
-        w = daily.resample(
-            "7D",
-            origin=pd.to_datetime(start_date),
-            label="left",
-            closed="left",
-        )
-        weekly = pd.DataFrame({
-            "precip_mm": w["precip_mm"].sum(),
-            "t2m_mean":  w["t2m_mean"].mean(),
-            "t2m_max":   w["t2m_max"].max(),
-            "t2m_min":   w["t2m_min"].min(),
-            "ssrd_MJ":   w["ssrd_MJ"].sum(),
-            "wind10_ms": w["wind10_ms"].mean(),
-            "vpd_kPa":   w["vpd_kPa"].mean(),
-            "rh2m_mean": w["rh2m_mean"].mean(),
-        }).reset_index().rename(columns={"date": "date"})
-        weekly["date"] = pd.to_datetime(weekly["date"]).dt.normalize()
-        weekly["wx_source"] = "OpenMeteo_ERA5"
-        return weekly
-
+        return _weekly_from_daily(daily, start_date)
     except Exception:
         return None
 
-def weekly_weather(site: Dict[str, Any]) -> pd.DataFrame:
+@profiling.staged("weather")
+def weekly_weather(site: Dict[str, Any], window: Dict[str, pd.Timestamp] | None = None) -> pd.DataFrame:
  
     coords = site["polygon"]
     poly_for_centroid = [{"lat": lat, "lng": lon} for (lon, lat) in coords]
     lat, lon = polygon_centroid(poly_for_centroid)
-    weeks = week_bins(DATE_FROM, DATE_TO)
+    window = window or analysis_window()
+    weeks = week_bins(window["date_from"], window["date_to"])
 
-    om = _weather_open_meteo(lat, lon, DATE_FROM, DATE_TO)
+    om = _weather_open_meteo(lat, lon, window["date_from"], window["date_to"], today=window["today"])
     if om is not None and not om.empty:
         return om
+    return _weather_empty(weeks)
 
+
+def _weather_empty(weeks: List[Tuple[pd.Timestamp, pd.Timestamp]]) -> pd.DataFrame:
+    # سطر لكل أسبوع بقيم NaN (ما فيه مصدر طقس) — الـ pipeline يكمل عادي
     df = pd.DataFrame({
         "date": [w[0].normalize() for w in weeks],
         "precip_mm": np.nan,
@@ -301,8 +393,18 @@ def weekly_weather(site: Dict[str, Any]) -> pd.DataFrame:
 
 
 
+def weather_result(future, window: Dict[str, pd.Timestamp]) -> pd.DataFrame:
+    """نتيجة weekly_weather من الـ executor؛ لو تعدت مهلة الانتظار نكمل بطقس NaN مثل فشل Open-Meteo."""
+    try:
+        return ee_executor.result(future)
+    except TimeoutError:
+        print("[WX] timeout waiting for weather → NaN weather")
+        return _weather_empty(week_bins(window["date_from"], window["date_to"]))
+
+
 def load_week_LST_Landsat_GEE(site: Dict[str, Any], d_from, d_to) -> float:
    
+    _ensure_ee()
     site_name = site.get("name", "UNKNOWN")
     geom = ee.Geometry.Polygon(site["polygon"])
 
@@ -325,7 +427,7 @@ def load_week_LST_Landsat_GEE(site: Dict[str, Any], d_from, d_to) -> float:
     col = col8.merge(col9)
 
     try:
-        size = col.size().getInfo()
+        size = ee_executor.call_with_retry(col.size().getInfo)
     except Exception as e:
         print(f"[LST] ERROR size().getInfo() for site={site_name}: {type(e).__name__}: {e}")
         return np.nan
@@ -363,13 +465,13 @@ def load_week_LST_Landsat_GEE(site: Dict[str, Any], d_from, d_to) -> float:
     lst_c = lst_k.subtract(273.15).rename("LST_C")
 
     try:
-        mean_dict = lst_c.reduceRegion(
+        mean_dict = ee_executor.call_with_retry(lst_c.reduceRegion(
             reducer=ee.Reducer.mean(),
             geometry=geom,
             scale=30,
             maxPixels=1e8,
             bestEffort=True,
-        ).getInfo()
+        ).getInfo)
     except Exception as e:
         print(f"[LST] ERROR reduceRegion() site={site_name}, img={img_id}, "
               f"window={d_from_iso}→{d_to_iso}: {type(e).__name__}: {e}")
@@ -384,6 +486,13 @@ def load_week_LST_Landsat_GEE(site: Dict[str, Any], d_from, d_to) -> float:
         print(f"[LST] reduceRegion has no 'LST_C' key for site={site_name}, img={img_id} → {mean_dict}")
         return np.nan
 
+    return _lst_value_or_nan(val, site_name, img_id)
+
+
+def _lst_value_or_nan(val, site_name: str, img_id) -> float:
+    """
+    تحويل متوسط LST_C إلى float مع استبعاد القيم خارج نطاق 15–65 °C (ترجع NaN).
+    """
     try:
         temp_c = float(val)
     except Exception as e:
@@ -399,26 +508,154 @@ def load_week_LST_Landsat_GEE(site: Dict[str, Any], d_from, d_to) -> float:
     return temp_c
 
 
+def _lst_weeks_fc(geom: ee.Geometry, weeks: List[Tuple[pd.Timestamp, pd.Timestamp]]) -> ee.FeatureCollection:
+    """
+    FeatureCollection فيها Feature لكل أسبوع: week_idx + LST_C (متوسط المضلع لأقل مشهد غيوم)
+    + img_id. الأسابيع بدون مشهد أو بدون ST_B10 ما يكون فيها LST_C.
+    """
+    d_from = (weeks[0][0] - pd.Timedelta(days=6)).date().isoformat()
+    d_to   = (weeks[-1][1] + pd.Timedelta(days=6)).date().isoformat()
 
+    col8 = (ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
+            .filterBounds(geom)
+            .filterDate(d_from, d_to)
+            .filter(ee.Filter.lt("CLOUD_COVER", 80)))
+    col9 = (ee.ImageCollection("LANDSAT/LC09/C02/T1_L2")
+            .filterBounds(geom)
+            .filterDate(d_from, d_to)
+            .filter(ee.Filter.lt("CLOUD_COVER", 80)))
+    col = col8.merge(col9)
 
-def s2_week_pixels_gee(site: Dict[str, Any], wstart: pd.Timestamp, wend: pd.Timestamp) -> pd.DataFrame | None:
-  
-    site_name = site["name"]
+    items = ee.List([
+        [i,
+         (wstart - pd.Timedelta(days=6)).date().isoformat(),
+         (wend   + pd.Timedelta(days=6)).date().isoformat()]
+        for i, (wstart, wend) in enumerate(weeks)
+    ])
+
+    def _week_lst(item):
+        item = ee.List(item)
+        wcol = col.filterDate(item.get(1), item.get(2))
+        img = ee.Image(wcol.sort("CLOUD_COVER").first())
+
+        lst_c = (img.select("ST_B10")
+                 .multiply(0.00341802)
+                 .add(149.0)
+                 .subtract(273.15)
+                 .rename("LST_C"))
+        mean_val = lst_c.reduceRegion(
+            reducer=ee.Reducer.mean(),
+            geometry=geom,
+            scale=30,
+            maxPixels=1e8,
+            bestEffort=True,
+        ).get("LST_C")
+
+        has_img = wcol.size().gt(0)
+        return ee.Feature(None, {
+            "week_idx": item.get(0),
+            "img_id": ee.Algorithms.If(has_img, img.get("LANDSAT_PRODUCT_ID"), None),
+            "LST_C": ee.Algorithms.If(
+                has_img,
+                ee.Algorithms.If(img.bandNames().contains("ST_B10"), mean_val, None),
+                None,
+            ),
+        })
+
+    return ee.FeatureCollection(items.map(_week_lst))
+
+
+def lst_series_landsat_gee(site: Dict[str, Any], weeks: List[Tuple[pd.Timestamp, pd.Timestamp]]) -> List[float]:
+    """
+    نفس نتيجة load_week_LST_Landsat_GEE لكل الأسابيع بطلب واحد (getInfo واحد).
+    ترجع قائمة بنفس ترتيب weeks، وNaN للأسبوع اللي ما له قيمة صالحة.
+    """
+    return _lst_series_fetch(site, weeks)[0]
+
+
+@profiling.staged("lst_fetch")
+def _lst_series_fetch(site: Dict[str, Any], weeks: List[Tuple[pd.Timestamp, pd.Timestamp]]) -> Tuple[List[float], bool]:
+    """
+    مثل lst_series_landsat_gee + هل الطلب نجح (False = كل القيم NaN بسبب خطأ، لا تنخزن).
+    """
+    out = [np.nan] * len(weeks)
+    if not weeks:
+        return out, True
+
+    _ensure_ee()
+    site_name = site.get("name", "UNKNOWN")
     geom = ee.Geometry.Polygon(site["polygon"])
 
-    d_from = (wstart - pd.Timedelta(days=6)).date().isoformat()
-    d_to   = (wend   + pd.Timedelta(days=6)).date().isoformat()
+    try:
+        info = ee_executor.call_with_retry(_lst_weeks_fc(geom, weeks).getInfo)
+    except Exception as e:
+        print(f"[LST] ERROR batched series for site={site_name}: {type(e).__name__}: {e}")
+        return out, False
+
+    for feat in (info or {}).get("features", []) or []:
+        props = feat.get("properties") or {}
+        idx = props.get("week_idx")
+        val = props.get("LST_C")
+        if idx is None or val is None:
+            continue
+        out[int(idx)] = _lst_value_or_nan(val, site_name, props.get("img_id", "UNKNOWN_ID"))
 
-    col = (ee.ImageCollection(S2_COLLECTION)
-           .filterBounds(geom)
-           .filterDate(d_from, d_to)
-           .filter(ee.Filter.lte("CLOUDY_PIXEL_PERCENTAGE", MAX_CLOUD)))
+    return out, True
 
-    size = col.size().getInfo()
-    if size == 0:
-        return None
 
-    image = ee.Image(col.sort("CLOUDY_PIXEL_PERCENTAGE").first())
+def _with_site(name: str):
+    return lambda f: ee.Feature(f).set("site", name)
+
+
+@profiling.staged("lst_fetch")
+def lst_farms_series_fetch(
+    jobs: List[Tuple[Dict[str, Any], List[Tuple[pd.Timestamp, pd.Timestamp]]]],
+) -> Dict[str, Tuple[List[float], bool]]:
+    """
+    _lst_series_fetch لعدة مزارع بـ getInfo واحد لكل S2_BATCH_FARMS مزرعة.
+    يرجّع {اسم المزرعة: (القيم بترتيب أسابيعها, نجح؟)}.
+    """
+    out: Dict[str, Tuple[List[float], bool]] = {
+        site["name"]: ([np.nan] * len(weeks), True) for site, weeks in jobs
+    }
+    jobs = [(site, weeks) for site, weeks in jobs if weeks]
+    if not jobs:
+        return out
+
+    _ensure_ee()
+    per_req = max(1, S2_BATCH_FARMS)
+    for f0 in range(0, len(jobs), per_req):
+        group = jobs[f0:f0 + per_req]
+        fc = ee.FeatureCollection([
+            _lst_weeks_fc(ee.Geometry.Polygon(site["polygon"]), weeks).map(_with_site(site["name"]))
+            for site, weeks in group
+        ]).flatten()
+
+        try:
+            info = ee_executor.call_with_retry(fc.getInfo)
+        except Exception as e:
+            names = ",".join(site["name"] for site, _ in group)
+            print(f"[LST] ERROR multi-farm series sites={names}: {type(e).__name__}: {e}")
+            for site, weeks in group:
+                out[site["name"]] = ([np.nan] * len(weeks), False)
+            continue
+
+        for feat in (info or {}).get("features", []) or []:
+            props = feat.get("properties") or {}
+            name, idx, val = props.get("site"), props.get("week_idx"), props.get("LST_C")
+            if name not in out or idx is None or val is None:
+                continue
+            out[name][0][int(idx)] = _lst_value_or_nan(val, name, props.get("img_id", "UNKNOWN_ID"))
+
+    return out
+
+
+
+
+def _s2_masked(image: ee.Image) -> ee.Image:
+    """
+    قناع SCL: نخلي بس الغطاء النباتي/التربة (4, 5) ونشيل الغيوم والظلال والثلج.
+    """
     scl = image.select("SCL")
 
     valid = scl.eq(4).Or(scl.eq(5))
@@ -428,7 +665,77 @@ def s2_week_pixels_gee(site: Dict[str, Any], wstart: pd.Timestamp, wend: pd.Time
               .Or(scl.eq(10))
               .Or(scl.eq(11)))
     mask = valid.And(clouds.Not())
-    image = image.updateMask(mask)
+    return image.updateMask(mask)
+
+
+def _s2_coords_image() -> ee.Image:
+    # جلب الإحداثيات الجغرافية
+    lonlat = ee.Image.pixelLonLat()
+    
+    # السر هنا: نعيد تسمية longitude إلى x و latitude إلى y
+    # لكي لا يشعر باقي الكود بأي تغيير ويستمر في الحسابات بشكل سليم
+    return lonlat.select(['longitude', 'latitude'], ['x', 'y'])
+
+
+def pixel_sampling(site: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    عدد البكسلات المتوقع من مساحة المضلع، ولو تعدى S2_PIXEL_BUDGET نأخذ بكسل واحد من كل stride×stride
+    على شبكة ثابتة (نفس البكسلات كل أسبوع عشان السلاسل الزمنية تبقى متطابقة).
+    fraction = النسبة الاسمية 1/stride² — الفعلية (fraction_actual) تنحسب من الأسطر المجلوبة في sampled_fraction.
+    """
+    area = polygon_area_m2([{"lng": x, "lat": y} for x, y in site["polygon"]])
+    est = int(area / (RESOLUTION * RESOLUTION))
+    stride = 1
+    if S2_PIXEL_BUDGET > 0 and est > S2_PIXEL_BUDGET:
+        stride = int(math.ceil(math.sqrt(est / S2_PIXEL_BUDGET)))
+    return {
+        "estimated_pixels": est,
+        "budget": S2_PIXEL_BUDGET,
+        "stride": stride,
+        "fraction": round(1.0 / (stride * stride), 4),
+    }
+
+
+def sampled_fraction(site: Dict[str, Any], df_s2: pd.DataFrame) -> Dict[str, Any]:
+    """
+    pixel_sampling + اللي انأخذ فعلاً: sampled_pixels = أكثر عدد بكسلات في أسبوع واحد (أصفى أسبوع)،
+    و fraction_actual = sampled_pixels ÷ estimated_pixels.
+    """
+    out = pixel_sampling(site)
+    sampled = int(df_s2.groupby("date").size().max()) if not df_s2.empty else 0
+    out["sampled_pixels"] = sampled
+    out["fraction_actual"] = round(sampled / out["estimated_pixels"], 4) if out["estimated_pixels"] else None
+    return out
+
+
+def _s2_grid_mask(stride, proj: ee.Projection) -> ee.Image:
+    # الشبكة بنفس إسقاط الباند (UTM اللي يصير فيه sample) بالمتر: كل بكسل 10 م خلية وحدة بالضبط،
+    # فالنسبة الفعلية 1/stride² بدون aliasing (شبكة EPSG:3857 كانت تنزاح عن بكسلات UTM).
+    # شبكة S2 مثبتة على مضاعفات 10 م بالـ UTM، فنفس البكسلات تنختار كل أسبوع
+    cell = ee.Image.pixelCoordinates(ee.Projection(proj.crs())).divide(RESOLUTION).floor()
+    return cell.select("x").mod(stride).eq(0).And(cell.select("y").mod(stride).eq(0))
+
+
+def _s2_fetch_image(image: ee.Image, stride=1) -> ee.Image:
+    """
+    الصورة اللي تنأخذ منها العينات حسب S2_TRANSFER_MODE:
+    raw → الباندات الخام uint16 (SR ممكن تتعدى 32767) والمؤشرات تنحسب محلياً في s2_indices_local، وإلا المؤشرات نفسها.
+    stride (رقم أو ee.Number) > 1 → نخلي بس بكسلات الشبكة (pixel_sampling).
+    """
+    if S2_TRANSFER_MODE == "raw":
+        img = _s2_masked(image).select(S2_RAW_BANDS).toUint16().addBands(_s2_coords_image())
+    else:
+        img = _s2_index_image(image)
+    if isinstance(stride, int) and stride <= 1:
+        return img
+    return img.updateMask(_s2_grid_mask(stride, image.select("B2").projection()))
+
+
+def _s2_index_image(image: ee.Image) -> ee.Image:
+    """
+    يطبّق قناع SCL على مشهد Sentinel-2 ويحسب المؤشرات الطيفية + إحداثيات البكسل (x/y).
+    """
+    image = _s2_masked(image)
 
     B2  = image.select("B2")
     B3  = image.select("B3")
@@ -474,14 +781,72 @@ def s2_week_pixels_gee(site: Dict[str, Any], wstart: pd.Timestamp, wend: pd.Time
                    .addBands(srwi)
                    .addBands(nmdi))
 
-    # جلب الإحداثيات الجغرافية
-    lonlat = ee.Image.pixelLonLat()
-    
-    # السر هنا: نعيد تسمية longitude إلى x و latitude إلى y
-    # لكي لا يشعر باقي الكود بأي تغيير ويستمر في الحسابات بشكل سليم
-    coords_img = lonlat.select(['longitude', 'latitude'], ['x', 'y'])
-    
-    full_img = indices_img.addBands(coords_img)
+    return indices_img.addBands(_s2_coords_image())
+
+
+def s2_indices_local(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    يحسب INDEX_COLS_ALL من الباندات الخام (S2_INDEX_TABLE) بتمريرة NumPy وحدة ويشيل الباندات.
+    المعادلات المكررة (NDMI = NDWI_Gao = SIWSI1) تنحسب مرة وحدة.
+    """
+    if df is None or df.empty or not set(S2_RAW_BANDS).issubset(df.columns):
+        return df
+
+    raw = df[S2_RAW_BANDS].to_numpy(dtype=np.float64)
+    band = {b: raw[:, i] for i, b in enumerate(S2_RAW_BANDS)}
+
+    done: Dict[Tuple[str, ...], np.ndarray] = {}
+    out: Dict[str, np.ndarray] = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for name, spec in S2_INDEX_TABLE.items():
+            if spec not in done:
+                kind, *bands = spec
+                v = [band[b] for b in bands]
+                if kind == "ratio":
+                    done[spec] = (v[0] - v[1]) / (v[0] + v[1] + 1e-6)
+                elif kind == "simple":
+                    done[spec] = v[0] / (v[1] + 1e-6)
+                elif kind == "mtci":
+                    done[spec] = (v[0] - v[1]) / (v[1] - v[2] + 1e-6)
+                elif kind == "nmdi":
+                    done[spec] = (v[0] - (v[1] - v[2])) / (v[0] + (v[1] - v[2]) + 1e-6)
+                else:
+                    raise ValueError(f"نوع معادلة غير معروف في S2_INDEX_TABLE: {kind!r}")
+            out[name] = done[spec]
+
+    rest = df.drop(columns=S2_RAW_BANDS)
+    return pd.concat([rest.reset_index(drop=True), pd.DataFrame(out)], axis=1)
+
+
+# s2_week_pixels_gee: فشل الطلب (يختلف عن None = ما فيه مشهد) — الأسبوع ما ينخزن في الكاش/السجل
+S2_WEEK_FAILED = object()
+
+
+def s2_week_pixels_gee(
+    site: Dict[str, Any],
+    wstart: pd.Timestamp,
+    wend: pd.Timestamp,
+    check_size: bool = True,
+) -> pd.DataFrame | None | object:
+    """
+    check_size=False لما تكون خطة الجلب (build_fetch_plan) أكدت وجود مشهد في هذا الأسبوع،
+    فنوفر طلب size().getInfo().
+    يرجّع None لو الأسبوع فاضي فعلاً، و S2_WEEK_FAILED لو فشل الجلب من GEE.
+    """
+    _ensure_ee()
+    site_name = site["name"]
+    geom = ee.Geometry.Polygon(site["polygon"])
+
+    d_from = (wstart - pd.Timedelta(days=6)).date().isoformat()
+    d_to   = (wend   + pd.Timedelta(days=6)).date().isoformat()
+
+    col = (ee.ImageCollection(S2_COLLECTION)
+           .filterBounds(geom)
+           .filterDate(d_from, d_to)
+           .filter(ee.Filter.lte("CLOUDY_PIXEL_PERCENTAGE", MAX_CLOUD)))
+
+    image = ee.Image(col.sort("CLOUDY_PIXEL_PERCENTAGE").first())
+    full_img = _s2_fetch_image(image, pixel_sampling(site)["stride"])
 
     fc = full_img.sample(
         region=geom,
@@ -490,37 +855,585 @@ def s2_week_pixels_gee(site: Dict[str, Any], wstart: pd.Timestamp, wend: pd.Time
         seed=42,
     )
 
+    # size() و ee_to_df تحت نفس الحماية: فشل أي واحد (بعد الـ retry) يفشّل هالأسبوع بس مو المزرعة كلها
     try:
-        df = geemap.ee_to_df(fc)
-    except Exception:
-        return None
+        if check_size:
+            size = ee_executor.call_with_retry(col.size().getInfo)
+            if size == 0:
+                return None
+        df = ee_executor.call_with_retry(geemap.ee_to_df, fc)
+    except Exception as e:
+        print(f"[S2] ERROR site={site_name} week={pd.to_datetime(wstart).date()}: {type(e).__name__}: {e}")
+        return S2_WEEK_FAILED
 
     if df.empty:
         return None
 
+    df = pixel_cube.add_pixel_id(s2_indices_local(df))
     df["site"] = site_name
     df["date"] = pd.to_datetime(wstart).normalize()
-    return df
+    return apply_dtype_plan(df)
 
 
+def _s2_week_items(weeks: List[Tuple[pd.Timestamp, pd.Timestamp]], first_idx: int) -> List[List[Any]]:
+    # [week_idx, بداية النافذة, نهاية النافذة] — نافذة كل أسبوع ±6 أيام زي s2_week_pixels_gee
+    return [
+        [first_idx + i,
+         (wstart - pd.Timedelta(days=6)).date().isoformat(),
+         (wend   + pd.Timedelta(days=6)).date().isoformat()]
+        for i, (wstart, wend) in enumerate(weeks)
+    ]
 
-def add_features(df: pd.DataFrame) -> pd.DataFrame:
-  
+
+def _s2_weekly_images(base: ee.ImageCollection, items: ee.List, stride=1) -> ee.ImageCollection:
+    """
+    أفضل مشهد (أقل غيوم) لكل أسبوع في items كصورة وحدة عليها باند week_idx؛ الأسبوع الفاضي ينشال.
+    """
+    def _week_composite(item):
+        item = ee.List(item)
+        wcol = base.filterDate(item.get(1), item.get(2))
+        best = _s2_fetch_image(ee.Image(wcol.sort("CLOUDY_PIXEL_PERCENTAGE").first()), stride)
+        best = best.addBands(ee.Image.constant(item.get(0)).toInt16().rename("week_idx"))
+        return ee.Algorithms.If(wcol.size().gt(0), best, None)
+
+    return ee.ImageCollection(items.map(_week_composite, True))
+
+
+def _s2_weeks_fc(
+    geom: ee.Geometry,
+    weeks: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    first_idx: int,
+    stride: int = 1,
+) -> ee.FeatureCollection:
+    """
+    يبني كل المركّبات الأسبوعية على السيرفر كـ ImageCollection واحدة (أفضل مشهد لكل أسبوع)
+    ثم يأخذ عينات البكسلات منها كلها بطلب واحد. كل بكسل يحمل week_idx لأسبوعه.
+    """
+    d_from = (weeks[0][0] - pd.Timedelta(days=6)).date().isoformat()
+    d_to   = (weeks[-1][1] + pd.Timedelta(days=6)).date().isoformat()
+
+    base = (ee.ImageCollection(S2_COLLECTION)
+            .filterBounds(geom)
+            .filterDate(d_from, d_to)
+            .filter(ee.Filter.lte("CLOUDY_PIXEL_PERCENTAGE", MAX_CLOUD)))
+
+    weekly = _s2_weekly_images(base, ee.List(_s2_week_items(weeks, first_idx)), stride)
+
+    return weekly.map(
+        lambda img: img.sample(
+            region=geom,
+            scale=RESOLUTION,
+            geometries=False,
+            seed=42,
+        )
+    ).flatten()
+
+
+def _s2_chunk_df(
+    site_name: str,
+    geom: ee.Geometry,
+    chunk: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    first_idx: int,
+    stride: int = 1,
+) -> Tuple[bool, pd.DataFrame | None]:
+    try:
+        return True, ee_executor.call_with_retry(geemap.ee_to_df, _s2_weeks_fc(geom, chunk, first_idx=first_idx, stride=stride))
+    except Exception as e:
+        print(f"[S2] ERROR batched fetch site={site_name} weeks {first_idx}..{first_idx + len(chunk) - 1}: "
+              f"{type(e).__name__}: {e}")
+        return False, None
+
+
+def s2_series_pixels_gee(site: Dict[str, Any], weeks: List[Tuple[pd.Timestamp, pd.Timestamp]]) -> pd.DataFrame | None:
+    """
+    نفس مخرجات s2_week_pixels_gee لكل الأسابيع دفعة وحدة (long-form: بكسل × أسبوع)،
+    بطلب واحد لكل S2_BATCH_WEEKS أسبوع بدل طلبين أو أكثر لكل أسبوع.
+    الدفعات تنرسل بالتوازي عبر ee_executor.
+    """
+    return _s2_series_fetch(site, weeks)[0]
+
+
+def _s2_series_fetch(site: Dict[str, Any], weeks: List[Tuple[pd.Timestamp, pd.Timestamp]]) -> Tuple[pd.DataFrame | None, Set[pd.Timestamp]]:
+    """
+    مثل s2_series_pixels_gee + مجموعة بدايات الأسابيع اللي فشل طلبها (عشان ما تنخزن كأسابيع فاضية).
+    """
+    if not weeks:
+        return None, set()
+
+    _ensure_ee()
+    site_name = site["name"]
+    geom = ee.Geometry.Polygon(site["polygon"])
+    week_starts = pd.DatetimeIndex([pd.to_datetime(w[0]).normalize() for w in weeks])
+    stride = pixel_sampling(site)["stride"]
+
+    step = max(1, S2_BATCH_WEEKS)
+    results = ee_executor.run_parallel([
+        (_s2_chunk_df, (site_name, geom, weeks[i:i + step], i, stride))
+        for i in range(0, len(weeks), step)
+    ])
+
+    frames: List[pd.DataFrame] = []
+    failed: Set[pd.Timestamp] = set()
+    for i, (ok, df) in zip(range(0, len(weeks), step), results):
+        if not ok:
+            failed.update(week_starts[i:i + step])
+        elif df is not None and not df.empty:
+            frames.append(df)
+
+    if not frames:
+        return None, failed
+
+    return _s2_series_frame(site_name, week_starts, frames), failed
+
+
+def _s2_series_frame(site_name: str, week_starts: pd.DatetimeIndex, frames: List[pd.DataFrame]) -> pd.DataFrame:
+    df = pixel_cube.add_pixel_id(s2_indices_local(pd.concat(frames, ignore_index=True)))
+    df["site"] = site_name
+    df["date"] = week_starts[df["week_idx"].astype(int).to_numpy()]
+    return apply_dtype_plan(df.drop(columns=["week_idx"]))
+
+
+def _s2_farms_fc(jobs: List[Tuple[Dict[str, Any], List[Tuple[pd.Timestamp, pd.Timestamp]], int]]) -> ee.FeatureCollection:
+    """
+    نفس _s2_weeks_fc لعدة مزارع بطلب واحد: jobs = [(site, weeks, first_idx), ...].
+    كل مزرعة Feature (المضلع + أسابيعها)، وكل بكسل يرجع ومعه site و week_idx.
+    """
+    d_from = min(weeks[0][0] for _, weeks, _ in jobs) - pd.Timedelta(days=6)
+    d_to   = max(weeks[-1][1] for _, weeks, _ in jobs) + pd.Timedelta(days=6)
+
+    farms = ee.FeatureCollection([
+        ee.Feature(
+            ee.Geometry.Polygon(site["polygon"]),
+            {
+                "site": site["name"],
+                "items": _s2_week_items(weeks, first_idx),
+                "stride": pixel_sampling(site)["stride"],
+            },
+        )
+        for site, weeks, first_idx in jobs
+    ])
+
+    base = (ee.ImageCollection(S2_COLLECTION)
+            .filterBounds(farms.geometry())
+            .filterDate(d_from.date().isoformat(), d_to.date().isoformat())
+            .filter(ee.Filter.lte("CLOUDY_PIXEL_PERCENTAGE", MAX_CLOUD)))
+
+    def _farm_pixels(farm):
+        farm = ee.Feature(farm)
+        geom = farm.geometry()
+        name = farm.get("site")
+        weekly = _s2_weekly_images(base.filterBounds(geom), ee.List(farm.get("items")), ee.Number(farm.get("stride")))
+        return weekly.map(
+            lambda img: img.sample(
+                region=geom,
+                scale=RESOLUTION,
+                geometries=False,
+                seed=42,
+            ).map(lambda px: px.set("site", name))
+        ).flatten()
+
+    return farms.map(_farm_pixels).flatten()
+
+
+def _s2_farms_chunk_df(jobs: List[Tuple[Dict[str, Any], List[Tuple[pd.Timestamp, pd.Timestamp]], int]]) -> Tuple[bool, pd.DataFrame | None]:
+    try:
+        return True, ee_executor.call_with_retry(geemap.ee_to_df, _s2_farms_fc(jobs))
+    except Exception as e:
+        names = ",".join(site["name"] for site, _, _ in jobs)
+        print(f"[S2] ERROR multi-farm fetch sites={names} weeks from {jobs[0][2]}: {type(e).__name__}: {e}")
+        return False, None
+
+
+@profiling.staged("s2_fetch")
+def s2_farms_series_fetch(
+    jobs: List[Tuple[Dict[str, Any], List[Tuple[pd.Timestamp, pd.Timestamp]]]],
+) -> Dict[str, Tuple[pd.DataFrame | None, Set[pd.Timestamp]]]:
+    """
+    مثل _s2_series_fetch لعدة مزارع: كل طلب GEE يغطي S2_BATCH_WEEKS أسبوع من S2_BATCH_FARMS مزرعة
+    بدل طلب لكل مزرعة، والنتيجة تنقسم بعمود site.
+    يرجّع {اسم المزرعة: (df, الأسابيع الفاشلة)}.
+    """
+    jobs = [(site, weeks) for site, weeks in jobs if weeks]
+    out: Dict[str, Tuple[pd.DataFrame | None, Set[pd.Timestamp]]] = {}
+    if not jobs:
+        return out
+
+    _ensure_ee()
+    step = max(1, S2_BATCH_WEEKS)
+    per_req = max(1, S2_BATCH_FARMS)
+
+    requests_: List[List[Tuple[Dict[str, Any], List[Tuple[pd.Timestamp, pd.Timestamp]], int]]] = []
+    for f0 in range(0, len(jobs), per_req):
+        group = jobs[f0:f0 + per_req]
+        n_weeks = max(len(weeks) for _, weeks in group)
+        for i in range(0, n_weeks, step):
+            req = [(site, weeks[i:i + step], i) for site, weeks in group if weeks[i:i + step]]
+            if req:
+                requests_.append(req)
+
+    print(f"[S2] multi-farm fetch farms={len(jobs)} requests={len(requests_)}")
+    results = ee_executor.run_parallel([(_s2_farms_chunk_df, (req,)) for req in requests_])
+
+    frames: Dict[str, List[pd.DataFrame]] = {site["name"]: [] for site, _ in jobs}
+    failed: Dict[str, Set[pd.Timestamp]] = {site["name"]: set() for site, _ in jobs}
+    for req, (ok, df) in zip(requests_, results):
+        if not ok:
+            for site, weeks, _ in req:
+                failed[site["name"]].update(pd.to_datetime(w[0]).normalize() for w in weeks)
+            continue
+        if df is None or df.empty:
+            continue
+        for name, part in df.groupby("site", sort=False):
+            if name in frames:
+                frames[name].append(part.drop(columns=["site"]))
+
+    for site, weeks in jobs:
+        name = site["name"]
+        week_starts = pd.DatetimeIndex([pd.to_datetime(w[0]).normalize() for w in weeks])
+        df = _s2_series_frame(name, week_starts, frames[name]) if frames[name] else None
+        out[name] = (df, failed[name])
+    return out
+
+
+def probe_scene_availability(site: Dict[str, Any], d_from, d_to) -> Dict[str, pd.DataFrame] | None:
+    """
+    طلب واحد يرجّع كل مشاهد S2 (بعد فلتر MAX_CLOUD) وLandsat 8/9 (CLOUD_COVER < 80)
+    فوق المضلع بين d_from و d_to: {"s2": DataFrame(time, cloud), "landsat": DataFrame(time, cloud)}.
+    يرجّع None إذا فشل الطلب (وقتها نجلب كل الأسابيع كالعادة).
+    """
+    _ensure_ee()
+    site_name = site.get("name", "UNKNOWN")
+    geom = ee.Geometry.Polygon(site["polygon"])
+    d_from_iso = pd.to_datetime(d_from).date().isoformat()
+    d_to_iso = pd.to_datetime(d_to).date().isoformat()
+
+    s2 = (ee.ImageCollection(S2_COLLECTION)
+          .filterBounds(geom)
+          .filterDate(d_from_iso, d_to_iso)
+          .filter(ee.Filter.lte("CLOUDY_PIXEL_PERCENTAGE", MAX_CLOUD)))
+    landsat = (ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
+               .merge(ee.ImageCollection("LANDSAT/LC09/C02/T1_L2"))
+               .filterBounds(geom)
+               .filterDate(d_from_iso, d_to_iso)
+               .filter(ee.Filter.lt("CLOUD_COVER", 80)))
+
+    try:
+        info = ee_executor.call_with_retry(ee.Dictionary({
+            "s2_time": s2.aggregate_array("system:time_start"),
+            "s2_cloud": s2.aggregate_array("CLOUDY_PIXEL_PERCENTAGE"),
+            "ls_time": landsat.aggregate_array("system:time_start"),
+            "ls_cloud": landsat.aggregate_array("CLOUD_COVER"),
+        }).getInfo)
+    except Exception as e:
+        print(f"[PROBE] ERROR scene probe for site={site_name}: {type(e).__name__}: {e}")
+        return None
+
+    def _scenes(times, clouds) -> pd.DataFrame:
+        times = times or []
+        clouds = clouds or []
+        if len(clouds) != len(times):
+            clouds = [np.nan] * len(times)
+        return pd.DataFrame({
+            "time": pd.to_datetime(pd.Series(times, dtype="float64"), unit="ms"),
+            "cloud": pd.Series(clouds, dtype="float64"),
+        }).sort_values("time").reset_index(drop=True)
+
+    scenes = {
+        "s2": _scenes(info.get("s2_time"), info.get("s2_cloud")),
+        "landsat": _scenes(info.get("ls_time"), info.get("ls_cloud")),
+    }
+    print(f"[PROBE] site={site_name} {d_from_iso}→{d_to_iso} "
+          f"s2_scenes={len(scenes['s2'])} landsat_scenes={len(scenes['landsat'])}")
+    return scenes
+
+
+def imagery_stamp_from_scenes(
+    site: Dict[str, Any],
+    scenes: Dict[str, pd.DataFrame] | None,
+    window: Dict[str, pd.Timestamp],
+) -> Dict[str, Any] | None:
+    """
+    بصمة المدخلات اللي انبنى عليها التحليل — لو ما تغيرت من آخر تحليل، النتيجة المخزنة ما راح تتغير:
+    - آخر مشهد S2/Landsat وعدد المشاهد بالنافذة (مشهد قديم ينضاف متأخر أو أسبوع LST جديد يغيّر العدد).
+    - بداية النافذة (الأسابيع القديمة تطلع منها) وآخر أسبوع طقس ERA5 نهائي.
+    - مفتاح المضلع.
+    None لو فشل الـ probe.
+    """
+    if scenes is None:
+        return None
+
+    def _latest(df: pd.DataFrame) -> str | None:
+        return None if df.empty else pd.to_datetime(df["time"]).max().isoformat()
+
+    wx_final = window["today"] - pd.Timedelta(days=weather_store.ERA5_FINAL_LAG_DAYS)
+    return {
+        "s2_latest": _latest(scenes["s2"]),
+        "landsat_latest": _latest(scenes["landsat"]),
+        "s2_scenes": int(len(scenes["s2"])),
+        "landsat_scenes": int(len(scenes["landsat"])),
+        "window_from": window["date_from"].date().isoformat(),
+        "weather_final_week": (wx_final - pd.Timedelta(days=wx_final.weekday())).date().isoformat(),
+        "polygon_key": pixel_history.history_key(site["name"], site["polygon"], pixel_sampling(site)["stride"]),
+    }
+
+
+@profiling.staged("scene_probe")
+def _window_scenes(site: Dict[str, Any], window: Dict[str, pd.Timestamp]) -> Dict[str, pd.DataFrame] | None:
+    # نفس مدى probe في fetch_weeks_gee لكل النافذة (نوافذ الأسابيع ±6 أيام)
+    return probe_scene_availability(
+        site,
+        window["date_from"] - pd.Timedelta(days=6),
+        window["date_to"] + pd.Timedelta(days=6),
+    )
+
+
+def imagery_stamp(farm_id: str, farm_doc: Dict[str, Any], window: Dict[str, pd.Timestamp] | None = None) -> Dict[str, Any] | None:
+    """
+    فحص رخيص (طلب GEE واحد) قبل التحليل الكامل: يقارن مع health.imagery_stamp المخزن.
+    """
+    poly = farm_doc.get("polygon") or []
+    if len(poly) < 3:
+        return None
+    site = {"name": farm_id, "polygon": [(p["lng"], p["lat"]) for p in poly]}
+    window = window or analysis_window()
+    return imagery_stamp_from_scenes(site, _window_scenes(site, window), window)
+
+
+def build_fetch_plan(
+    weeks: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    scenes: Dict[str, pd.DataFrame] | None,
+) -> Dict[str, List[Tuple[pd.Timestamp, pd.Timestamp]]]:
+    """
+    يحدد أي أسابيع فيها مشهد فعلاً داخل نافذتها [wstart-6, wend+6) لكل مصدر.
+    بدون probe (None) نرجّع كل الأسابيع للمصدرين.
+    """
+    if scenes is None:
+        return {"s2": list(weeks), "landsat": list(weeks)}
+
+    plan: Dict[str, List[Tuple[pd.Timestamp, pd.Timestamp]]] = {"s2": [], "landsat": []}
+    for source in ("s2", "landsat"):
+        times = scenes[source]["time"].to_numpy()
+        for wstart, wend in weeks:
+            lo = np.datetime64(pd.to_datetime(wstart) - pd.Timedelta(days=6))
+            hi = np.datetime64(pd.to_datetime(wend) + pd.Timedelta(days=6))
+            if ((times >= lo) & (times < hi)).any():
+                plan[source].append((wstart, wend))
+    return plan
+
+
+@profiling.staged("s2_fetch")
+def s2_weeks_cached(
+    site: Dict[str, Any],
+    weeks: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    available: Set[pd.Timestamp] | None = None,
+    today: pd.Timestamp | None = None,
+) -> Tuple[pd.DataFrame | None, Set[pd.Timestamp]]:
+    """
+    بكسلات S2 للأسابيع المطلوبة: الأسابيع المقفلة تنقرأ من s2_cache (ما تتغير أبداً)،
+    والباقي ينجلب من GEE ثم تنخزن المقفلة منها. يرجّع (df, الأسابيع اللي فشل جلبها).
+    available (من build_fetch_plan): الأسابيع اللي فيها مشهد — غيرها ما ينطلب أصلاً ويعتبر فاضي.
+    """
+    frames, to_fetch, keys = _s2_cache_split(site, weeks, available, today)
+
+    failed: Set[pd.Timestamp] = set()
+    new_df = None
+    if to_fetch:
+        if S2_FETCH_MODE == "weekly":
+            results = ee_executor.run_parallel([
+                (s2_week_pixels_gee, (site, ws, we, available is None)) for ws, we in to_fetch
+            ])
+            fetched = []
+            for (ws, _), df in zip(to_fetch, results):
+                if df is S2_WEEK_FAILED:
+                    failed.add(pd.to_datetime(ws).normalize())
+                elif df is not None and not df.empty:
+                    fetched.append(df)
+            new_df = pd.concat(fetched, ignore_index=True) if fetched else None
+        else:
+            new_df, failed = _s2_series_fetch(site, to_fetch)
+
+    return _s2_cache_store(site, weeks, frames, to_fetch, keys, new_df, failed)
+
+
+def _s2_cache_split(
+    site: Dict[str, Any],
+    weeks: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    available: Set[pd.Timestamp] | None,
+    today: pd.Timestamp | None,
+) -> Tuple[List[pd.DataFrame], List[Tuple[pd.Timestamp, pd.Timestamp]], Dict[pd.Timestamp, str]]:
+    """
+    النص الأول من s2_weeks_cached: (الأسابيع الموجودة في الكاش, الأسابيع اللي لازم تنجلب, مفاتيح المقفلة منها).
+    """
+    site_name = site["name"]
+    today = analysis_window(today)["today"]
+    stride = pixel_sampling(site)["stride"]
+    frames: List[pd.DataFrame] = []
+    to_fetch: List[Tuple[pd.Timestamp, pd.Timestamp]] = []
+    keys: Dict[pd.Timestamp, str] = {}
+
+    for wstart, wend in weeks:
+        ws = pd.to_datetime(wstart).normalize()
+        if week_is_final(wend, today):
+            key = s2_cache.cache_key(site["polygon"], ws, MAX_CLOUD, RESOLUTION, S2_COLLECTION, stride)
+            found, cached = s2_cache.get(key)
+            if found:
+                if cached is not None:
+                    frames.append(cached.assign(site=site_name, date=ws))
+                continue
+            keys[ws] = key
+        if available is not None and ws not in available:
+            continue
+        to_fetch.append((wstart, wend))
+
+    return frames, to_fetch, keys
+
+
+def _s2_cache_store(
+    site: Dict[str, Any],
+    weeks: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    frames: List[pd.DataFrame],
+    to_fetch: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    keys: Dict[pd.Timestamp, str],
+    new_df: pd.DataFrame | None,
+    failed: Set[pd.Timestamp],
+) -> Tuple[pd.DataFrame | None, Set[pd.Timestamp]]:
+    """
+    النص الثاني: يخزن الأسابيع المقفلة اللي انجلبت (حتى الفاضية) ويجمع الكاش + الجديد.
+    """
+    site_name = site["name"]
+    if new_df is not None and not new_df.empty:
+        frames = frames + [new_df]
+
+    for ws, key in keys.items():
+        if ws in failed:
+            continue
+        part = new_df[new_df["date"] == ws] if new_df is not None else None
+        s2_cache.put(key, part.drop(columns=["site", "date"]) if part is not None and not part.empty else None)
+
+    print(f"[S2CACHE] site={site_name} weeks={len(weeks)} fetched={len(to_fetch)} failed={len(failed)} stats={s2_cache.stats()}")
+
+    if not frames:
+        return None, failed
+    # أسطر الكاش المكتوبة قبل pixel_id تاخذ رقمها هنا
+    return pixel_cube.add_pixel_id(pd.concat(frames, ignore_index=True)), failed
+
+
+
+def slope_s_np(x, w=8):
+    res = np.full_like(x, np.nan, dtype=float)
+    t = np.arange(w)
+    for i in range(w - 1, len(x)):
+        y_window = x[i - w + 1 : i + 1]
+        ok = np.isfinite(y_window)
+        if ok.sum() >= max(4, w // 2):
+            y_temp = y_window.copy()
+            m = np.nanmean(y_temp[ok])
+            y_temp[~ok] = m
+            cov = np.cov(t, y_temp, ddof=0)[0, 1]
+            var_t = np.var(t)
+            res[i] = cov / (var_t + 1e-6)
+    return res
+
+
+CORE_INDICES = ["NDVI", "NDRE", "NDMI", "SIWSI1"]
+
+
+@profiling.staged("add_features")
+def add_features(df: pd.DataFrame, series: Dict[str, Any] | None = None) -> pd.DataFrame:
+    """
+    نفس ميزات _add_features_frame بس محسوبة على مكعب (pixel, week, band) float32
+    بعمليات NumPy على محور الزمن، والـ DataFrame ينبني مرة وحدة بالنهاية.
+    series: فهرس pixel_cube.series_index لنفس أسطر df (بنفس الترتيب) — لو ما انعطى ننرتب ونحسبه هنا.
+    """
     if df.empty:
         return df
 
-    df = df.sort_values(["site", "x", "y", "date"]).copy()
+    if series is None:
+        df = pixel_cube.add_pixel_id(df).sort_values(["pixel_id", "date"]).reset_index(drop=True)
+        series = pixel_cube.series_index(df)
+    bands = [c for c in INDEX_COLS_ALL if c in df.columns]
+    cube = pixel_cube.build_cube(df, bands, series) if series is not None else None
+    if cube is None:
+        print("[FEATURES] duplicate (pixel, week) rows → falling back to DataFrame features")
+        return _add_features_frame(df)
+
+    df["weekofyear"] = df["date"].dt.isocalendar().week.astype(int)
+    df["month"] = df["date"].dt.month
+
+    core = [c for c in CORE_INDICES if c in bands]
+    vals = {c: pixel_cube.band(cube, c) for c in bands}
+    feats: Dict[str, np.ndarray] = {}
+
+    for col in core:
+        feats[f"{col}_season_mean"] = pixel_cube.month_mean(cube, vals[col])
+
+    for col in core:
+        feats[f"{col}_std8"] = pixel_cube.rolling_std(cube, vals[col], 8, 4)
+
+    for col in core:
+        value = vals[col]
+        base = feats[f"{col}_season_mean"]
+        base_safe = np.where(np.isfinite(base), base, value)
+        std = feats[f"{col}_std8"]
+        std_safe = np.where(np.isfinite(std) & (std > 1e-6), std, np.nan)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            k = (value - base_safe) / std_safe
+
+        no_ref = ~np.isfinite(std_safe) | ~np.isfinite(base_safe)
+        k[no_ref & np.isfinite(value)] = 0.0
+        k[~np.isfinite(value)] = np.nan
+
+        feats[f"k_{col}"] = k
+
+    for col in ["NDVI", "NDMI"]:
+        if col in bands:
+            feats[f"slope8_{col}"] = pixel_cube.rolling_slope(cube, vals[col], 8, 4)
+
+    for col in core:
+        feats[f"{col}_base"] = pixel_cube.pixel_quantile(cube, vals[col], 0.8, 4)
+
+    for col in ["NDVI", "NDMI", "SIWSI1"]:
+        if f"{col}_base" in feats:
+            b = feats[f"{col}_base"]
+            feats[f"{col}_drop_frac"] = (b - vals[col]) / (b + 1e-9)
+
+    for col in ["NDVI", "NDMI"]:
+        if f"{col}_drop_frac" in feats:
+            feats[f"{col}_drop_3w"] = pixel_cube.rolling_mean(cube, feats[f"{col}_drop_frac"], 3, 2)
+
+    has_index = np.isfinite(cube["values"]).any(axis=2)
+    feats["history_weeks"] = pixel_cube.pixel_count(cube, has_index)
+
+    for name, arr in feats.items():
+        col = pixel_cube.to_rows(cube, arr)
+        df[name] = col.astype(np.float32) if col.dtype.kind == "f" else col
+    for name in ["NDVI_drop_3w", "NDMI_drop_3w"]:
+        if name not in df.columns:
+            df[name] = np.nan
+
+    return df
+
+
+def _add_features_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    نسخة groupby على الجدول الطويل — تنستخدم بس لو الجدول ما ينحط في مكعب.
+    """
+    if df.empty:
+        return df
+
+    df = pixel_cube.add_pixel_id(df.copy()).sort_values(["pixel_id", "date"])
     df["weekofyear"] = df["date"].dt.isocalendar().week.astype(int)
     df["month"] = df["date"].dt.month
 
     core_indices = ["NDVI", "NDRE", "NDMI", "SIWSI1"]
 
-    g_pixel_month = df.groupby(["site", "x", "y", "month"])
+    g_pixel_month = df.groupby(["pixel_id", "month"])
     for col in core_indices:
         if col in df.columns:
             df[f"{col}_season_mean"] = g_pixel_month[col].transform("mean")
 
-    g_pixel = df.groupby(["site", "x", "y"])
+    g_pixel = df.groupby("pixel_id")
 
     def _roll_std(s, w=8):
         return s.rolling(w, min_periods=4).std()
@@ -555,21 +1468,6 @@ def add_features(df: pd.DataFrame) -> pd.DataFrame:
 
             df[f"k_{col}"] = k
 
-    def slope_s_np(x, w=8):
-        res = np.full_like(x, np.nan, dtype=float)
-        t = np.arange(w)
-        for i in range(w - 1, len(x)):
-            y_window = x[i - w + 1 : i + 1]
-            ok = np.isfinite(y_window)
-            if ok.sum() >= max(4, w // 2):
-                y_temp = y_window.copy()
-                m = np.nanmean(y_temp[ok])
-                y_temp[~ok] = m
-                cov = np.cov(t, y_temp, ddof=0)[0, 1]
-                var_t = np.var(t)
-                res[i] = cov / (var_t + 1e-6)
-        return res
-
     for col in ["NDVI", "NDMI"]:
         if col in df.columns:
             df[f"slope8_{col}"] = g_pixel[col].transform(
@@ -609,13 +1507,13 @@ def add_features(df: pd.DataFrame) -> pd.DataFrame:
 
     cnt_weeks = (
         df[INDEX_COLS_ALL].notna().any(axis=1)
-    ).groupby([df["site"], df["x"], df["y"]]).sum()
-    history_df = cnt_weeks.rename("history_weeks").reset_index()
-    df = df.merge(history_df, on=["site", "x", "y"], how="left")
+    ).groupby(df["pixel_id"]).sum()
+    df["history_weeks"] = df["pixel_id"].map(cnt_weeks)
 
     return df
 
 
+@profiling.staged("if_scoring")
 def compute_if_risk_inference(all_df: pd.DataFrame) -> pd.DataFrame:
    
     feats = [
@@ -656,16 +1554,8 @@ def compute_if_risk_inference(all_df: pd.DataFrame) -> pd.DataFrame:
 
     col_means = pd.Series(means_dict)
     X = X[valid_cols]
-    X_filled = X.fillna(col_means)
 
-    print("\n====== DEBUG IF INPUT ======")
-    print("Valid feature columns:", valid_cols)
-    print("Shape before fill:", X.shape)
-    print("Sample before fill:\n", X.head(5))
-    print("\nMeans used for fill:\n", col_means)
-    print("\nSample AFTER fill:\n", X_filled.head(5))
-    print("Describe AFTER fill:\n", X_filled.describe())
-    print("====== END DEBUG ======\n")
+    print(f"[IF] rows={len(X)} features={valid_cols} filled_from_training={sorted(set(valid_cols) & set(training_means))}")
 
     try:
         IF_model = get_if_model()
@@ -677,7 +1567,7 @@ def compute_if_risk_inference(all_df: pd.DataFrame) -> pd.DataFrame:
         ) from e
 
 
-    for site, sdf in all_df.groupby("site"):
+    for site, sdf in all_df.groupby("site", observed=True):
         X_site = sdf[valid_cols].replace([np.inf, -np.inf], np.nan).fillna(col_means)
         try:
             scores = IF_model.decision_function(X_site.values)
@@ -691,6 +1581,7 @@ def compute_if_risk_inference(all_df: pd.DataFrame) -> pd.DataFrame:
 
 
 
+@profiling.staged("rpw_scoring")
 def add_rpw_flags_and_score(
     df: pd.DataFrame,
     ndre_low_q: float = 0.25,
@@ -698,8 +1589,12 @@ def add_rpw_flags_and_score(
     rpw_monitor_q: float = 0.80,
     rpw_critical_q: float = 0.95,
     if_risk_q: float = 0.90,
+    series: Dict[str, Any] | None = None,
 ) -> pd.DataFrame:
-  
+    """
+    series: فهرس pixel_cube.series_index لنفس أسطر df (من _health_from_series) — الـ rolling median
+    ينحسب عليه بدون groupby. لو ما انعطى ننرتب ونحسبه هنا.
+    """
     if df.empty:
         df = df.copy()
         df["RPW_score"] = np.nan
@@ -707,7 +1602,11 @@ def add_rpw_flags_and_score(
         df["RPW_label_rule"] = "Healthy"
         return df
 
-    df = df.sort_values(["site", "x", "y", "date"]).copy()
+    if series is None:
+        df = df.sort_values(["pixel_id", "date"]).copy()
+        series = pixel_cube.series_index(df)
+    else:
+        df = df.copy()
 
     if "NDRE" in df.columns:
         ndre_thr = df["NDRE"].quantile(ndre_low_q)
@@ -736,14 +1635,18 @@ def add_rpw_flags_and_score(
     else:
         df["flag_NDWI_below_025"] = False
 
-    def rolling_median(s):
-        return s.rolling(8, min_periods=4).median()
+    def rolling_median(col):
+        if col not in df.columns:
+            return pd.Series(np.nan, index=df.index)
+        if series is None:
+            # أسطر مكررة لنفس (بكسل، أسبوع) — نرجع لـ groupby
+            return df.groupby("pixel_id")[col].transform(lambda s: s.rolling(8, min_periods=4).median())
+        med = pixel_cube.rolling_median(series, pixel_cube.from_rows(series, df[col]), 8, 4)
+        return pd.Series(pixel_cube.to_rows(series, med), index=df.index)
 
-    g = df.groupby(["site", "x", "y"])
-
-    base_SI = g["SIWSI1"].transform(rolling_median) if "SIWSI1" in df.columns else pd.Series(np.nan, index=df.index)
-    base_WI = g["NDWI_Gao"].transform(rolling_median) if "NDWI_Gao" in df.columns else pd.Series(np.nan, index=df.index)
-    base_NV = g["NDVI"].transform(rolling_median) if "NDVI" in df.columns else pd.Series(np.nan, index=df.index)
+    base_SI = rolling_median("SIWSI1")
+    base_WI = rolling_median("NDWI_Gao")
+    base_NV = rolling_median("NDVI")
 
     if "SIWSI1" in df.columns:
         df["flag_drop_SIWSI10pct"] = ((base_SI - df["SIWSI1"]) / (base_SI + 1e-9)) >= 0.10
@@ -973,9 +1876,9 @@ def indices_history_last_weeks(
         return []
 
     if agg == "median":
-        g = df.groupby(["site", "date"], as_index=False)[cols].median()
+        g = df.groupby(["site", "date"], as_index=False, observed=True)[cols].median()
     else:
-        g = df.groupby(["site", "date"], as_index=False)[cols].mean()
+        g = df.groupby(["site", "date"], as_index=False, observed=True)[cols].mean()
 
     g = g.sort_values("date").tail(weeks)
 
@@ -1044,25 +1947,19 @@ FORECAST_FEATURES = [
 
 
 #healthmap predection points (توقعات حالة البكسلات للأسبوع القادم) - نفس تنسيق نقاط الخريطة العادية لكن مع حالة التوقع وليس الحالة الحالية
-def get_forecast_lookup(latest_last: pd.DataFrame) -> Dict[str, int]:
+def get_forecast_lookup(latest_last: pd.DataFrame) -> Dict[int, int]:
     if latest_last is None or latest_last.empty:
         return {}
 
-    lookup = {}
-    for _, row in latest_last.iterrows():
-        code = row.get('pred_class_code_next', 0)
-        status_code = 0
-        if code >= 1.5: status_code = 2
-        elif code >= 0.5: status_code = 1
-            
-        # المفتاح lat_lng
-        key = f"{round(float(row['y']), 6)}_{round(float(row['x']), 6)}"
-        lookup[key] = status_code
-    return lookup
+    code = latest_last["pred_class_code_next"].fillna(0).to_numpy()
+    status_code = np.where(code >= 1.5, 2, np.where(code >= 0.5, 1, 0))
+    # المفتاح pixel_id
+    return dict(zip(latest_last["pixel_id"].to_numpy(dtype=np.int64).tolist(), status_code.tolist()))
 
 
     
 
+@profiling.staged("forecast")
 def forecast_next_week_summary(df_all: pd.DataFrame) -> Dict[str, Any]:
     if df_all.empty:
         return {
@@ -1076,8 +1973,8 @@ def forecast_next_week_summary(df_all: pd.DataFrame) -> Dict[str, Any]:
     model = get_forecast_model()
 
     latest_last = (
-        df_all.sort_values(["site", "x", "y", "date"])
-             .groupby(["site", "x", "y"], as_index=False)
+        df_all.sort_values(["pixel_id", "date"])
+             .groupby("pixel_id", as_index=False)
              .tail(1)
              .copy()
     )
@@ -1108,13 +2005,13 @@ def forecast_next_week_summary(df_all: pd.DataFrame) -> Dict[str, Any]:
     latest_last["pred_class_next"] = latest_last["pred_class_code_next"].apply(decode_class_code)
 
     # ✅ FIX: avoid "cannot insert site, already exists"
-    counts = latest_last.groupby(["site", "pred_class_next"]).size()
-    pct = (counts / counts.groupby(level=0).transform("sum")) * 100.0
+    counts = latest_last.groupby(["site", "pred_class_next"], observed=True).size()
+    pct = (counts / counts.groupby(level=0, observed=True).transform("sum")) * 100.0
 
     farm_pivot = (
         pct.rename("pct")
            .reset_index()
-           .pivot_table(index="site", columns="pred_class_next", values="pct", fill_value=0.0)
+           .pivot_table(index="site", columns="pred_class_next", values="pct", fill_value=0.0, observed=True)
            .reset_index()
            .rename(columns={
                "Healthy": "Healthy_Pct_next",
@@ -1125,7 +2022,7 @@ def forecast_next_week_summary(df_all: pd.DataFrame) -> Dict[str, Any]:
 
 
 
-    delta_agg = latest_last.groupby("site").agg(
+    delta_agg = latest_last.groupby("site", observed=True).agg(
         ndvi_delta_next_mean=("pred_ndvi_delta_next", "mean"),
         ndmi_delta_next_mean=("pred_ndmi_delta_next", "mean"),
     ).reset_index()
@@ -1155,42 +2052,404 @@ def forecast_next_week_summary(df_all: pd.DataFrame) -> Dict[str, Any]:
 }
 
 
+S2_PIXEL_COLUMNS = ["site", "date", "x", "y", "pixel_id"] + INDEX_COLS_ALL
+
+
+def fetch_weeks_gee(
+    site: Dict[str, Any],
+    weeks: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    today: pd.Timestamp | None = None,
+    scenes: Dict[str, pd.DataFrame] | None = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame, Set[pd.Timestamp]]:
+    """
+    يجلب بكسلات Sentinel-2 + LST للأسابيع المطلوبة فقط (S2 المقفل من s2_cache والباقي من GEE).
+    يرجّع (df_s2, df_th, failed) — df_th فيه سطر لكل أسبوع (site, date, canopy_temp)،
+    وfailed = بدايات الأسابيع اللي فشل جلبها (لا تنخزن كأسابيع فاضية).
+    scenes: نتيجة probe جاهزة (تغطي هذي الأسابيع) — لو موجودة ما نعيد الطلب.
+    """
+    if not weeks:
+        return _empty_fetch()
+
+    plan, available = _fetch_plan(site, weeks, scenes)
+    lst_weeks = plan["landsat"]
+
+    # LST يشتغل بالتوازي مع جلب S2 (نفس الـ executor المحدود)
+    if LST_FETCH_MODE == "weekly":
+        lst_futures = [
+            ee_executor.submit(
+                load_week_LST_Landsat_GEE, site,
+                wstart - pd.Timedelta(days=6), wend + pd.Timedelta(days=6),
+            )
+            for wstart, wend in lst_weeks
+        ]
+    else:
+        lst_futures = [ee_executor.submit(_lst_series_fetch, site, lst_weeks)]
+
+    df_s2, failed = s2_weeks_cached(site, weeks, available=available, today=today)
+
+    if LST_FETCH_MODE == "weekly":
+        lst_planned = []
+        for (wstart, _), f in zip(lst_weeks, lst_futures):
+            try:
+                lst_planned.append(ee_executor.result(f))
+            except TimeoutError:
+                print(f"[LST] timeout site={site['name']} week={pd.to_datetime(wstart).date()}")
+                lst_planned.append(np.nan)
+                failed = failed | {pd.to_datetime(wstart).normalize()}
+    else:
+        try:
+            lst_planned, lst_ok = ee_executor.result(lst_futures[0])
+        except TimeoutError:
+            print(f"[LST] timeout site={site['name']} weeks={len(lst_weeks)}")
+            lst_planned, lst_ok = [np.nan] * len(lst_weeks), False
+        if not lst_ok:
+            failed = failed | {pd.to_datetime(w[0]).normalize() for w in lst_weeks}
+
+    if df_s2 is None or df_s2.empty:
+        df_s2 = pd.DataFrame(columns=S2_PIXEL_COLUMNS)
+
+    return df_s2, _thermal_frame(site, weeks, lst_weeks, lst_planned), failed
+
+
+def _empty_fetch() -> Tuple[pd.DataFrame, pd.DataFrame, Set[pd.Timestamp]]:
+    return (
+        pd.DataFrame(columns=S2_PIXEL_COLUMNS),
+        pd.DataFrame(columns=["site", "date", "canopy_temp"]),
+        set(),
+    )
+
+
+def _fetch_plan(
+    site: Dict[str, Any],
+    weeks: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    scenes: Dict[str, pd.DataFrame] | None,
+) -> Tuple[Dict[str, List[Tuple[pd.Timestamp, pd.Timestamp]]], Set[pd.Timestamp] | None]:
+    """
+    خطة الجلب لمزرعة وحدة: (plan, available) — available = بدايات أسابيع S2 اللي فيها مشهد
+    (None لو الـ probe فشل، وقتها نطلب كل الأسابيع).
+    """
+    # طلب واحد يحدد الأسابيع اللي فيها مشاهد فعلاً — الباقي ما ننطلب عليه أي شيء
+    if scenes is None:
+        scenes = probe_scene_availability(
+            site,
+            weeks[0][0] - pd.Timedelta(days=6),
+            weeks[-1][1] + pd.Timedelta(days=6),
+        )
+    plan = build_fetch_plan(weeks, scenes)
+    print(f"[PLAN] site={site['name']} weeks={len(weeks)} s2={len(plan['s2'])} landsat={len(plan['landsat'])} "
+          f"sampling={pixel_sampling(site)}")
+    available = None if scenes is None else {pd.to_datetime(w[0]).normalize() for w in plan["s2"]}
+    return plan, available
+
+
+def _thermal_frame(
+    site: Dict[str, Any],
+    weeks: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    lst_weeks: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    lst_planned: List[float],
+) -> pd.DataFrame:
+    """سطر لكل أسبوع (site, date, canopy_temp) — الأسبوع اللي ما انطلب له Landsat قيمته NaN."""
+    lst_by_week = {pd.to_datetime(w[0]).normalize(): v for w, v in zip(lst_weeks, lst_planned)}
+    thermal_rows = [
+        {
+            "site": site["name"],
+            "date": pd.to_datetime(wstart).normalize(),
+            "canopy_temp": lst_by_week.get(pd.to_datetime(wstart).normalize(), np.nan),
+        }
+        for wstart, _ in weeks
+    ]
+    df_th = pd.DataFrame(thermal_rows, columns=["site", "date", "canopy_temp"])
+    df_th["date"] = pd.to_datetime(df_th["date"]).dt.normalize()
+    return df_th
+
+
+def fetch_farms_weeks_gee(
+    jobs: List[Tuple[Dict[str, Any], List[Tuple[pd.Timestamp, pd.Timestamp]], Dict[str, pd.DataFrame] | None]],
+    today: pd.Timestamp | None = None,
+) -> Dict[str, Tuple[pd.DataFrame, pd.DataFrame, Set[pd.Timestamp]]]:
+    """
+    fetch_weeks_gee لعدة مزارع: jobs = [(site, weeks, scenes), ...].
+    الخطة والكاش لكل مزرعة لحالها، لكن الجلب من GEE مشترك (s2_farms_series_fetch / lst_farms_series_fetch)
+    عشان زمن الطلب يتوزع على كل المزارع. يرجّع {اسم المزرعة: (df_s2, df_th, failed)}.
+    """
+    out: Dict[str, Tuple[pd.DataFrame, pd.DataFrame, Set[pd.Timestamp]]] = {}
+    state: List[Tuple[Dict[str, Any], List[Tuple[pd.Timestamp, pd.Timestamp]], Any, Any]] = []
+    for site, weeks, scenes in jobs:
+        if not weeks:
+            out[site["name"]] = _empty_fetch()
+            continue
+        plan, available = _fetch_plan(site, weeks, scenes)
+        state.append((site, weeks, plan, _s2_cache_split(site, weeks, available, today)))
+
+    if not state:
+        return out
+
+    lst_future = ee_executor.submit(
+        lst_farms_series_fetch, [(site, plan["landsat"]) for site, _, plan, _ in state]
+    )
+    s2_new = s2_farms_series_fetch([(site, split[1]) for site, _, _, split in state])
+    try:
+        lst_new = ee_executor.result(lst_future)
+    except TimeoutError:
+        print(f"[LST] timeout farms={len(state)}")
+        lst_new = {site["name"]: ([np.nan] * len(plan["landsat"]), False) for site, _, plan, _ in state}
+
+    for site, weeks, plan, (frames, to_fetch, keys) in state:
+        name = site["name"]
+        new_df, failed = s2_new.get(name, (None, set()))
+        df_s2, failed = _s2_cache_store(site, weeks, frames, to_fetch, keys, new_df, failed)
+
+        lst_planned, lst_ok = lst_new[name]
+        if not lst_ok:
+            failed = failed | {pd.to_datetime(w[0]).normalize() for w in plan["landsat"]}
+
+        if df_s2 is None or df_s2.empty:
+            df_s2 = pd.DataFrame(columns=S2_PIXEL_COLUMNS)
+        out[name] = (df_s2, _thermal_frame(site, weeks, plan["landsat"], lst_planned), failed)
+
+    return out
+
+
+def load_farm_series(
+    site: Dict[str, Any],
+    weeks: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    today: pd.Timestamp | None = None,
+    scenes: Dict[str, pd.DataFrame] | None = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    نفس fetch_weeks_gee لكن تراكمي: الأسابيع المقفلة تنقرأ من pixel_history،
+    ونجلب من GEE فقط الأسابيع الناقصة/المفتوحة، ثم نحدّث السجل (ونحذف اللي طلع من النافذة).
+    """
+    window = analysis_window(today)
+    hist_px, hist_wk, missing = _history_split(site, weeks, window)
+
+    new_s2, new_th, failed = fetch_weeks_gee(site, missing, today=window["today"], scenes=scenes) if missing else _empty_fetch()
+
+    return _history_merge(site, window, hist_px, hist_wk, missing, new_s2, new_th, failed)
+
+
+def _history_split(
+    site: Dict[str, Any],
+    weeks: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    window: Dict[str, pd.Timestamp],
+) -> Tuple[pd.DataFrame, pd.DataFrame, List[Tuple[pd.Timestamp, pd.Timestamp]]]:
+    """(بكسلات السجل, أسابيع السجل, الأسابيع الناقصة) داخل النافذة."""
+    farm_id = site["name"]
+    window_start = pd.to_datetime(weeks[0][0]).normalize() if weeks else window["date_from"]
+
+    hist_px, hist_wk = pixel_history.load_history(farm_id, site["polygon"], pixel_sampling(site)["stride"])
+    hist_wk = hist_wk[hist_wk["date"] >= window_start]
+    if not hist_px.empty:
+        hist_px = hist_px[hist_px["date"] >= window_start]
+
+    stored = set(hist_wk["date"])
+    missing = [w for w in weeks if pd.to_datetime(w[0]).normalize() not in stored]
+    print(f"[HISTORY] farm={farm_id} weeks={len(weeks)} stored={len(stored)} to_fetch={len(missing)}")
+    return hist_px, hist_wk, missing
+
+
+def _history_merge(
+    site: Dict[str, Any],
+    window: Dict[str, pd.Timestamp],
+    hist_px: pd.DataFrame,
+    hist_wk: pd.DataFrame,
+    missing: List[Tuple[pd.Timestamp, pd.Timestamp]],
+    new_s2: pd.DataFrame,
+    new_th: pd.DataFrame,
+    failed: Set[pd.Timestamp],
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """يدمج السجل مع الجديد ويحفظ الأسابيع المقفلة اللي انجلبت بنجاح."""
+    farm_id = site["name"]
+    px_parts = [f for f in (hist_px, new_s2) if not f.empty]
+    df_s2 = apply_dtype_plan(pixel_cube.add_pixel_id(pd.concat(px_parts, ignore_index=True))) if px_parts else pd.DataFrame(columns=S2_PIXEL_COLUMNS)
+
+    hist_th = hist_wk[["date", "canopy_temp"]].assign(site=farm_id)
+    th_parts = [f for f in (hist_th, new_th) if not f.empty]
+    df_th = (pd.concat(th_parts, ignore_index=True) if th_parts else new_th)[["site", "date", "canopy_temp"]]
+    df_th["date"] = pd.to_datetime(df_th["date"]).dt.normalize()
+
+    # نخزن فقط الأسابيع المقفلة اللي انجلبت بنجاح — المفتوحة/الفاشلة تنجلب من جديد المرة الجاية
+    final_dates = {
+        pd.to_datetime(wstart).normalize()
+        for wstart, wend in missing
+        if week_is_final(wend, window["today"])
+    } - failed
+    if final_dates:
+        new_final_px = new_s2[new_s2["date"].isin(final_dates)] if not new_s2.empty else new_s2
+        rows_per_week = new_final_px.groupby("date").size() if not new_final_px.empty else pd.Series(dtype=int)
+        new_wk = new_th[new_th["date"].isin(final_dates)][["date", "canopy_temp"]].copy()
+        new_wk["s2_rows"] = new_wk["date"].map(rows_per_week).fillna(0).astype(int)
+
+        px_parts = [f for f in (hist_px, new_final_px) if not f.empty]
+        wk_parts = [f for f in (hist_wk, new_wk) if not f.empty]
+        pixel_history.save_history(
+            farm_id,
+            site["polygon"],
+            pd.concat(px_parts, ignore_index=True) if px_parts else pd.DataFrame(columns=S2_PIXEL_COLUMNS),
+            pd.concat(wk_parts, ignore_index=True).sort_values("date"),
+            stride=pixel_sampling(site)["stride"],
+        )
+
+    return df_s2, df_th
+
+
 
 def analyze_farm_health(farm_id: str, farm_doc: Dict[str, Any]) -> Dict[str, Any]:
     # 1. التحقق من المضلع (Polygon)
+    site = _farm_site(farm_id, farm_doc)
+
+    # 2. جلب بيانات Sentinel-2 و Landsat LST (من السجل المخزن + الأسابيع الجديدة فقط من GEE)
+    #    والطقس (Open-Meteo) يشتغل بالتوازي معها
+    window = analysis_window()
+    wx_future = ee_executor.submit(weekly_weather, site, window)
+
+    weeks = week_bins(window["date_from"], window["date_to"])
+    # probe واحد للنافذة كاملة: يحدد خطة الجلب ويعطينا بصمة الصور (imagery_stamp) لفحص الجدولة
+    scenes = _window_scenes(site, window)
+    df_s2, df_th = load_farm_series(site, weeks, today=window["today"], scenes=scenes)
+
+    return _health_from_series(site, df_s2, df_th, weather_result(wx_future, window), window, scenes)
+
+
+def _farm_site(farm_id: str, farm_doc: Dict[str, Any]) -> Dict[str, Any]:
     poly = farm_doc.get("polygon") or []
     if len(poly) < 3:
         raise ValueError("Farm polygon is missing or < 3 points")
+    return {"name": farm_id, "polygon": [(p["lng"], p["lat"]) for p in poly]}
 
-    coords = [(p["lng"], p["lat"]) for p in poly]
-    site = {"name": farm_id, "polygon": coords}
 
-    # 2. جلب بيانات Sentinel-2 و Landsat LST من GEE
-    weekly_series: List[pd.DataFrame] = []
-    thermal_rows: List[Dict[str, Any]] = []
+def analyze_farms_health(farms: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """
+    نفس analyze_farm_health لدفعة مزارع (الجدولة): بكسلات S2 و LST تنجلب بطلبات GEE مشتركة
+    (fetch_farms_weeks_gee) بدل طلبات لكل مزرعة، والباقي (features/IF/RPW/...) لكل مزرعة لحالها.
+    المزارع تمشي مجموعات بحجم S2_BATCH_FARMS (جلب → تحليل → تحرير) عشان الذاكرة ما تكبر مع حجم الدفعة.
+    يرجّع {farm_id: نتيجة analyze_farm_health} — والمزرعة اللي فشلت نتيجتها {"error": "..."}.
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    sites: List[Dict[str, Any]] = []
+    docs = dict(farms)
+    for farm_id, farm_doc in farms:
+        try:
+            sites.append(_farm_site(farm_id, farm_doc))
+        except Exception as e:
+            results[farm_id] = {"error": str(e)}
+
+    window = analysis_window()
+    step = max(1, S2_BATCH_FARMS)
+    for i in range(0, len(sites), step):
+        group = sites[i:i + step]
+        try:
+            results.update(_analyze_farms_group(group, window))
+        except Exception as e:
+            # فشل الجلب المشترك للمجموعة → كل مزرعة فيها لحالها بالطريقة العادية
+            print(f"[HEALTH] batch group farms={[s['name'] for s in group]} failed: {type(e).__name__}: {e} → per-farm")
+            for site in group:
+                farm_id = site["name"]
+                try:
+                    results[farm_id] = analyze_farm_health(farm_id, docs[farm_id])
+                except Exception as fe:
+                    print(f"[HEALTH] farm={farm_id} failed: {type(fe).__name__}: {fe}")
+                    results[farm_id] = {"error": str(fe)}
+
+    return results
+
+
+def _analyze_farms_group(
+    sites: List[Dict[str, Any]],
+    window: Dict[str, pd.Timestamp],
+) -> Dict[str, Dict[str, Any]]:
+    """مجموعة وحدة من analyze_farms_health: أي خطأ قبل التحليل لكل مزرعة يرتفع للمستدعي."""
+    results: Dict[str, Dict[str, Any]] = {}
+    weeks = week_bins(window["date_from"], window["date_to"])
+    wx_futures = {site["name"]: ee_executor.submit(weekly_weather, site, window) for site in sites}
+
+    # probe لكل مزرعة (طلب صغير) بالتوازي — يحدد الخطة وبصمة الصور
+    all_scenes = ee_executor.run_parallel([(_window_scenes, (site, window)) for site in sites])
+    scenes_by = {site["name"]: sc for site, sc in zip(sites, all_scenes)}
+
+    history = {site["name"]: _history_split(site, weeks, window) for site in sites}
+    fetched = fetch_farms_weeks_gee(
+        [(site, history[site["name"]][2], scenes_by[site["name"]]) for site in sites],
+        today=window["today"],
+    )
 
-    for wstart, wend in week_bins(DATE_FROM, DATE_TO):
-        s2 = s2_week_pixels_gee(site, wstart, wend)
-        if s2 is not None and not s2.empty:
-            weekly_series.append(s2)
+    for site in sites:
+        farm_id = site["name"]
+        try:
+            hist_px, hist_wk, missing = history.pop(farm_id)
+            new_s2, new_th, failed = fetched.pop(farm_id)
+            df_s2, df_th = _history_merge(site, window, hist_px, hist_wk, missing, new_s2, new_th, failed)
+            del hist_px, new_s2
+            wx = weather_result(wx_futures[farm_id], window)
+            results[farm_id] = _health_from_series(site, df_s2, df_th, wx, window, scenes_by[farm_id])
+        except Exception as e:
+            print(f"[HEALTH] batch farm={farm_id} failed: {type(e).__name__}: {e}")
+            results[farm_id] = {"error": str(e)}
 
-        d_from = (wstart - pd.Timedelta(days=6))
-        d_to   = (wend   + pd.Timedelta(days=6))
-        lst_c = load_week_LST_Landsat_GEE(site, d_from, d_to)
-        thermal_rows.append(
-            {"site": farm_id, "date": pd.to_datetime(wstart).normalize(), "canopy_temp": lst_c}
-        )
+    return results
 
-    # 3. تجميع البيانات في DataFrame واحد
-    if weekly_series:
-        df_s2 = pd.concat(weekly_series, ignore_index=True)
-    else:
-        df_s2 = pd.DataFrame(columns=["site", "date", "x", "y", "NDVI", "GNDVI", "NDRE", "NDRE740", "MTCI", "NDMI", "NDWI_Gao", "SIWSI1", "SIWSI2", "SRWI", "NMDI"])
 
-    df_th = pd.DataFrame(thermal_rows)
-    df_th["date"] = pd.to_datetime(df_th["date"]).dt.normalize()
+PixelState = Tuple[pd.DataFrame, Dict[str, Any] | None]
+
+
+def _stage_prepare(df_all: pd.DataFrame, series: Dict[str, Any] | None = None) -> PixelState:
+    """ترتيب وفهرس البكسلات مرة وحدة — add_features و RPW يشتغلون عليه بدل groupby."""
+    apply_dtype_plan(df_all, "merge")
+    df_all["date"] = pd.to_datetime(df_all["date"]).dt.normalize()
+    df_all = pixel_cube.add_pixel_id(df_all).sort_values(["pixel_id", "date"]).reset_index(drop=True)
+    return df_all, pixel_cube.series_index(df_all)
+
+
+def _stage_features(df_all: pd.DataFrame, series: Dict[str, Any] | None) -> PixelState:
+    return apply_dtype_plan(add_features(df_all, series), "features"), series
 
-    wx = weekly_weather(site)
+
+def _stage_history_filter(df_all: pd.DataFrame, series: Dict[str, Any] | None) -> PixelState:
+    """يشيل البكسلات اللي كل مؤشراتها ناقصة أو تاريخها أقل من 6 أسابيع — والفهرس يتقص معها."""
+    keep = df_all[[c for c in INDEX_COLS_ALL if c in df_all.columns]].notna().any(axis=1)
+    if "history_weeks" in df_all.columns:
+        keep &= df_all["history_weeks"] >= 6
+    keep = keep.to_numpy()
+    df_all = df_all[keep].reset_index(drop=True)
+    return df_all, pixel_cube.subset(series, keep) if series is not None else None
+
+
+def _stage_if(df_all: pd.DataFrame, series: Dict[str, Any] | None) -> PixelState:
+    return apply_dtype_plan(compute_if_risk_inference(df_all), "if"), series
+
+
+def _stage_rpw(df_all: pd.DataFrame, series: Dict[str, Any] | None) -> PixelState:
+    return apply_dtype_plan(add_rpw_flags_and_score(df_all, series=series), "rpw"), series
+
+
+# مراحل البكسلات بالترتيب (بعد دمج S2 + الطقس + LST) — _health_from_series و benchmarks/health_bench.py
+PIXEL_STAGES: List[Tuple[str, Callable[..., PixelState]]] = [
+    ("prepare", _stage_prepare),
+    ("add_features", _stage_features),
+    ("history_filter", _stage_history_filter),
+    ("compute_if_risk_inference", _stage_if),
+    ("add_rpw_flags_and_score", _stage_rpw),
+]
+
+
+def score_pixels(df_all: pd.DataFrame) -> pd.DataFrame:
+    """الجدول المدموج → features → فلترة التاريخ → IF → RPW (PIXEL_STAGES)."""
+    series = None
+    for _, fn in PIXEL_STAGES:
+        df_all, series = fn(df_all, series)
+    return df_all
+
+
+def _health_from_series(
+    site: Dict[str, Any],
+    df_s2: pd.DataFrame,
+    df_th: pd.DataFrame,
+    wx: pd.DataFrame,
+    window: Dict[str, pd.Timestamp],
+    scenes: Dict[str, pd.DataFrame] | None,
+) -> Dict[str, Any]:
+    """من جداول البكسلات/LST/الطقس للنتيجة النهائية (features → IF → RPW → الإحصائيات والخريطة)."""
+    farm_id = site["name"]
     wx["site"] = farm_id
 
     _wx_recent = wx.copy()
@@ -1198,7 +2457,7 @@ def analyze_farm_health(farm_id: str, farm_doc: Dict[str, Any]) -> Dict[str, Any
       _wx_recent["date"] = pd.to_datetime(_wx_recent["date"], utc=True, errors="coerce")
       _wx_recent["date"] = _wx_recent["date"].dt.tz_localize(None).dt.normalize()
 
-    cutoff = TODAY - pd.Timedelta(weeks=4)
+    cutoff = window["today"] - pd.Timedelta(weeks=4)
     _wx_recent = _wx_recent[_wx_recent["date"] >= cutoff]
     _rain_s = _wx_recent["precip_mm"].dropna() if "precip_mm" in _wx_recent.columns else pd.Series(dtype=float)
     _temp_s = _wx_recent["t2m_mean"].dropna()  if "t2m_mean"  in _wx_recent.columns else pd.Series(dtype=float)
@@ -1212,17 +2471,10 @@ def analyze_farm_health(farm_id: str, farm_doc: Dict[str, Any]) -> Dict[str, Any
 
     if df_all.empty:
         raise RuntimeError("لم يتمكن النظام من جلب أي بكسلات Sentinel-2 لهذه المزرعة")
+    sampling = sampled_fraction(site, df_s2)
 
     # 4. معالجة الميزات (Features) وحساب المخاطر
-    df_all["date"] = pd.to_datetime(df_all["date"]).dt.normalize()
-    df_all = add_features(df_all)
-    df_all = df_all.dropna(subset=INDEX_COLS_ALL, how="all").copy()
-
-    if "history_weeks" in df_all.columns:
-        df_all = df_all[df_all["history_weeks"] >= 6].reset_index(drop=True)
-
-    df_all = compute_if_risk_inference(df_all)
-    df_all = add_rpw_flags_and_score(df_all)
+    df_all = score_pixels(df_all)
     risk_diagnostics = build_alert_signals(df_all)
 
     #    # 5. حساب الإحصائيات الحالية (Stats)
@@ -1260,9 +2512,10 @@ def analyze_farm_health(farm_id: str, farm_doc: Dict[str, Any]) -> Dict[str, Any
         health_map_data = fallback_points
 
     # دمج الحالة المتوقعة (ps) داخل نقاط الخريطة الحالية
-    for pt in health_map_data:
-        key = f"{pt['lat']}_{pt['lng']}"
-        pt["predictedStatus"] = lookup.get(key, 0)
+    if health_map_data:
+        keys = pixel_cube.pixel_ids([pt["lng"] for pt in health_map_data], [pt["lat"] for pt in health_map_data])
+        for pt, key in zip(health_map_data, keys.tolist()):
+            pt["predictedStatus"] = lookup.get(key, 0)
     # 7. الإرجاع النهائي الموحد لـ Firestore
     return {
         "current_health": processed_health,
@@ -1271,9 +2524,12 @@ def analyze_farm_health(farm_id: str, farm_doc: Dict[str, Any]) -> Dict[str, Any
         "indices_history_last_month": history_last_month,
         "indices_table": indices_table,
         "risk_diagnostics": risk_diagnostics,
+        "imagery_stamp": imagery_stamp_from_scenes(site, scenes, window),
+        "pixel_sampling": sampling,
     }
 
 
+@profiling.staged("alert_signals")
 def build_alert_signals(df_all: pd.DataFrame) -> Dict[str, Any]:
     """
     ✅ ملخص إشارات للتنبيهات مبني 100% على أعمدة df_all الناتجة من كودكم:
@@ -1380,36 +2636,25 @@ def build_alert_signals(df_all: pd.DataFrame) -> Dict[str, Any]:
 
 
 # --- دالة استخراج النقاط (المصححة لمسميات GEE) ---
+@profiling.staged("map_points")
 def get_health_map_points(df_all: pd.DataFrame) -> List[Dict[str, Any]]:
     if df_all is None or df_all.empty:
         return []
 
-    df = df_all.copy()
-    
-    # نحول المسميات من x/y إلى lng/lat فقط عند إرسالها للجوال
-    if 'x' in df.columns:
-        df = df.rename(columns={'x': 'lng', 'y': 'lat'})
-
-    try:
-        # التجميع بناءً على الإحداثيات (التي أصبحت الآن درجات حقيقية)
-        latest_pixels = df.sort_values('date').groupby(['lat', 'lng']).last().reset_index()
-    except KeyError:
+    if 'pixel_id' not in df_all.columns:
         return []
-    
-    map_points = []
-    for _, row in latest_pixels.iterrows():
-        status_code = 0 
-        risk_val = row.get('pixel_risk_class', 'Healthy')
-        
-        if risk_val == 'Critical': status_code = 2
-        elif risk_val == 'Monitor': status_code = 1
-            
-        map_points.append({
-            'lat': round(float(row['lat']), 6),
-            'lng': round(float(row['lng']), 6),
-            'currentStatus': status_code
-        })
-    return map_points 
+
+    # آخر أسبوع لكل بكسل؛ lat/lng من pixel_id (نفس الإحداثيات المقربة) عشان مفتاح التوقع يرجع منها بالضبط
+    latest_pixels = df_all.sort_values('date').groupby('pixel_id').last()
+
+    risk = latest_pixels['pixel_risk_class'] if 'pixel_risk_class' in latest_pixels.columns else pd.Series('Healthy', index=latest_pixels.index)
+    status = np.where(risk == 'Critical', 2, np.where(risk == 'Monitor', 1, 0))
+    lng, lat = pixel_cube.pixel_lonlat(latest_pixels.index.to_numpy())
+
+    return [
+        {'lat': round(float(la), 6), 'lng': round(float(ln), 6), 'currentStatus': int(st)}
+        for la, ln, st in zip(lat, lng, status)
+    ]
 
 def _build_top_action(health_result: Dict[str, Any]) -> Dict[str, Any]:
     dist    = health_result.get("current_health", {})
@@ -1708,42 +2953,8 @@ def get_report_weather_from_weatherapi(farm_doc: Dict[str, Any]) -> Dict[str, fl
         poly_for_centroid = [{"lat": lat, "lng": lon} for (lon, lat) in coords]
         lat, lon = polygon_centroid(poly_for_centroid)
 
-        end_dt = pd.Timestamp.utcnow().normalize()
-        start_dt = end_dt - pd.Timedelta(days=7)  # used to be 29 but the report says it's last 7 days
-
-        rows = []
-        current = start_dt
-
-        while current <= end_dt:
-            d = current.strftime("%Y-%m-%d")
-            url = "https://api.weatherapi.com/v1/history.json"
-            params = {
-                "key": WEATHERAPI_KEY,
-                "q": f"{lat},{lon}",
-                "dt": d,
-            }
-
-            r = session.get(url, params=params, timeout=30)
-            r.raise_for_status()
-            data = r.json()
-
-            day = ((data.get("forecast") or {}).get("forecastday") or [{}])[0].get("day", {})
-
-            rows.append({
-                "precip_mm": float(day.get("totalprecip_mm", 0) or 0),
-                "t2m_mean": float(day.get("avgtemp_c", 0) or 0),
-            })
-
-            current += pd.Timedelta(days=1)
-
-        if not rows:
-            return {"rain_mm": 0.0, "t_mean": 0.0}
-
-        df = pd.DataFrame(rows)
-        return {
-            "rain_mm": round(float(df["precip_mm"].sum()), 1),
-            "t_mean": round(float(df["t2m_mean"].mean()), 1),
-        }
+        # last 7 days + today (used to be 29 but the report says it's last 7 days)
+        return weather_store.weatherapi_summary(lat, lon, WEATHERAPI_KEY, n_days=7)
 
     except Exception as e:
         print(f"[REPORT WEATHER] WeatherAPI failed: {e}")
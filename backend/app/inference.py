@@ -1,22 +1,27 @@
 import os
 import io
+import sys
+import ast
+import glob
 import tempfile
 import math
-from typing import Dict, Any, Tuple, List
+import subprocess
+from typing import Dict, Any, Tuple, List, Optional
 
 import requests
 import time, hashlib, logging
 from PIL import Image, ImageOps
 from google.cloud import storage
-from ultralytics import YOLO
 
 import gc
-import torch
-from app.common import polygon_centroid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from app.common import polygon_centroid, point_in_polygon
 
 
-TILE_SIZE = 1024        
-OVERLAP = 0.20          
+TILE_SIZE = 1024        # نافذة الاستدلال (بكسل)
+OVERLAP = 0.20          # تداخل النوافذ في وضع tiled
 CONF_THRESHOLD = 0.30   
 NMS_IOU_THRESHOLD = 0.70  
 MAX_DETECTION_LIMIT = 5000  
@@ -24,11 +29,29 @@ MAX_DETECTION_LIMIT = 5000
 MAPTILER_KEY = os.environ.get("MAPTILER_KEY")
 TILE_URL = "https://api.maptiler.com/maps/satellite/{zoom}/{x}/{y}.jpg?key={key}"
 TILE_SIZE_MAP = 512     
+COUNT_ZOOM = 18
+
+# tiled: نغطي المضلع كله بنوافذ TILE_SIZE | centroid: صورة وحدة حول المركز (القديم)
+COUNT_MODE = os.environ.get("COUNT_MODE", "tiled").strip().lower()
+# سقف النوافذ لكل مزرعة (وقت) — 0 = بدون سقف (الافتراضي). لو انضبط وزادت النوافذ
+# العدّ يطلع جزئي: partial=True و coverage = نسبة النوافذ اللي انعدّت (ما ينعرض كعدد كامل)
+COUNT_MAX_TILES = int(os.environ.get("COUNT_MAX_TILES", "0"))
+# دمج التكرار على حدود النوافذ: التقاطع ÷ مساحة الصندوق الأصغر (النخلة المقصوصة بنافذة كاملة بالثانية)
+COUNT_MERGE_IOS = float(os.environ.get("COUNT_MERGE_IOS", "0.5"))
+# عدد النوافذ في كل model.predict (CPU) — 1 = نافذة نافذة
+YOLO_BATCH_SIZE = int(os.environ.get("YOLO_BATCH_SIZE", "4"))
+# A و B بالتوازي (كل واحد بنص خيوط torch) — 0 = واحد بعد الثاني مثل قبل. onnx/openvino دايماً بالتسلسل
+YOLO_PARALLEL_AB = os.environ.get("YOLO_PARALLEL_AB", "1") == "1"
 
 DEFAULT_BUCKET = os.environ.get("STORAGE_BUCKET", "saaf-97251.firebasestorage.app")
 MODELS_PREFIX = os.environ.get("REMOTE_MODELS_PREFIX", "models/")
 MODELS_GCS_URI_A = os.environ.get("MODELS_GCS_URI_A")
 MODELS_GCS_URI_B = os.environ.get("MODELS_GCS_URI_B")
+# torch (.pt) | onnx (onnxruntime) | openvino — نفس الـ .pt يتصدّر مرة ويتخزن جنبه في GCS.
+# torch و ultralytics ينستوردون بس مع torch؛ onnx/openvino يشتغلون بالـ runtime مباشرة (letterbox + NMS هنا)
+YOLO_BACKEND = os.environ.get("YOLO_BACKEND", "torch").strip().lower()
+if YOLO_BACKEND not in ("torch", "onnx", "openvino"):
+    raise ValueError(f"YOLO_BACKEND must be torch|onnx|openvino, got {YOLO_BACKEND!r}")
 
 
 
@@ -75,39 +98,183 @@ def _auto_pick_two_pt(bucket: str, prefix: str) -> Tuple[str, str]:
     return pts_sorted[0].name, pts_sorted[1].name
 
 
+def export_weights(pt_path: str, backend: Optional[str] = None) -> str:
+    """
+    .pt → ملف/مجلد الـ backend (onnx: model.onnx | openvino: model_openvino_model/) جنب الـ .pt.
+    لو التصدير موجود من قبل نرجعه بدون ما نعيد. torch يرجّع pt_path نفسه.
+    """
+    backend = backend or YOLO_BACKEND
+    if backend == "torch":
+        return pt_path
+    stem = os.path.splitext(pt_path)[0]
+    target = stem + (".onnx" if backend == "onnx" else "_openvino_model")
+    if os.path.exists(target):
+        return target
+    from ultralytics import YOLO
+
+    t0 = time.perf_counter()
+    # dynamic=True عشان predict_tiles يقدر يرسل دفعات بأحجام مختلفة
+    out = YOLO(pt_path).export(format=backend, dynamic=True, simplify=False, device="cpu", verbose=False)
+    print(f"✅ Exported {pt_path} -> {out} backend={backend} in {time.perf_counter() - t0:.1f}s")
+    return str(out)
+
+
+def _export_isolated(pt_path: str) -> str:
+    """
+    التصدير يحتاج torch + ultralytics: يشتغل في process لحاله عشان ما يبقون بذاكرة السيرفر
+    (onnx/openvino ما يستوردونهم أبداً). آخر سطر بالـ stdout = مسار التصدير.
+    """
+    code = "import sys; from app.inference import export_weights; print(export_weights(sys.argv[1]))"
+    proc = subprocess.run(
+        [sys.executable, "-c", code, pt_path],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env={**os.environ, "YOLO_BACKEND": YOLO_BACKEND},
+        capture_output=True,
+        text=True,
+    )
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        err = " | ".join((proc.stderr or proc.stdout).strip().splitlines()[-5:])
+        raise RuntimeError(f"export failed backend={YOLO_BACKEND} weights={pt_path}: {err}")
+    for line in lines[:-1]:
+        print(line)
+    return lines[-1].strip()
+
+
+def _backend_weights(bucket_name: str, blob_name: str, pt_path: str) -> str:
+    """
+    يجيب تصدير الـ backend من GCS (جنب الـ .pt) لو موجود، وإلا يصدّر محلياً ويرفعه للمرة الجاية.
+    أي فشل بالرفع ما يوقف التحميل.
+    """
+    if YOLO_BACKEND == "torch":
+        return pt_path
+    client = _gcs()
+    bucket = client.bucket(bucket_name)
+    remote_stem = os.path.splitext(blob_name)[0]
+    local_stem = os.path.splitext(pt_path)[0]
+
+    if YOLO_BACKEND == "onnx":
+        blob = bucket.blob(remote_stem + ".onnx")
+        local = local_stem + ".onnx"
+        if blob.exists():
+            blob.download_to_filename(local)
+            print(f"✅ Downloaded gs://{bucket_name}/{blob.name} -> {local}")
+            return local
+        local = _export_isolated(pt_path)
+        try:
+            blob.upload_from_filename(local)
+            print(f"✅ Uploaded {local} -> gs://{bucket_name}/{blob.name}")
+        except Exception as e:
+            print(f"⚠️ ONNX upload failed gs://{bucket_name}/{blob.name}: {e}")
+        return local
+
+    # openvino: مجلد (xml + bin + metadata.yaml)
+    prefix = remote_stem + "_openvino_model/"
+    local_dir = local_stem + "_openvino_model"
+    blobs = list(client.list_blobs(bucket_name, prefix=prefix))
+    if blobs:
+        os.makedirs(local_dir, exist_ok=True)
+        for b in blobs:
+            b.download_to_filename(os.path.join(local_dir, os.path.basename(b.name)))
+        print(f"✅ Downloaded gs://{bucket_name}/{prefix} ({len(blobs)} files) -> {local_dir}")
+        return local_dir
+    local_dir = _export_isolated(pt_path)
+    try:
+        for name in os.listdir(local_dir):
+            bucket.blob(prefix + name).upload_from_filename(os.path.join(local_dir, name))
+        print(f"✅ Uploaded {local_dir} -> gs://{bucket_name}/{prefix}")
+    except Exception as e:
+        print(f"⚠️ OpenVINO upload failed gs://{bucket_name}/{prefix}: {e}")
+    return local_dir
+
+
+def load_yolo(weights: str):
+    """
+    torch: YOLO من ultralytics (الاستيراد هنا بس).
+    onnx/openvino: _load_exported — session مباشرة بدون ultralytics/torch.
+    """
+    if YOLO_BACKEND != "torch":
+        return _load_exported(weights)
+    from ultralytics import YOLO
+
+    model = YOLO(weights, task="detect")
+    model.model.to("cpu").eval()
+    return model
+
+
+def _load_exported(path: str) -> Dict[str, Any]:
+    """
+    {"backend", "infer": (N,3,S,S) float32 → (N, 4+nc, anchors), "imgsz": S, "names": {cls: label}}
+    imgsz و names من الـ metadata اللي يكتبها ultralytics وقت التصدير.
+    """
+    if YOLO_BACKEND == "onnx":
+        import onnxruntime as ort
+
+        sess = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+        meta = {k: ast.literal_eval(v) if k in ("names", "imgsz") else v
+                for k, v in sess.get_modelmeta().custom_metadata_map.items()}
+        input_name = sess.get_inputs()[0].name
+
+        def infer(x: np.ndarray) -> np.ndarray:
+            return sess.run(None, {input_name: x})[0]
+    else:
+        import yaml
+        import openvino as ov
+
+        xml = path if path.endswith(".xml") else glob.glob(os.path.join(path, "*.xml"))[0]
+        core = ov.Core()
+        compiled = core.compile_model(core.read_model(xml), "CPU", {"PERFORMANCE_HINT": "LATENCY"})
+        meta_path = os.path.join(os.path.dirname(xml), "metadata.yaml")
+        meta = {}
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = yaml.safe_load(f) or {}
+
+        def infer(x: np.ndarray) -> np.ndarray:
+            # infer request لكل طلب: خيطين gunicorn ممكن يعدّون بنفس الوقت
+            req = compiled.create_infer_request()
+            req.infer({0: x})
+            return np.array(req.get_output_tensor(0).data)
+
+    imgsz = meta.get("imgsz") or 640
+    names = {int(k): str(v) for k, v in (meta.get("names") or {}).items()}
+    return {
+        "backend": YOLO_BACKEND,
+        "infer": infer,
+        "imgsz": int(imgsz[0] if isinstance(imgsz, (list, tuple)) else imgsz),
+        "names": names,
+    }
+
+
+def _load_pair(a_bucket: str, a_blob: str, b_bucket: str, b_blob: str):
+    a_local = _download_blob(a_bucket, a_blob)
+    b_local = _download_blob(b_bucket, b_blob)
+
+    model_a = load_yolo(_backend_weights(a_bucket, a_blob, a_local))
+    model_b = load_yolo(_backend_weights(b_bucket, b_blob, b_local))
+    print(f"[YOLO] backend={YOLO_BACKEND}")
+    return {"A": model_a, "B": model_b}
+
+
 def load_models_auto():
     if MODELS_GCS_URI_A and MODELS_GCS_URI_B:
         a_bucket, a_blob = _parse_gs_uri(MODELS_GCS_URI_A)
         b_bucket, b_blob = _parse_gs_uri(MODELS_GCS_URI_B)
 
-        a_local = _download_blob(a_bucket, a_blob)
-        b_local = _download_blob(b_bucket, b_blob)
-
-        model_a = YOLO(a_local)
-        model_a.model.to("cpu").eval()
-        model_b = YOLO(b_local)
-        model_b.model.to("cpu").eval()
-
-        return {"A": model_a, "B": model_b}, {
+        return _load_pair(a_bucket, a_blob, b_bucket, b_blob), {
             "A": MODELS_GCS_URI_A,
             "B": MODELS_GCS_URI_B,
+            "backend": YOLO_BACKEND,
         }
 
     blob_a, blob_b = _auto_pick_two_pt(DEFAULT_BUCKET, MODELS_PREFIX)
 
-    a_local = _download_blob(DEFAULT_BUCKET, blob_a)
-    b_local = _download_blob(DEFAULT_BUCKET, blob_b)
-
-    model_a = YOLO(a_local)
-    model_a.model.to("cpu").eval()
-    model_b = YOLO(b_local)
-    model_b.model.to("cpu").eval()
-
     return (
-        {"A": model_a, "B": model_b},
+        _load_pair(DEFAULT_BUCKET, blob_a, DEFAULT_BUCKET, blob_b),
         {
             "A": f"gs://{DEFAULT_BUCKET}/{blob_a}",
             "B": f"gs://{DEFAULT_BUCKET}/{blob_b}",
+            "backend": YOLO_BACKEND,
         },
     )
 
@@ -227,47 +394,148 @@ def get_sat_image_for_farm(farm: Dict[str, Any]) -> str:
 
 
 
-def _yolo_predict(model: YOLO, image_path: str) -> Dict[str, Any]:
+def _summarize(dets: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # score = متوسط الثقة + مكافأة صغيرة للعدد (نفسه للصورة الوحدة والنوافذ عشان مقارنة A/B ما تتغير)
+    mean_conf = (sum(d["conf"] for d in dets) / len(dets)) if dets else 0.0
+    score = float(mean_conf + 0.05 * math.log(1 + len(dets)))
+    return {"detections": dets, "count": len(dets), "score": score}
+
+
+def _result_detections(r) -> List[Dict[str, Any]]:
+    """نتيجة ultralytics لصورة وحدة → [{cls, label, conf, box_xyxy}] (إحداثيات الصورة نفسها)."""
+    dets: List[Dict[str, Any]] = []
+
+    if hasattr(r, "boxes") and r.boxes is not None:
+        names = getattr(r, "names", {}) or {}
+        limit = min(len(r.boxes), MAX_DETECTION_LIMIT)
+
+        for i in range(limit):
+            b = r.boxes[i]
+            cls = int(b.cls[0])
+            conf = float(b.conf[0])
+
+            if conf >= CONF_THRESHOLD:
+                x1, y1, x2, y2 = [float(v) for v in b.xyxy[0].tolist()]
+                dets.append(
+                    {
+                        "cls": cls,
+                        "label": names.get(cls, str(cls)),
+                        "conf": conf,
+                        "box_xyxy": [x1, y1, x2, y2],
+                    }
+                )
+    return dets
+
+
+def _source_image(src) -> Image.Image:
+    """مسار / PIL / np (BGR مثل ultralytics) → PIL RGB."""
+    if isinstance(src, Image.Image):
+        return src.convert("RGB")
+    if isinstance(src, np.ndarray):
+        return Image.fromarray(np.ascontiguousarray(src[..., ::-1]))
+    return Image.open(src).convert("RGB")
+
+
+def _letterbox(img: Image.Image, size: int) -> Tuple[np.ndarray, float, Tuple[int, int]]:
+    """نفس LetterBox حق ultralytics للموديلات المصدّرة: تصغير بنفس النسبة + حشو 114 بالوسط → (HWC uint8, gain, (left, top))."""
+    w, h = img.size
+    gain = min(size / h, size / w)
+    nw, nh = int(round(w * gain)), int(round(h * gain))
+    if (nw, nh) != (w, h):
+        img = img.resize((nw, nh), Image.BILINEAR)
+    left = int(round((size - nw) / 2 - 0.1))
+    top = int(round((size - nh) / 2 - 0.1))
+    out = np.full((size, size, 3), 114, dtype=np.uint8)
+    out[top:top + nh, left:left + nw] = np.asarray(img)
+    return out, gain, (left, top)
+
+
+def _nms(boxes: np.ndarray, scores: np.ndarray, iou: float) -> List[int]:
+    """NMS عادي (IoU) — الفهارس مرتبة بالثقة."""
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-scores, kind="stable")
+    keep: List[int] = []
+    while order.size and len(keep) < MAX_DETECTION_LIMIT:
+        i = order[0]
+        keep.append(int(i))
+        rest = order[1:]
+        iw = np.clip(np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]), 0, None)
+        ih = np.clip(np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]), 0, None)
+        inter = iw * ih
+        order = rest[inter / np.maximum(area[i] + area[rest] - inter, 1e-9) <= iou]
+    return keep
+
+
+def _decode(pred: np.ndarray, gain: float, pad: Tuple[int, int], shape: Tuple[int, int],
+            names: Dict[int, str]) -> List[Dict[str, Any]]:
+    """
+    مخرج YOLOv8 المصدّر لصورة وحدة (4+nc, anchors): xywh بمقاس الـ letterbox + ثقة كل فئة.
+    فلتر CONF_THRESHOLD → NMS لكل فئة (إزاحة بالفئة مثل ultralytics) → إحداثيات الصورة الأصلية.
+    """
+    p = pred.T
+    cls_scores = p[:, 4:]
+    cls = cls_scores.argmax(1)
+    conf = cls_scores[np.arange(len(p)), cls]
+    m = conf >= CONF_THRESHOLD
+    if not m.any():
+        return []
+    xywh, cls, conf = p[m, :4].astype(np.float64), cls[m], conf[m].astype(np.float64)
+    xyxy = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+    # 30000 أعلى ثقة قبل NMS مثل max_nms في ultralytics
+    top = np.argsort(-conf, kind="stable")[:30000]
+    xyxy, cls, conf = xyxy[top], cls[top], conf[top]
+    keep = _nms(xyxy + cls[:, None] * 7680.0, conf, NMS_IOU_THRESHOLD)
+
+    w, h = shape
+    left, top_pad = pad
+    boxes = (xyxy[keep] - [left, top_pad, left, top_pad]) / gain
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, w)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, h)
+    return [
+        {
+            "cls": int(cls[k]),
+            "label": names.get(int(cls[k]), str(int(cls[k]))),
+            "conf": float(conf[k]),
+            "box_xyxy": [float(v) for v in box],
+        }
+        for k, box in zip(keep, boxes)
+    ]
+
+
+def _predict_exported(model: Dict[str, Any], sources: List[Any]) -> List[List[Dict[str, Any]]]:
+    """onnx/openvino: letterbox → batch واحد NCHW RGB/255 → _decode لكل صورة."""
+    size = model["imgsz"]
+    batch, metas = [], []
+    for src in sources:
+        img = _source_image(src)
+        arr, gain, pad = _letterbox(img, size)
+        batch.append(arr)
+        metas.append((gain, pad, img.size))
+    x = np.ascontiguousarray(np.stack(batch).transpose(0, 3, 1, 2), dtype=np.float32) / 255.0
+    preds = model["infer"](x)
+    return [_decode(preds[i], *metas[i], model["names"]) for i in range(len(metas))]
+
+
+def _predict_batch(model, sources: List[Any]) -> List[List[Dict[str, Any]]]:
+    """طلب predict واحد لقائمة صور (batch واحد) — torch عن طريق ultralytics، onnx/openvino بالـ session مباشرة."""
+    if YOLO_BACKEND != "torch":
+        return _predict_exported(model, sources)
+    import torch
+
     try:
         gc.collect()
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
         results = model.predict(
-            image_path,
+            sources,
             device="cpu",
             verbose=False,
             conf=CONF_THRESHOLD,
             iou=NMS_IOU_THRESHOLD,
             max_det=MAX_DETECTION_LIMIT,
         )
-
-        r = results[0]
-        dets: List[Dict[str, Any]] = []
-
-        if hasattr(r, "boxes") and r.boxes is not None:
-            names = getattr(r, "names", {}) or {}
-            limit = min(len(r.boxes), MAX_DETECTION_LIMIT)
-
-            for i in range(limit):
-                b = r.boxes[i]
-                cls = int(b.cls[0])
-                conf = float(b.conf[0])
-
-                if conf >= CONF_THRESHOLD:
-                    x1, y1, x2, y2 = [float(v) for v in b.xyxy[0].tolist()]
-                    dets.append(
-                        {
-                            "cls": cls,
-                            "label": names.get(cls, str(cls)),
-                            "conf": conf,
-                            "box_xyxy": [x1, y1, x2, y2],
-                        }
-                    )
-
-        mean_conf = (sum(d["conf"] for d in dets) / len(dets)) if dets else 0.0
-        score = float(mean_conf + 0.05 * math.log(1 + len(dets)))
-        return {"detections": dets, "count": len(dets), "score": score}
+        return [_result_detections(r) for r in results]
 
     finally:
         gc.collect()
@@ -275,21 +543,336 @@ def _yolo_predict(model: YOLO, image_path: str) -> Dict[str, Any]:
             torch.cuda.empty_cache()
 
 
-def run_both_and_pick_best(models, image_path: str) -> Dict[str, Any]:
-    
-    a = _yolo_predict(models["A"], image_path)
-    b = _yolo_predict(models["B"], image_path)
-    best = a if a["score"] >= b["score"] else b
+def _yolo_predict(model, image_path) -> Dict[str, Any]:
+    dets = _predict_batch(model, [image_path])[0]
+    return _summarize(dets)
+
+
+def predict_tiles(
+    model,
+    tiles: List[Tuple[Any, Tuple[float, float]]],
+    batch_size: Optional[int] = None,
+) -> List[List[Dict[str, Any]]]:
+    """
+    tiles: [(صورة PIL/np, (x0, y0)), ...] — (x0, y0) موقع البلاطة بالصورة الأصلية.
+    يشغّل الموديل على دفعات بحجم YOLO_BATCH_SIZE ويرجّع كشوفات كل بلاطة بإحداثيات الصورة الأصلية
+    (box_xyxy مزاح بـ x0/y0)، بنفس ترتيب tiles.
+    """
+    bs = max(1, int(batch_size or YOLO_BATCH_SIZE))
+    out: List[List[Dict[str, Any]]] = []
+    for i in range(0, len(tiles), bs):
+        chunk = tiles[i:i + bs]
+        for dets, (_, (x0, y0)) in zip(_predict_batch(model, [img for img, _ in chunk]), chunk):
+            for d in dets:
+                x1, y1, x2, y2 = d["box_xyxy"]
+                d["box_xyxy"] = [x1 + x0, y1 + y0, x2 + x0, y2 + y0]
+            out.append(dets)
+    return out
+
+
+_AB_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_AB_LOCK = threading.Lock()
+_TORCH_THREADS: Optional[int] = None
+
+
+def _ab_executor() -> ThreadPoolExecutor:
+    global _AB_EXECUTOR, _TORCH_THREADS
+    if _AB_EXECUTOR is None:
+        with _AB_LOCK:
+            if _AB_EXECUTOR is None:
+                import torch
+
+                # ميزانية الخيوط الكلية تنقرأ مرة من الخيط الرئيسي قبل التقسيم
+                _TORCH_THREADS = torch.get_num_threads()
+                _AB_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="yolo-ab")
+    return _AB_EXECUTOR
+
+
+_AB_ACTIVE = 0
+
+
+def _with_thread_budget(fn, model, *args):
+    """
+    set_num_threads يضبط OpenMP للخيط اللي ناداه، بس MKL على مستوى الـ process كله —
+    فكل موديل ياخذ نص الأنوية وقت التشغيل المتوازي، وآخر واحد يخلص يرجّع الميزانية الكاملة
+    عشان طلبات الموديل الواحد بعدها ما تشتغل بنص الأنوية.
+    """
+    global _AB_ACTIVE
+    import torch
+
+    with _AB_LOCK:
+        _AB_ACTIVE += 1
+    torch.set_num_threads(max(1, (_TORCH_THREADS or 1) // 2))
+    try:
+        return fn(model, *args)
+    finally:
+        with _AB_LOCK:
+            _AB_ACTIVE -= 1
+            if _AB_ACTIVE == 0:
+                torch.set_num_threads(_TORCH_THREADS or 1)
+
+
+def _run_ab(models, fn, *args, only: Optional[str] = None) -> Tuple[Any, Any]:
+    """
+    fn(models["A"], *args) و fn(models["B"], *args) — بالتوازي لو YOLO_PARALLEL_AB و backend torch، وإلا بالتسلسل.
+    only="A"/"B": موديل واحد بس (model_policy) والثاني يرجع None.
+    """
+    if only in ("A", "B"):
+        out = fn(models[only], *args)
+        return (out, None) if only == "A" else (None, out)
+    # session حق onnxruntime/openvino تستخدم كل الأنوية وما نقدر نقسمها مثل torch،
+    # فتشغيل الاثنين مع بعض يزاحم المعالج ويطلع أبطأ من التسلسل
+    if not YOLO_PARALLEL_AB or YOLO_BACKEND != "torch":
+        return fn(models["A"], *args), fn(models["B"], *args)
+    ex = _ab_executor()
+    fa = ex.submit(_with_thread_budget, fn, models["A"], *args)
+    fb = ex.submit(_with_thread_budget, fn, models["B"], *args)
+    return fa.result(), fb.result()
+
+
+def _pick_best(a: Optional[Dict[str, Any]], b: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    الأعلى score بين A و B؛ الموديل اللي ما اشتغل ياخذ count/score = None.
+    tie=True لو الاثنين اشتغلوا وطلعوا نفس العدد (أو نفس score) — picked يبقى A بس المقارنة ما تنحسب فوز.
+    """
+    if b is None or (a is not None and a["score"] >= b["score"]):
+        picked, best = "A", a
+    else:
+        picked, best = "B", b
+    tie = a is not None and b is not None and (a["count"] == b["count"] or a["score"] == b["score"])
     return {
-        "picked": "A" if best is a else "B",
+        "picked": picked,
+        "tie": tie,
         "count": best["count"],
         "score": best["score"],
         "best_detections": best["detections"],
-        "A": {"count": a["count"], "score": a["score"]},
-        "B": {"count": b["count"], "score": b["score"]},
+        "A": {"count": a["count"], "score": a["score"]} if a is not None else {"count": None, "score": None},
+        "B": {"count": b["count"], "score": b["score"]} if b is not None else {"count": None, "score": None},
     }
 
 
+def run_both_and_pick_best(models, image_path: str, only: Optional[str] = None) -> Dict[str, Any]:
+    
+    a, b = _run_ab(models, _yolo_predict, image_path, only=only)
+    return _pick_best(a, b)
+
+
+# ---------- tiled: تغطية المضلع كامل ----------
+
+def _lonlat_to_px(lat: float, lon: float, zoom: int) -> Tuple[float, float]:
+    """Web Mercator → بكسل عالمي بمقاس بلاطات MapTiler (TILE_SIZE_MAP)."""
+    world = TILE_SIZE_MAP * (2.0 ** zoom)
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    lat_rad = math.radians(lat)
+    x = (lon + 180.0) / 360.0 * world
+    y = (1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * world
+    return x, y
+
+
+def _px_to_lonlat(x: float, y: float, zoom: int) -> Tuple[float, float]:
+    """العكس: بكسل عالمي → (lat, lon)."""
+    world = TILE_SIZE_MAP * (2.0 ** zoom)
+    lon = x / world * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * y / world))))
+    return lat, lon
+
+
+def _axis_starts(lo: float, hi: float) -> List[int]:
+    """بدايات النوافذ على محور واحد (خطوة TILE_SIZE*(1-OVERLAP))، والشبكة متمركزة على المدى."""
+    step = max(1, int(TILE_SIZE * (1.0 - OVERLAP)))
+    span = hi - lo
+    n = 1 if span <= TILE_SIZE else int(math.ceil((span - TILE_SIZE) / step)) + 1
+    covered = (n - 1) * step + TILE_SIZE
+    start = int(math.floor(lo - (covered - span) / 2.0))
+    return [start + i * step for i in range(n)]
+
+
+def _segments_cross(p1, p2, q1, q2) -> bool:
+    def orient(a, b, c):
+        return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    d1, d2 = orient(q1, q2, p1), orient(q1, q2, p2)
+    d3, d4 = orient(p1, p2, q1), orient(p1, p2, q2)
+    return (d1 > 0) != (d2 > 0) and (d3 > 0) != (d4 > 0)
+
+
+def _window_hits_polygon(x0: float, y0: float, pts: List[Tuple[float, float]]) -> bool:
+    """هل النافذة [x0, x0+TILE_SIZE]² تتقاطع مع المضلع (بالبكسل)؟"""
+    x1, y1 = x0 + TILE_SIZE, y0 + TILE_SIZE
+    if any(x0 <= x <= x1 and y0 <= y <= y1 for x, y in pts):
+        return True
+    corners = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+    # النافذة كلها داخل المضلع (ray casting بالبكسل)
+    cx, cy = x0 + TILE_SIZE / 2.0, y0 + TILE_SIZE / 2.0
+    inside = False
+    for i in range(len(pts)):
+        (xi, yi), (xj, yj) = pts[i], pts[i - 1]
+        if (yi > cy) != (yj > cy) and cx < xi + (cy - yi) * (xj - xi) / (yj - yi):
+            inside = not inside
+    if inside:
+        return True
+    for i in range(len(pts)):
+        for k in range(4):
+            if _segments_cross(pts[i - 1], pts[i], corners[k - 1], corners[k]):
+                return True
+    return False
+
+
+def plan_count_windows(poly: List[Dict[str, float]], zoom: int = COUNT_ZOOM) -> Dict[str, Any]:
+    """
+    يقسم bbox المضلع لنوافذ TILE_SIZE متداخلة بـ OVERLAP ويخلي اللي تلمس المضلع بس.
+    يرجّع {"windows": [(x0, y0), ...] بالبكسل العالمي, "planned": العدد قبل السقف, "grid": عدد نوافذ الـ bbox}
+    """
+    pts = [_lonlat_to_px(p["lat"], p["lng"], zoom) for p in poly]
+    xs = [x for x, _ in pts]
+    ys = [y for _, y in pts]
+    grid = [(x0, y0) for y0 in _axis_starts(min(ys), max(ys)) for x0 in _axis_starts(min(xs), max(xs))]
+    windows = [w for w in grid if _window_hits_polygon(w[0], w[1], pts)]
+    planned = len(windows)
+    if COUNT_MAX_TILES > 0 and planned > COUNT_MAX_TILES:
+        print(f"[COUNT] ⚠️ windows={planned} > COUNT_MAX_TILES={COUNT_MAX_TILES} → partial count ({COUNT_MAX_TILES} windows)")
+        windows = windows[:COUNT_MAX_TILES]
+    return {"windows": windows, "planned": planned, "grid": len(grid)}
+
+
+def _map_tile(tx: int, ty: int, zoom: int, cache: Dict[Tuple[int, int], Image.Image]) -> Image.Image:
+    key = (tx, ty)
+    if key not in cache:
+        url = TILE_URL.format(zoom=zoom, x=tx, y=ty, key=MAPTILER_KEY)
+        r = _http_get_with_retry(url, tries=3, backoff=0.75, timeout=60)
+        cache[key] = Image.open(io.BytesIO(r.content)).convert("RGB")
+    return cache[key]
+
+
+def _window_image(x0: int, y0: int, zoom: int, cache: Dict[Tuple[int, int], Image.Image]) -> Image.Image:
+    """يركّب نافذة TILE_SIZE من بلاطات MapTiler (البلاطات المشتركة بين النوافذ تنزل مرة وحدة)."""
+    img = Image.new("RGB", (TILE_SIZE, TILE_SIZE))
+    for ty in range(y0 // TILE_SIZE_MAP, (y0 + TILE_SIZE - 1) // TILE_SIZE_MAP + 1):
+        for tx in range(x0 // TILE_SIZE_MAP, (x0 + TILE_SIZE - 1) // TILE_SIZE_MAP + 1):
+            img.paste(_map_tile(tx, ty, zoom, cache), (tx * TILE_SIZE_MAP - x0, ty * TILE_SIZE_MAP - y0))
+    return img
+
+
+def _merge_detections(dets: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """NMS عام بعد تجميع النوافذ: نخلي الأعلى ثقة ونشيل أي صندوق يغطي COUNT_MERGE_IOS من الأصغر."""
+    if not dets:
+        return []
+    boxes = np.asarray([d["box_xyxy"] for d in dets], dtype=np.float64)
+    conf = np.asarray([d["conf"] for d in dets], dtype=np.float64)
+    area = np.maximum(boxes[:, 2] - boxes[:, 0], 0) * np.maximum(boxes[:, 3] - boxes[:, 1], 0)
+
+    order = np.argsort(-conf, kind="stable")
+    keep: List[int] = []
+    while order.size:
+        i = order[0]
+        keep.append(int(i))
+        rest = order[1:]
+        iw = np.clip(np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]), 0, None)
+        ih = np.clip(np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]), 0, None)
+        smaller = np.maximum(np.minimum(area[i], area[rest]), 1e-9)
+        order = rest[(iw * ih) / smaller < COUNT_MERGE_IOS]
+    return [dets[i] for i in keep]
+
+
+def count_farm_tiled(
+    models, farm: Dict[str, Any], zoom: int = COUNT_ZOOM, only: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    يعدّ النخيل على المضلع كامل:
+    نوافذ TILE_SIZE تلمس المضلع → A و B على كل نافذة → نخلي الصناديق اللي مركزها داخل المضلع → دمج الحدود.
+    الناتج نفس شكل run_both_and_pick_best + "tiles".
+    box_xyxy بالبكسل من أول نافذة (أعلى يسار التغطية)، و lat/lng لمركز الصندوق.
+    """
+    if not MAPTILER_KEY:
+        raise RuntimeError("MAPTILER_KEY is required")
+    poly = farm.get("polygon") or []
+    if len(poly) < 3:
+        raise ValueError("Farm polygon is missing or < 3 points")
+
+    plan = plan_count_windows(poly, zoom)
+    windows = plan["windows"]
+    ox = min(x for x, _ in windows)
+    oy = min(y for _, y in windows)
+
+    cache: Dict[Tuple[int, int], Image.Image] = {}
+    run_keys = (only,) if only in ("A", "B") else ("A", "B")
+    raw: Dict[str, Optional[List[Dict[str, Any]]]] = {k: ([] if k in run_keys else None) for k in ("A", "B")}
+    t_fetch = t_infer = 0.0
+    map_tiles = 0
+    # دفعة YOLO_BATCH_SIZE نوافذ بالذاكرة بس، مو المزرعة كلها
+    bs = max(1, YOLO_BATCH_SIZE)
+    for i in range(0, len(windows), bs):
+        t0 = time.perf_counter()
+        cached_before = len(cache)
+        tiles = [
+            (_window_image(x0, y0, zoom, cache), (x0 - ox, y0 - oy))
+            for x0, y0 in windows[i:i + bs]
+        ]
+        map_tiles += len(cache) - cached_before
+        t_fetch += time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        per_model = dict(zip(("A", "B"), _run_ab(models, predict_tiles, tiles, bs, only=only)))
+        for key, tile_dets in per_model.items():
+            if tile_dets is None:
+                continue
+            for dets in tile_dets:
+                for d in dets:
+                    bx1, by1, bx2, by2 = d["box_xyxy"]
+                    lat, lng = _px_to_lonlat(ox + (bx1 + bx2) / 2.0, oy + (by1 + by2) / 2.0, zoom)
+                    if point_in_polygon(lat, lng, poly):
+                        raw[key].append({**d, "lat": lat, "lng": lng})
+        t_infer += time.perf_counter() - t0
+        del tiles
+
+        # النوافذ بترتيب الصفوف: البلاطات فوق أول صف باقي ما عاد تنحتاج (الذاكرة ما تكبر مع مساحة المزرعة)
+        if i + bs < len(windows):
+            next_row = windows[i + bs][1] // TILE_SIZE_MAP
+            for key in [k for k in cache if k[1] < next_row]:
+                del cache[key]
+
+    a = None if raw["A"] is None else _summarize(_merge_detections(raw["A"]))
+    b = None if raw["B"] is None else _summarize(_merge_detections(raw["B"]))
+    tiles = {
+        "run": len(windows),
+        "planned": plan["planned"],
+        "grid": plan["grid"],
+        "map_tiles": map_tiles,
+        "fetch_s": round(t_fetch, 3),
+        "infer_s": round(t_infer, 3),
+        "batch_size": bs,
+    }
+
+    def _fmt(key, res):
+        return f"{key}=skip" if res is None else f"{key}={len(raw[key])}->{res['count']}"
+
+    print(
+        f"[COUNT] tiled windows={len(windows)}/{plan['planned']} grid={plan['grid']} map_tiles={map_tiles} batch={bs} "
+        f"{_fmt('A', a)} {_fmt('B', b)} fetch={t_fetch:.2f}s infer={t_infer:.2f}s"
+    )
+    partial = len(windows) < plan["planned"]
+    return {
+        **_pick_best(a, b),
+        "tiles": tiles,
+        "partial": partial,
+        "coverage": round(len(windows) / plan["planned"], 4) if plan["planned"] else 1.0,
+    }
+
+
+def image_source(farm: Dict[str, Any]) -> str:
+    """"user" لو المزرعة لها صورة مرفوعة، وإلا "maptiler"."""
+    return "user" if (farm.get("imageURL") or farm.get("imageUrl") or "").strip() else "maptiler"
+
+
+def count_farm(models, farm: Dict[str, Any], only: Optional[str] = None) -> Dict[str, Any]:
+    """
+    نقطة الدخول للعد: صورة المستخدم (imageURL) تبقى صورة وحدة،
+    وإلا COUNT_MODE=tiled يغطي المضلع كامل و centroid يرجع للطريقة القديمة.
+    only="A"/"B" يشغّل موديل واحد (قرار model_policy).
+    """
+    if image_source(farm) == "user" or COUNT_MODE != "tiled":
+        img_path = get_sat_image_for_farm(farm)
+        return run_both_and_pick_best(models, img_path, only=only)
+    return count_farm_tiled(models, farm, only=only)
 
 
 def count_palms(models, image_path: str) -> Dict[str, Any]:
@@ -13,6 +13,7 @@ import firebase_admin
 from firebase_admin import messaging
 
 from app.firestore_utils import set_status, get_farm_doc
+from app import profiling
 
 app = Flask(__name__, template_folder="templates", static_folder="static")
 CORS(app)
@@ -245,12 +246,16 @@ def analyze():
             400,
         )
 
+    # مراحل الطلب (وقت/طلبات EE/أسطر/RSS) — ترجع في الرد تحت "profile"
+    profile_token = profiling.start_run(farmId=farm_id)
     try:
         app.logger.info(f"[ANALYZE] origin={origin} farmId={farm_id}")
 
-        set_status(farm_id, status="running", errorMessage=None)
+        with profiling.stage("firestore_write", what="status_running"):
+            set_status(farm_id, status="running", errorMessage=None)
 
         from app import inference as inf
+        from app import model_policy
         from app import health as health_mod
 
         models, uris = get_models_once()
@@ -259,7 +264,8 @@ def analyze():
                 f"YOLO model initialization failed: {uris.get('error', 'Unknown failure')}"
             )
 
-        farm_doc = get_farm_doc(farm_id)
+        with profiling.stage("firestore_read", what="farm_doc"):
+            farm_doc = get_farm_doc(farm_id)
         if not farm_doc:
             raise ValueError(f"Farm '{farm_id}' not found in Firestore")
 
@@ -268,22 +274,25 @@ def analyze():
             raise ValueError("Farm polygon is missing or < 3 points")
         app.logger.info(f"[DEBUG] farmId={farm_id} polygon_len={len(poly)}")
 
-        img_path = inf.get_sat_image_for_farm(farm_doc)
-        app.logger.info(f"[IMG] {img_path}")
-
-        picked = inf.run_both_and_pick_best(models, img_path)
+        # الصور (MapTiler/رابط المستخدم) + YOLO — في وضع tiled الاثنين متداخلين لكل نافذة
+        with profiling.stage("yolo_count", mode=inf.COUNT_MODE):
+            picked = model_policy.count_farm(models, uris, farm_doc)
         app.logger.info(f"[COUNT] done count={picked['count']} score={picked['score']}")
 
         count_summary = {
             "count": int(picked["count"]),
             "quality": float(picked["score"]),
             "model": picked.get("picked"),
+            # COUNT_MAX_TILES قص النوافذ → العدد جزئي وما ينعرض كعدد المزرعة الكامل
+            "partial": bool(picked.get("partial", False)),
+            "coverage": float(picked.get("coverage", 1.0)),
         }
 
         # ✅ Health + Alerts + Push
         export_payload = {}
         try:
-            health_result = health_mod.analyze_farm_health(farm_id, farm_doc) 
+            with profiling.stage("health"):
+                health_result = health_mod.analyze_farm_health(farm_id, farm_doc)
 
             # ✅ (جديد) تجهيز بيانات التصدير المختصرة
             
@@ -299,11 +308,12 @@ def analyze():
             alerts_pkg = build_alerts_and_recommendations(farm_id, health_result)
 
 # ✅ (1) خزن alerts/recs وارجع لنا كم alert جديد انضاف
-            new_alerts_count = set_alerts_and_recommendations(
-               farm_id,
-               alerts_pkg.get("alerts", []),
-               alerts_pkg.get("recommendations", []),
-              )
+            with profiling.stage("firestore_write", what="alerts"):
+                new_alerts_count = set_alerts_and_recommendations(
+                   farm_id,
+                   alerts_pkg.get("alerts", []),
+                   alerts_pkg.get("recommendations", []),
+                  )
 
 # ✅ (2) Push فقط لو فيه جديد
             owner_uid = farm_doc.get("createdBy") or farm_doc.get("ownerUid")
@@ -322,16 +332,20 @@ def analyze():
             health_result = {"error": str(he)}
 
         h_map = list(health_result.pop("health_map", []))
-        set_status(
-            farm_id,
-            status="done",
-            palm_count=count_summary["count"],
-            detection_quality=count_summary["quality"],
-            health=health_result,
-            healthMap=h_map,
-            # export_data=export_payload,
-            lastAnalysisAt=firestore.SERVER_TIMESTAMP,
-        )
+        with profiling.stage("firestore_write", what="status_done"):
+            set_status(
+                farm_id,
+                status="done",
+                palm_count=count_summary["count"],
+                palm_count_partial=count_summary["partial"],
+                palm_count_coverage=count_summary["coverage"],
+                detection_quality=count_summary["quality"],
+                health=health_result,
+                healthMap=h_map,
+                # export_data=export_payload,
+                lastAnalysisAt=firestore.SERVER_TIMESTAMP,
+            )
+        profile = profiling.finish_run(profile_token)
 
         return (
             jsonify(
@@ -342,6 +356,7 @@ def analyze():
                     "countResult": count_summary,
                     "healthResult": health_result,
                     "debugCountRaw": picked,
+                    "profile": profile,
                 }
             ),
             200,
@@ -350,7 +365,7 @@ def analyze():
     except Exception as e:
         set_status(farm_id, status="failed", errorMessage=str(e))
         app.logger.exception(f"❌ ERROR during /analyze: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500 
+        return jsonify({"status": "error", "message": str(e), "profile": profiling.finish_run(profile_token)}), 500 
 @app.post("/scheduled-update")
 def scheduled_update():
     app.logger.info("⏰ /scheduled-update called")
@@ -360,8 +375,16 @@ def scheduled_update():
     now = datetime.utcnow()
     updated = []
     skipped = []
+    reused = []
     failed = []
 
+    from app import inference as inf
+    from app import model_policy
+    from app import health as health_mod
+    from app.alerts_engine import build_alerts_and_recommendations
+    from app.firestore_utils import set_alerts_and_recommendations
+
+    pending = []
     for doc in farms:
         farm = doc.to_dict() or {}
         farm_id = doc.id
@@ -378,11 +401,41 @@ def scheduled_update():
             continue
 
         try:
-            from app import inference as inf
-            from app import health as health_mod
-            from app.alerts_engine import build_alerts_and_recommendations
-            from app.firestore_utils import set_alerts_and_recommendations
+            # ✅ 0) نفس مدخلات آخر تحليل (مشاهد S2/Landsat، نافذة الأسابيع، أسبوع الطقس النهائي، المضلع)؟
+            #    الصحة المخزنة نفسها — لا تحليل ولا YOLO (صور MapTiler والموديلات ما تتغير خلال نفس الأسبوع)
+            stored_health = farm.get("health") or {}
+            stamp = health_mod.imagery_stamp(farm_id, farm)
+            if stamp and not stored_health.get("error") and stored_health.get("imagery_stamp") == stamp:
+                app.logger.info(f"[SCHEDULED] farmId={farm_id} inputs unchanged → reusing stored health + palm count")
+                set_status(farm_id, status="done", lastAnalysisAt=firestore.SERVER_TIMESTAMP)
+                reused.append(
+                    {
+                        "farmId": farm_id,
+                        "reused": ["health", "healthMap", "alerts", "palm_count"],
+                        "imagery_stamp": stamp,
+                        "palm_count": farm.get("palm_count"),
+                    }
+                )
+                continue
+        except Exception as e:
+            app.logger.exception(f"❌ scheduled-update failed for farmId={farm_id}: {e}")
+            set_status(farm_id, status="failed", errorMessage=str(e))
+            failed.append({"farmId": farm_id, "error": str(e)})
+            continue
+
+        pending.append((farm_id, farm))
+
+    # ✅ Health لكل المزارع المحتاجة دفعة وحدة (طلبات GEE مشتركة بدل طلبات لكل مزرعة)
+    health_results = {}
+    if pending:
+        try:
+            health_results = health_mod.analyze_farms_health(pending)
+        except Exception as e:
+            app.logger.exception(f"❌ scheduled-update batch health failed: {e}")
+            health_results = {farm_id: {"error": str(e)} for farm_id, _ in pending}
 
+    for farm_id, farm in pending:
+        try:
             models, uris = get_models_once()
             if not models:
                 raise RuntimeError(
@@ -390,11 +443,12 @@ def scheduled_update():
                 )
 
             # ✅ 1) Count
-            img_path = inf.get_sat_image_for_farm(farm)
-            picked = inf.run_both_and_pick_best(models, img_path)
+            picked = model_policy.count_farm(models, uris, farm)
 
-            # ✅ 2) Health
-            health_result = health_mod.analyze_farm_health(farm_id, farm)
+            # ✅ 2) Health (من الدفعة)
+            health_result = health_results.get(farm_id) or {"error": "missing batch health result"}
+            if "error" in health_result:
+                raise RuntimeError(health_result["error"])
 #             export_payload = health_mod.prepare_export_data(
 #     farm,
 #     health_result,
@@ -421,6 +475,8 @@ def scheduled_update():
                 farm_id,
                 status="done",
                 palm_count=int(picked["count"]),
+                palm_count_partial=bool(picked.get("partial", False)),
+                palm_count_coverage=float(picked.get("coverage", 1.0)),
                 detection_quality=float(picked["score"]),
                 health=health_result,
                 healthMap=h_map,
@@ -433,6 +489,7 @@ def scheduled_update():
                     "farmId": farm_id,
                     "newAlerts": int(new_alerts_count or 0),
                     "count": int(picked["count"]),
+                    "partial": bool(picked.get("partial", False)),
                     "score": float(picked["score"]),
                 }
             )
@@ -442,7 +499,7 @@ def scheduled_update():
             set_status(farm_id, status="failed", errorMessage=str(e))
             failed.append({"farmId": farm_id, "error": str(e)})
 
-    return jsonify({"updated": updated, "skipped": skipped, "failed": failed}), 200
+    return jsonify({"updated": updated, "skipped": skipped, "reused": reused, "failed": failed}), 200
 
 from app.reports_routes import reports_bp
 app.register_blueprint(reports_bp, url_prefix='/api')
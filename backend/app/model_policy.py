@@ -0,0 +1,179 @@
+import os
+import math
+import time
+import random
+import hashlib
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from google.cloud import firestore
+
+from app import inference as inf
+from app.common import polygon_centroid
+
+
+# adaptive: لو موديل يفوز بثبات في (المنطقة, مصدر الصورة) نشغّله لحاله | both: A و B دايماً (القديم)
+MODEL_POLICY = os.environ.get("MODEL_POLICY", "adaptive").strip().lower()
+MODEL_POLICY_COLLECTION = os.environ.get("MODEL_POLICY_COLLECTION", "model_policy")
+# أقل عدد مقارنات (A و B مع بعض) قبل ما نثق بالإحصائية
+MODEL_POLICY_MIN_RUNS = int(os.environ.get("MODEL_POLICY_MIN_RUNS", "10"))
+# الحد الأدنى (Wilson 95%) لنسبة فوز المتصدر عشان نشغّله لحاله
+MODEL_POLICY_MIN_WINRATE = float(os.environ.get("MODEL_POLICY_MIN_WINRATE", "0.75"))
+# نسبة العدّات اللي نشغّل فيها الاثنين حتى بعد الثقة (عشان نلاحظ لو تغيّر الفائز)
+MODEL_POLICY_EXPLORE = float(os.environ.get("MODEL_POLICY_EXPLORE", "0.1"))
+# كاش الإحصائيات بالذاكرة (ثواني) — يوفّر قراءة Firestore لكل عدّ
+MODEL_POLICY_CACHE_S = int(os.environ.get("MODEL_POLICY_CACHE_S", "300"))
+
+_db = None
+_STATS: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+_STATS_LOCK = threading.Lock()
+
+
+def _get_db():
+    global _db
+    if _db is None:
+        _db = firestore.Client()
+    return _db
+
+
+def farm_region(farm: Dict[str, Any]) -> str:
+    """region/city من وثيقة المزرعة، وإلا خلية درجة وحدة حول المركز (g24_46)."""
+    name = str(farm.get("region") or farm.get("city") or "").strip().lower()
+    if name:
+        return "".join(ch if ch.isalnum() else "_" for ch in name)[:60]
+    poly = farm.get("polygon") or []
+    if len(poly) >= 3:
+        lat, lon = polygon_centroid(poly)
+        return f"g{math.floor(lat)}_{math.floor(lon)}"
+    return "unknown"
+
+
+def _models_tag(model_uris: Dict[str, Any]) -> str:
+    # لو تغيّر checkpoint A أو B تبدأ الإحصائية من جديد
+    raw = f"{model_uris.get('A', '')}|{model_uris.get('B', '')}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:10]
+
+
+def _wilson_lower(wins: int, n: int, z: float = 1.96) -> float:
+    if n <= 0:
+        return 0.0
+    p = wins / n
+    denom = 1.0 + z * z / n
+    centre = p + z * z / (2 * n)
+    margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))
+    return (centre - margin) / denom
+
+
+def _load_stats(key: str) -> Dict[str, Any]:
+    now = time.time()
+    with _STATS_LOCK:
+        hit = _STATS.get(key)
+        if hit and now - hit[0] < MODEL_POLICY_CACHE_S:
+            return dict(hit[1])
+    try:
+        doc = _get_db().collection(MODEL_POLICY_COLLECTION).document(key).get()
+        data = doc.to_dict() if doc.exists else {}
+    except Exception as e:
+        print(f"[POLICY] ⚠️ stats read failed key={key}: {e}")
+        data = {}
+    stats = {
+        "runs": int(data.get("runs") or 0),
+        "winsA": int(data.get("winsA") or 0),
+        "winsB": int(data.get("winsB") or 0),
+        "ties": int(data.get("ties") or 0),
+    }
+    with _STATS_LOCK:
+        _STATS[key] = (now, stats)
+    return dict(stats)
+
+
+def decide(farm: Dict[str, Any], model_uris: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    يقرر مين يشتغل للعدّ الحالي:
+    {"key", "region", "source", "run": "A"/"B"/None (None = الاثنين), "mode", "runs", "ties", "win_rate", "leader"}
+    mode: off | warmup (مقارنات حاسمة قليلة) | undecided (ما فيه فائز ثابت) | explore | single
+    التعادلات (نفس العدد) ما تدخل في نسبة الفوز — runs هنا = المقارنات الحاسمة بس.
+    """
+    region = farm_region(farm)
+    source = inf.image_source(farm)
+    key = f"{region}__{source}__{_models_tag(model_uris)}"
+    out: Dict[str, Any] = {"key": key, "region": region, "source": source, "run": None}
+
+    if MODEL_POLICY != "adaptive":
+        return {**out, "mode": "off"}
+
+    stats = _load_stats(key)
+    n = stats["winsA"] + stats["winsB"]
+    leader = "A" if stats["winsA"] >= stats["winsB"] else "B"
+    wins = stats["wins" + leader]
+    out.update({
+        "runs": n,
+        "ties": stats["ties"],
+        "leader": leader,
+        "win_rate": round(wins / n, 3) if n else None,
+    })
+
+    if n < MODEL_POLICY_MIN_RUNS:
+        return {**out, "mode": "warmup"}
+    if _wilson_lower(wins, n) < MODEL_POLICY_MIN_WINRATE:
+        return {**out, "mode": "undecided"}
+    if random.random() < MODEL_POLICY_EXPLORE:
+        return {**out, "mode": "explore"}
+    return {**out, "mode": "single", "run": leader}
+
+
+def record(decision: Dict[str, Any], result: Dict[str, Any]) -> None:
+    """
+    يسجّل الفائز بس لو A و B اشتغلوا مع بعض (عدّة موديل واحد ما تقول شي عن المقارنة).
+    التعادل ينحسب في ties لحاله (picked=A بالتعادل، فلو انحسب فوز لـ A تميل الإحصائية له بدون سبب).
+    """
+    if decision.get("run") is not None or decision.get("mode") == "off":
+        return
+    if result.get("A", {}).get("score") is None or result.get("B", {}).get("score") is None:
+        return
+    winner = result.get("picked")
+    if winner not in ("A", "B"):
+        return
+
+    field = "ties" if result.get("tie") else f"wins{winner}"
+    key = decision["key"]
+    try:
+        _get_db().collection(MODEL_POLICY_COLLECTION).document(key).set(
+            {
+                "region": decision["region"],
+                "source": decision["source"],
+                "runs": firestore.Increment(1),
+                field: firestore.Increment(1),
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+            },
+            merge=True,
+        )
+    except Exception as e:
+        print(f"[POLICY] ⚠️ stats write failed key={key}: {e}")
+        return
+
+    with _STATS_LOCK:
+        hit = _STATS.get(key)
+        if hit:
+            stats = dict(hit[1])
+            stats["runs"] += 1
+            stats[field] += 1
+            _STATS[key] = (hit[0], stats)
+
+
+def count_farm(models, model_uris: Dict[str, Any], farm: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    inf.count_farm مع السياسة: موديل واحد لو الفائز ثابت، وإلا الاثنين ونسجّل مين فاز.
+    picked يبقى الموديل اللي طلع منه العدد، و "policy" توضح ليش.
+    """
+    decision = decide(farm, model_uris)
+    result = inf.count_farm(models, farm, only=decision["run"])
+    record(decision, result)
+
+    policy = {k: v for k, v in decision.items() if k != "key"}
+    print(
+        f"[POLICY] region={decision['region']} source={decision['source']} mode={decision['mode']} "
+        f"run={decision['run'] or 'A+B'} picked={result.get('picked')} "
+        f"tie={result.get('tie')} runs={decision.get('runs')} ties={decision.get('ties')} win_rate={decision.get('win_rate')}"
+    )
+    return {**result, "policy": policy}
@@ -0,0 +1,243 @@
+import warnings
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+# pixel_id = iy * PIXEL_ID_STRIDE + ix — الإحداثيات مقربة لـ 1e-6 درجة (~0.1 م)
+PIXEL_ID_SCALE = 1_000_000
+PIXEL_ID_STRIDE = 360 * PIXEL_ID_SCALE + 1
+
+
+def pixel_ids(x, y) -> np.ndarray:
+    """(lon, lat) → int64 ثابت لكل بكسل (نفس البكسل في كل الأسابيع يطلع له نفس الرقم)."""
+    ix = np.rint((np.asarray(x, dtype=np.float64) + 180.0) * PIXEL_ID_SCALE).astype(np.int64)
+    iy = np.rint((np.asarray(y, dtype=np.float64) + 90.0) * PIXEL_ID_SCALE).astype(np.int64)
+    return iy * PIXEL_ID_STRIDE + ix
+
+
+def pixel_lonlat(ids) -> tuple:
+    """عكس pixel_ids: (lon, lat) المقربة."""
+    ids = np.asarray(ids, dtype=np.int64)
+    return ids % PIXEL_ID_STRIDE / PIXEL_ID_SCALE - 180.0, ids // PIXEL_ID_STRIDE / PIXEL_ID_SCALE - 90.0
+
+
+def add_pixel_id(df: pd.DataFrame) -> pd.DataFrame:
+    """يضيف عمود pixel_id (أو يكمّل الناقص منه لأسطر الكاش/السجل القديمة) من x و y."""
+    if df is None or df.empty or "x" not in df.columns:
+        return df
+    if "pixel_id" in df.columns and df["pixel_id"].notna().all():
+        if df["pixel_id"].dtype != np.int64:
+            df["pixel_id"] = df["pixel_id"].astype(np.int64)
+        return df
+    df["pixel_id"] = pixel_ids(df["x"].to_numpy(), df["y"].to_numpy())
+    return df
+
+
+def series_index(df: pd.DataFrame) -> Dict[str, Any] | None:
+    """
+    فهرس السلاسل الزمنية للبكسلات — ينحسب مرة وحدة ويتمرر لكل المراحل بدل groupby في كل مرحلة:
+
+    - pixel / week: رقم البكسل ورقم الأسبوع لكل سطر في df (بنفس ترتيب df) — هذي تُستخدم بالرجوع للأسطر.
+    - present: (pixel, week) هل فيه سطر فعلاً لهذا البكسل بهذا الأسبوع.
+    - dates: تواريخ أعمدة الأسابيع.
+
+    يرجّع None لو فيه أكثر من سطر لنفس (بكسل، أسبوع) لأن المكعب ما يقدر يمثلها.
+    """
+    _, pixel = np.unique(df["pixel_id"].to_numpy(dtype=np.int64), return_inverse=True)
+    pixel = pixel.astype(np.int64)
+    dates, week = np.unique(pd.to_datetime(df["date"]).to_numpy(), return_inverse=True)
+    week = week.astype(np.int64)
+
+    n_pix = int(pixel.max()) + 1 if len(pixel) else 0
+    present = np.zeros((n_pix, len(dates)), dtype=bool)
+    present[pixel, week] = True
+    if int(present.sum()) != len(df):
+        return None
+
+    return {"pixel": pixel, "week": week, "dates": pd.DatetimeIndex(dates), "present": present}
+
+
+def subset(index: Dict[str, Any], keep: np.ndarray) -> Dict[str, Any]:
+    """فهرس الأسطر الباقية بعد فلترة df[keep] (بدون إعادة حساب المفاتيح)."""
+    keep = np.asarray(keep, dtype=bool)
+    pixel, week = index["pixel"][keep], index["week"][keep]
+    present = np.zeros_like(index["present"])
+    present[pixel, week] = True
+    return {"pixel": pixel, "week": week, "dates": index["dates"], "present": present}
+
+
+def build_cube(df: pd.DataFrame, bands: List[str], index: Dict[str, Any] | None = None) -> Dict[str, Any] | None:
+    """
+    يحوّل الجدول الطويل (سطر لكل بكسل × أسبوع) لمكعب كثيف float32 شكله (pixel, week, band)
+    على فهرس series_index (لو ما انعطى ينحسب هنا). None لو فيه أسطر مكررة.
+    """
+    if index is None:
+        index = series_index(df)
+        if index is None:
+            return None
+
+    values = np.full(index["present"].shape + (len(bands),), np.nan, dtype=np.float32)
+    values[index["pixel"], index["week"], :] = df[bands].to_numpy(dtype=np.float32)
+
+    cube = dict(index)
+    cube.update({"bands": list(bands), "values": values})
+    return cube
+
+
+def band(cube: Dict[str, Any], name: str) -> np.ndarray:
+    """(pixel, week) float64 لباند واحد — الحساب نفسه بـ float64 والتخزين float32."""
+    return cube["values"][:, :, cube["bands"].index(name)].astype(np.float64)
+
+
+def to_rows(cube: Dict[str, Any], arr: np.ndarray) -> np.ndarray:
+    """يرجّع قيم مصفوفة (pixel, week) لأسطر df الأصلية."""
+    return arr[cube["pixel"], cube["week"]]
+
+
+def from_rows(index: Dict[str, Any], values) -> np.ndarray:
+    """عمود من df (بنفس ترتيب الأسطر) → مصفوفة (pixel, week) float64، والخانات الفاضية NaN."""
+    out = np.full(index["present"].shape, np.nan, dtype=np.float64)
+    out[index["pixel"], index["week"]] = np.asarray(values, dtype=np.float64)
+    return out
+
+
+# ──────────────────────────────────────────────
+# العرض المضغوط: أسابيع كل بكسل الموجودة فعلاً مرصوصة من اليسار
+# (عشان rolling يمشي على الأسطر زي pandas — الأسبوع اللي ما له سطر ما ينحسب ضمن النافذة)
+# ──────────────────────────────────────────────
+
+def packed_order(cube: Dict[str, Any]) -> np.ndarray:
+    if "order" not in cube:
+        cube["order"] = np.argsort(~cube["present"], axis=1, kind="stable")
+    return cube["order"]
+
+
+def pack(cube: Dict[str, Any], arr: np.ndarray) -> np.ndarray:
+    out = np.take_along_axis(arr, packed_order(cube), axis=1)
+    n = cube["present"].sum(axis=1)
+    out[np.arange(out.shape[1])[None, :] >= n[:, None]] = np.nan
+    return out
+
+
+def unpack(cube: Dict[str, Any], packed: np.ndarray) -> np.ndarray:
+    out = np.full(packed.shape, np.nan, dtype=packed.dtype)
+    np.put_along_axis(out, packed_order(cube), packed, axis=1)
+    return out
+
+
+def _window_sums(a: np.ndarray, w: int) -> np.ndarray:
+    """مجموع نافذة متحركة طولها w على محور الزمن (النافذة تقصر في البداية)."""
+    cs = np.zeros((a.shape[0], a.shape[1] + 1), dtype=np.float64)
+    np.cumsum(a, axis=1, out=cs[:, 1:])
+    end = np.arange(1, a.shape[1] + 1)
+    start = np.maximum(end - w, 0)
+    return cs[:, end] - cs[:, start]
+
+
+def rolling_mean(cube: Dict[str, Any], arr: np.ndarray, w: int, min_periods: int) -> np.ndarray:
+    """زي groupby(pixel).rolling(w, min_periods).mean() على أسطر كل بكسل."""
+    p = pack(cube, arr)
+    ok = np.isfinite(p)
+    cnt = _window_sums(ok.astype(np.float64), w)
+    s = _window_sums(np.where(ok, p, 0.0), w)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = np.where(cnt >= min_periods, s / cnt, np.nan)
+    return unpack(cube, out)
+
+
+def rolling_std(cube: Dict[str, Any], arr: np.ndarray, w: int, min_periods: int) -> np.ndarray:
+    """زي rolling(w, min_periods).std() (ddof=1). نطرح متوسط البكسل أول عشان دقة الـ cumsum."""
+    p = pack(cube, arr)
+    ok = np.isfinite(p)
+    n_ok = ok.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        center = np.where(n_ok > 0, np.where(ok, p, 0.0).sum(axis=1, keepdims=True) / n_ok, 0.0)
+    d = np.where(ok, p - center, 0.0)
+
+    cnt = _window_sums(ok.astype(np.float64), w)
+    s1 = _window_sums(d, w)
+    s2 = _window_sums(d * d, w)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var = (s2 - s1 * s1 / cnt) / (cnt - 1.0)
+    var = np.where(cnt >= max(min_periods, 2), np.maximum(var, 0.0), np.nan)
+    return unpack(cube, np.sqrt(var))
+
+
+def rolling_slope(cube: Dict[str, Any], arr: np.ndarray, w: int = 8, min_valid: int = 4) -> np.ndarray:
+    """
+    ميل المربعات الصغرى على آخر w أسطر لكل بكسل (نفس slope_s_np في health بدون loop):
+    القيم الناقصة تتعوض بمتوسط النافذة، ولازم min_valid قيم صالحة على الأقل،
+    وأول w-1 أسطر من كل بكسل NaN.
+
+    مع التعويض بالمتوسط: cov(t, y) * w = Σ_valid t·y − (Σ_valid y / n)·Σ_valid t
+    وكل المجاميع تطلع من cumsum على محور الزمن (t = الترتيب داخل النافذة).
+    """
+    p = pack(cube, arr)
+    ok = np.isfinite(p)
+    y = np.where(ok, p, 0.0)
+    g = np.arange(p.shape[1], dtype=np.float64)[None, :]
+
+    n = _window_sums(ok.astype(np.float64), w)
+    s_y = _window_sums(y, w)
+    s_gy = _window_sums(g * y, w)
+    s_g = _window_sums(np.where(ok, g, 0.0), w)
+
+    start = g - (w - 1)
+    s_ty = s_gy - start * s_y
+    s_t = s_g - start * n
+
+    var_t = float(np.var(np.arange(w)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (s_ty - s_y / n * s_t) / w / (var_t + 1e-6)
+
+    valid = (n >= max(min_valid, w // 2)) & (start >= 0)
+    return unpack(cube, np.where(valid, slope, np.nan))
+
+
+def rolling_median(cube: Dict[str, Any], arr: np.ndarray, w: int, min_periods: int, chunk: int = 4096) -> np.ndarray:
+    """زي groupby(pixel).rolling(w, min_periods).median() — nanmedian على نوافذ sliding_window_view (دفعات بكسلات)."""
+    p = pack(cube, arr)
+    out = np.full(p.shape, np.nan, dtype=np.float64)
+    pad = np.full((p.shape[0], w - 1), np.nan, dtype=np.float64)
+    padded = np.concatenate([pad, p], axis=1)
+    for i in range(0, p.shape[0], chunk):
+        win = np.lib.stride_tricks.sliding_window_view(padded[i:i + chunk], w, axis=1)
+        cnt = np.isfinite(win).sum(axis=2)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            med = np.nanmedian(win, axis=2)
+        out[i:i + chunk] = np.where(cnt >= min_periods, med, np.nan)
+    return unpack(cube, out)
+
+
+def month_mean(cube: Dict[str, Any], arr: np.ndarray) -> np.ndarray:
+    """متوسط كل بكسل لكل شهر (زي groupby(site, x, y, month).transform('mean')) مفرود على الأسابيع."""
+    month = cube["dates"].month.to_numpy() - 1
+    onehot = np.zeros((len(month), 12), dtype=np.float64)
+    onehot[np.arange(len(month)), month] = 1.0
+
+    ok = np.isfinite(arr) & cube["present"]
+    s = np.where(ok, arr, 0.0) @ onehot
+    cnt = ok.astype(np.float64) @ onehot
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(cnt > 0, s / cnt, np.nan)
+    return mean[:, month]
+
+
+def pixel_quantile(cube: Dict[str, Any], arr: np.ndarray, q: float, min_valid: int) -> np.ndarray:
+    """quantile لكل بكسل على كل أسابيعه (NaN لو القيم الصالحة أقل من min_valid) مفرود على الأسابيع."""
+    vals = np.where(cube["present"], arr, np.nan)
+    n_ok = np.isfinite(vals).sum(axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        base = np.nanquantile(vals, q, axis=1)
+    base = np.where(n_ok >= min_valid, base, np.nan)
+    return np.repeat(base[:, None], arr.shape[1], axis=1)
+
+
+def pixel_count(cube: Dict[str, Any], mask: np.ndarray) -> np.ndarray:
+    """عدد الأسابيع اللي تحقق mask لكل بكسل، مفرود على الأسابيع."""
+    n = (mask & cube["present"]).sum(axis=1)
+    return np.repeat(n[:, None], mask.shape[1], axis=1)
@@ -0,0 +1,211 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from typing import List, Tuple
+
+import pandas as pd
+from google.cloud import storage
+
+
+OUT_ROOT = os.environ.get("HEALTH_OUT_ROOT", "/tmp/saaf_health")
+HISTORY_ROOT = os.path.join(OUT_ROOT, "pixel_history")
+HISTORY_ENABLED = os.environ.get("PIXEL_HISTORY_ENABLED", "1") == "1"
+
+# اختياري: نسخة دائمة على GCS (gs://bucket/prefix) لأن /tmp في Cloud Run يضيع مع كل instance
+HISTORY_GS_PREFIX = os.environ.get("PIXEL_HISTORY_GS_PREFIX", "").rstrip("/")
+# سقف النسخة المحلية (/tmp في Cloud Run = ذاكرة) — الأقدم استخداماً ينحذف، و GCS يبقى النسخة الدائمة
+HISTORY_MAX_MB = float(os.environ.get("PIXEL_HISTORY_MAX_MB", "256"))
+
+PIXELS_FILE = "pixels.parquet"
+WEEKS_FILE = "weeks.parquet"
+
+WEEK_COLUMNS = ["date", "canopy_temp", "s2_rows"]
+
+_LOCK = threading.Lock()
+
+
+def _gcs() -> storage.Client:
+    return storage.Client()
+
+
+def _parse_gs_uri(uri: str) -> Tuple[str, str]:
+    uri = uri.replace("gs://", "")
+    bucket, *parts = uri.split("/")
+    blob = "/".join(parts)
+    return bucket, blob
+
+
+def history_key(farm_id: str, polygon: List[Tuple[float, float]], stride: int = 1) -> str:
+    """
+    مفتاح السجل = farmId + hash للمضلع، عشان لو المستخدم عدّل حدود المزرعة نبدأ سجل جديد.
+    stride > 1 (عينة شبكية للمزارع الكبيرة) سجل منفصل — بكسلاته غير بكسلات التحليل الكامل.
+    """
+    poly_hash = hashlib.sha1(
+        json.dumps([[round(float(x), 7), round(float(y), 7)] for x, y in polygon]).encode("utf-8")
+    ).hexdigest()[:12]
+    return f"{farm_id}_{poly_hash}" if stride <= 1 else f"{farm_id}_{poly_hash}_s{int(stride)}"
+
+
+def _local_dir(key: str) -> str:
+    return os.path.join(HISTORY_ROOT, key)
+
+
+def _dir_stat(path: str) -> Tuple[float, int]:
+    """(آخر استخدام = mtime حق weeks.parquet, الحجم الكلي) لمجلد سجل واحد."""
+    mtime, size = 0.0, 0
+    for name in os.listdir(path):
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            continue
+        size += st.st_size
+        if name == WEEKS_FILE:
+            mtime = st.st_mtime
+    return mtime, size
+
+
+def _drop_stale(farm_id: str, key: str) -> int:
+    """
+    يحذف محلياً سجلات المزرعة بمفاتيح قديمة (المضلع تعدّل أو الـ stride تغيّر) — ما عاد أحد يقراها.
+    نسختها في GCS تبقى.
+    """
+    if not os.path.isdir(HISTORY_ROOT):
+        return 0
+    pattern = re.compile(rf"^{re.escape(farm_id)}_[0-9a-f]{{12}}(_s\d+)?$")
+    removed = 0
+    for name in os.listdir(HISTORY_ROOT):
+        if name != key and pattern.match(name):
+            shutil.rmtree(os.path.join(HISTORY_ROOT, name), ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def evict(keep: str = "") -> int:
+    """
+    يحذف مجلدات السجل الأقدم استخداماً لين يصير الحجم المحلي تحت HISTORY_MAX_MB (keep ما ينحذف).
+    اللي ينحذف وله نسخة في GCS يرجع ينسحب وقت الحاجة.
+    """
+    if not os.path.isdir(HISTORY_ROOT):
+        return 0
+    limit = int(HISTORY_MAX_MB * 1024 * 1024)
+    entries = []
+    for name in os.listdir(HISTORY_ROOT):
+        path = os.path.join(HISTORY_ROOT, name)
+        if os.path.isdir(path):
+            entries.append((*_dir_stat(path), name, path))
+    total = sum(size for _, size, _, _ in entries)
+    removed = 0
+    for _, size, name, path in sorted(entries):
+        if total <= limit:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
+
+
+def _pull_from_gcs(key: str) -> None:
+    if not HISTORY_GS_PREFIX:
+        return
+    bucket_name, prefix = _parse_gs_uri(f"{HISTORY_GS_PREFIX}/{key}")
+    bucket = _gcs().bucket(bucket_name)
+    os.makedirs(_local_dir(key), exist_ok=True)
+    for name in (PIXELS_FILE, WEEKS_FILE):
+        blob = bucket.blob(f"{prefix}/{name}")
+        if blob.exists():
+            blob.download_to_filename(os.path.join(_local_dir(key), name))
+
+
+def _push_to_gcs(key: str) -> None:
+    if not HISTORY_GS_PREFIX:
+        return
+    bucket_name, prefix = _parse_gs_uri(f"{HISTORY_GS_PREFIX}/{key}")
+    bucket = _gcs().bucket(bucket_name)
+    for name in (PIXELS_FILE, WEEKS_FILE):
+        path = os.path.join(_local_dir(key), name)
+        if os.path.exists(path):
+            bucket.blob(f"{prefix}/{name}").upload_from_filename(path)
+
+
+def _write_atomic(df: pd.DataFrame, path: str) -> None:
+    fd, tmp_path = tempfile.mkstemp(suffix=".parquet", dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_history(farm_id: str, polygon: List[Tuple[float, float]], stride: int = 1) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    يرجّع (pixels, weeks) المخزنة للمزرعة:
+    - pixels: نفس أعمدة بكسلات Sentinel-2 (long-form) للأسابيع المقفلة.
+    - weeks: سطر لكل أسبوع تم جلبه (date, canopy_temp, s2_rows) حتى لو ما كان فيه مشهد.
+    """
+    empty = (pd.DataFrame(), pd.DataFrame(columns=WEEK_COLUMNS))
+    if not HISTORY_ENABLED:
+        return empty
+
+    key = history_key(farm_id, polygon, stride)
+    weeks_path = os.path.join(_local_dir(key), WEEKS_FILE)
+    pixels_path = os.path.join(_local_dir(key), PIXELS_FILE)
+
+    try:
+        if not os.path.exists(weeks_path):
+            _pull_from_gcs(key)
+        if not os.path.exists(weeks_path):
+            return empty
+
+        weeks = pd.read_parquet(weeks_path)
+        pixels = pd.read_parquet(pixels_path) if os.path.exists(pixels_path) else pd.DataFrame()
+        os.utime(weeks_path, None)  # ترتيب الـ LRU في evict
+    except Exception as e:
+        print(f"[HISTORY] ERROR loading history for farm={farm_id}: {type(e).__name__}: {e}")
+        return empty
+
+    weeks["date"] = pd.to_datetime(weeks["date"]).dt.normalize()
+    if not pixels.empty:
+        pixels["date"] = pd.to_datetime(pixels["date"]).dt.normalize()
+
+    print(f"[HISTORY] farm={farm_id} loaded weeks={len(weeks)} pixels={len(pixels)}")
+    return pixels, weeks
+
+
+def save_history(
+    farm_id: str,
+    polygon: List[Tuple[float, float]],
+    pixels: pd.DataFrame,
+    weeks: pd.DataFrame,
+    stride: int = 1,
+) -> None:
+    """
+    يكتب السجل كامل (بعد ما ينضاف الجديد وتنحذف الأسابيع اللي طلعت من النافذة).
+    أي خطأ هنا ما يوقف التحليل — أسوأ شيء نعيد الجلب المرة الجاية.
+    """
+    if not HISTORY_ENABLED:
+        return
+
+    key = history_key(farm_id, polygon, stride)
+    try:
+        os.makedirs(_local_dir(key), exist_ok=True)
+        _write_atomic(pixels.reset_index(drop=True), os.path.join(_local_dir(key), PIXELS_FILE))
+        _write_atomic(weeks[WEEK_COLUMNS].reset_index(drop=True), os.path.join(_local_dir(key), WEEKS_FILE))
+        _push_to_gcs(key)
+        print(f"[HISTORY] farm={farm_id} saved weeks={len(weeks)} pixels={len(pixels)}")
+    except Exception as e:
+        print(f"[HISTORY] ERROR saving history for farm={farm_id}: {type(e).__name__}: {e}")
+        return
+
+    with _LOCK:
+        stale = _drop_stale(farm_id, key)
+        evicted = evict(keep=key)
+    if stale or evicted:
+        print(f"[HISTORY] farm={farm_id} dropped stale={stale} evicted={evicted}")
@@ -0,0 +1,95 @@
+import json
+import time
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+# التشغيل الحالي (مثلاً طلب /analyze واحد): {"stages": [...]} — None يعني المراحل تنطبع في اللوق بس
+_RUN: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("health_profile_run", default=None)
+# المراحل المفتوحة حالياً (من الخارج للداخل) — طلب EE ينحسب لكل المراحل المفتوحة
+_STACK: contextvars.ContextVar[tuple] = contextvars.ContextVar("health_profile_stack", default=())
+
+
+def _rss_mb() -> Optional[float]:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except Exception:
+        return None
+
+
+def start_run(**meta) -> contextvars.Token:
+    """يبدأ تجميع المراحل للطلب الحالي. لازم يتقفل بـ finish_run(token)."""
+    return _RUN.set({"meta": meta, "stages": [], "t0": time.perf_counter()})
+
+
+def finish_run(token: contextvars.Token) -> Dict[str, Any]:
+    """يقفل التشغيل ويرجّع {"total_s", "ee_calls", "stages": [...]} (جاهز للـ JSON)."""
+    run = _RUN.get() or {"meta": {}, "stages": [], "t0": time.perf_counter()}
+    try:
+        _RUN.reset(token)
+    except (ValueError, RuntimeError):
+        pass  # اتقفل قبل (مسار خطأ بعد الرد)
+    stages: List[Dict[str, Any]] = list(run["stages"])
+    out = {
+        **run["meta"],
+        "total_s": round(time.perf_counter() - run["t0"], 3),
+        "ee_calls": sum(s["ee_calls"] for s in stages if not s.get("parent")),
+        "stages": stages,
+    }
+    print(f"[PROFILE] {json.dumps({'event': 'run', **{k: v for k, v in out.items() if k != 'stages'}}, default=str)}")
+    return out
+
+
+def count_ee_call(n: int = 1) -> None:
+    """ينادى مع كل طلب EE/شبكة (ee_executor.call_with_retry)."""
+    for rec in _STACK.get():
+        rec["ee_calls"] += n
+
+
+@contextmanager
+def stage(name: str, **meta) -> Iterator[Dict[str, Any]]:
+    """
+    يقيس مرحلة: wall time + عدد طلبات EE + الأسطر + فرق RSS، ويطبعها كسطر JSON.
+    المهام المرسلة لـ ee_executor من داخل المرحلة تورث السياق (contextvars) فطلباتها تنحسب عليها.
+    """
+    stack = _STACK.get()
+    rec: Dict[str, Any] = {"stage": name, "ee_calls": 0, "rows": None, **meta}
+    if stack:
+        rec["parent"] = stack[-1]["stage"]
+    token = _STACK.set(stack + (rec,))
+    rss0 = _rss_mb()
+    t0 = time.perf_counter()
+    try:
+        yield rec
+    except Exception as e:
+        rec["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        rec["wall_s"] = round(time.perf_counter() - t0, 4)
+        rss1 = _rss_mb()
+        rec["rss_mb"] = None if rss1 is None else round(rss1, 1)
+        rec["rss_delta_mb"] = None if rss0 is None or rss1 is None else round(rss1 - rss0, 1)
+        _STACK.reset(token)
+
+        run = _RUN.get()
+        if run is not None:
+            run["stages"].append(rec)
+        print(f"[PROFILE] {json.dumps({'event': 'stage', **rec}, default=str)}")
+
+
+def staged(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """decorator: الدالة كلها مرحلة وحدة، والأسطر = طول الناتج (DataFrame/list) أو أول عنصر لو tuple."""
+    def deco(fn: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name) as rec:
+                out = fn(*args, **kwargs)
+                first = out[0] if isinstance(out, tuple) and out else out
+                if hasattr(first, "__len__") and not isinstance(first, (str, bytes)):
+                    rec["rows"] = len(first)
+                return out
+        return wrapper
+    return deco
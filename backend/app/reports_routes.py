@@ -13,6 +13,7 @@ from google.cloud import firestore
 from openpyxl.chart.label import DataLabelList
 from openpyxl.chart import PieChart
 from app.health import prepare_export_data
+from app import weather_store
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -1956,47 +1957,9 @@ def _get_report_weather_live(farm_data: dict) -> dict:
     logger.info("Weather debug | centroid lat=%s lng=%s", lat, lng)
 
     try:
-        end_dt = datetime.utcnow().date()
-        start_dt = end_dt - __import__("datetime").timedelta(days=7)
-
-        rows = []
-        current = start_dt
-
-        while current <= end_dt:
-            d = current.strftime("%Y-%m-%d")
-            url = "https://api.weatherapi.com/v1/history.json"
-            params = {
-                "key": WEATHERAPI_KEY,
-                "q": f"{lat},{lng}",
-                "dt": d,
-            }
-
-            resp = requests.get(url, params=params, timeout=20)
-            logger.info("WeatherAPI request | date=%s | status=%s", d, resp.status_code)
-
-            if resp.status_code != 200:
-                logger.error("WeatherAPI failed | date=%s | body=%s", d, resp.text[:500])
-                resp.raise_for_status()
-
-            data = resp.json()
-            day = ((data.get("forecast") or {}).get("forecastday") or [{}])[0].get("day", {})
-
-            rows.append({
-                "precip_mm": float(day.get("totalprecip_mm", 0) or 0),
-                "t2m_mean": float(day.get("avgtemp_c", 0) or 0),
-            })
-
-            current += __import__("datetime").timedelta(days=1)
-
-        if not rows:
-            logger.error("WeatherAPI returned no rows")
-            return {"rain_mm": 0.0, "t_mean": 0.0}
-
-        rain_mm = round(sum(r["precip_mm"] for r in rows), 1)
-        t_mean = round(sum(r["t2m_mean"] for r in rows) / len(rows), 1)
-
-        logger.info("Live WeatherAPI success | rain_mm=%s | t_mean=%s", rain_mm, t_mean)
-        return {"rain_mm": rain_mm, "t_mean": t_mean}
+        res = weather_store.weatherapi_summary(lat, lng, WEATHERAPI_KEY, n_days=7)
+        logger.info("Live WeatherAPI success | rain_mm=%s | t_mean=%s", res["rain_mm"], res["t_mean"])
+        return res
 
     except Exception:
         logger.error("Live WeatherAPI crashed:\n%s", traceback.format_exc())
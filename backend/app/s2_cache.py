@@ -0,0 +1,182 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+
+OUT_ROOT = os.environ.get("HEALTH_OUT_ROOT", "/tmp/saaf_health")
+CACHE_ROOT = os.path.join(OUT_ROOT, "s2_cache")
+S2_CACHE_ENABLED = os.environ.get("S2_CACHE_ENABLED", "1") == "1"
+S2_CACHE_MAX_MB = float(os.environ.get("S2_CACHE_MAX_MB", "512"))
+
+# غيّره لو تغيّر شكل/حساب جدول البكسلات عشان المفاتيح القديمة ما تنقرأ
+CACHE_VERSION = "v1"
+
+DATA_SUFFIX = ".parquet"
+EMPTY_SUFFIX = ".empty"   # أسبوع مقفل ما فيه أي مشهد/بكسل صالح
+# .empty حجمها 0 بس كل ملف ياخذ inode وصفحة في tmpfs — ينحسب بحجم اسمي عشان العلامات ما تكبر بدون سقف
+EMPTY_NOMINAL_BYTES = 4096
+
+_STATS = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+_LOCK = threading.Lock()
+# الحجم الكلي بالذاكرة (None = ما انحسب بعد) — put يزيده، و evict يمشي على المجلد بس لو تعدّى السقف
+_TOTAL: Optional[int] = None
+
+
+def cache_key(
+    polygon: List[Tuple[float, float]],
+    wstart: pd.Timestamp,
+    max_cloud: float,
+    resolution: float,
+    collection: str,
+    stride: int = 1,
+) -> str:
+    """
+    مفتاح المحتوى: hash لكل شيء يأثر على نتيجة الأسبوع (المضلع، بداية الأسبوع، MAX_CLOUD، الدقة، الـ collection،
+    وخطوة شبكة العينة لو المزرعة أكبر من ميزانية البكسلات).
+    """
+    payload = {
+        "v": CACHE_VERSION,
+        "poly": [[round(float(x), 7), round(float(y), 7)] for x, y in polygon],
+        "week": pd.to_datetime(wstart).normalize().date().isoformat(),
+        "max_cloud": float(max_cloud),
+        "resolution": float(resolution),
+        "collection": collection,
+    }
+    if stride > 1:
+        payload["stride"] = int(stride)
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _path(key: str, suffix: str) -> str:
+    return os.path.join(CACHE_ROOT, key[:2], key + suffix)
+
+
+def _file_size(path: str) -> int:
+    try:
+        size = os.stat(path).st_size
+    except OSError:
+        return 0
+    return max(size, EMPTY_NOMINAL_BYTES) if path.endswith(EMPTY_SUFFIX) else size
+
+
+def _bump(name: str, n: int = 1) -> None:
+    with _LOCK:
+        _STATS[name] += n
+
+
+def get(key: str) -> Tuple[bool, Optional[pd.DataFrame]]:
+    """
+    يرجّع (found, df). found=True و df=None يعني الأسبوع مخزّن كأسبوع فاضي.
+    أي قراءة ناجحة تحدّث mtime (هو ترتيب الـ LRU).
+    """
+    if not S2_CACHE_ENABLED:
+        return False, None
+
+    for suffix in (DATA_SUFFIX, EMPTY_SUFFIX):
+        path = _path(key, suffix)
+        if not os.path.exists(path):
+            continue
+        try:
+            df = pd.read_parquet(path) if suffix == DATA_SUFFIX else None
+            os.utime(path, None)
+        except Exception as e:
+            print(f"[S2CACHE] ERROR reading {path}: {type(e).__name__}: {e}")
+            break
+        _bump("hits")
+        return True, df
+
+    _bump("misses")
+    return False, None
+
+
+def put(key: str, df: Optional[pd.DataFrame]) -> None:
+    if not S2_CACHE_ENABLED:
+        return
+
+    path = _path(key, EMPTY_SUFFIX if df is None or df.empty else DATA_SUFFIX)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        before = _file_size(path)
+        if df is None or df.empty:
+            with open(path, "w"):
+                pass
+        else:
+            fd, tmp_path = tempfile.mkstemp(suffix=DATA_SUFFIX, dir=os.path.dirname(path))
+            os.close(fd)
+            try:
+                df.reset_index(drop=True).to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        _bump("writes")
+    except Exception as e:
+        print(f"[S2CACHE] ERROR writing key={key[:12]}: {type(e).__name__}: {e}")
+        return
+
+    global _TOTAL
+    with _LOCK:
+        if _TOTAL is None:
+            _TOTAL = sum(size for _, size, _ in _entries())
+        else:
+            _TOTAL += _file_size(path) - before
+        over = _TOTAL > int(S2_CACHE_MAX_MB * 1024 * 1024)
+    if over:
+        evict()
+
+
+def _entries() -> List[Tuple[float, int, str]]:
+    out = []
+    if not os.path.isdir(CACHE_ROOT):
+        return out
+    for root, _, files in os.walk(CACHE_ROOT):
+        for name in files:
+            if not (name.endswith(DATA_SUFFIX) or name.endswith(EMPTY_SUFFIX)):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            size = max(st.st_size, EMPTY_NOMINAL_BYTES) if name.endswith(EMPTY_SUFFIX) else st.st_size
+            out.append((st.st_mtime, size, path))
+    return out
+
+
+def evict() -> int:
+    """
+    يحذف الأقدم استخداماً (mtime) لين يصير الحجم الكلي تحت 90% من S2_CACHE_MAX_MB
+    (الهامش عشان كل put بعدها ما يرجع يمشي على المجلد).
+    يمشي على المجلد كامل — put يناديه بس لما _TOTAL يتعدّى السقف، ويعيد ضبط _TOTAL من الحجم الفعلي.
+    """
+    global _TOTAL
+    limit = int(S2_CACHE_MAX_MB * 1024 * 1024 * 0.9)
+    with _LOCK:
+        entries = _entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        _TOTAL = total
+        _STATS["evictions"] += removed
+    return removed
+
+
+def stats() -> Dict[str, Any]:
+    with _LOCK:
+        out: Dict[str, Any] = dict(_STATS)
+    lookups = out["hits"] + out["misses"]
+    out["hit_rate"] = round(out["hits"] / lookups, 3) if lookups else 0.0
+    return out
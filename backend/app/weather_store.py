@@ -0,0 +1,385 @@
+import os
+import json
+import tempfile
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+
+OUT_ROOT = os.environ.get("HEALTH_OUT_ROOT", "/tmp/saaf_health")
+ERA5_ROOT = os.path.join(OUT_ROOT, "weather_era5")
+
+# شبكة ERA5 = 0.25° — كل المزارع اللي بنفس الخلية تشارك نفس الملف ونفس الطلب
+ERA5_CELL_DEG = 0.25
+# الأيام الأحدث من كذا ممكن تنعاد (ERA5T / قيم فاضية) فما نخزنها، تنجلب كل مرة
+ERA5_FINAL_LAG_DAYS = int(os.environ.get("ERA5_FINAL_LAG_DAYS", "7"))
+
+ERA5_URL = "https://archive-api.open-meteo.com/v1/era5"
+ERA5_DAILY_VARS = [
+    "precipitation_sum",
+    "temperature_2m_mean",
+    "temperature_2m_max",
+    "temperature_2m_min",
+    "shortwave_radiation_sum",
+    "wind_speed_10m_mean",
+    "relative_humidity_2m_mean",
+    "dew_point_2m_mean",
+]
+DAILY_COLUMNS = [
+    "date", "precip_mm", "t2m_mean", "t2m_max", "t2m_min",
+    "ssrd_MJ", "wind10_ms", "rh2m_mean", "vpd_kPa",
+]
+
+WEATHERAPI_ROOT = os.path.join(OUT_ROOT, "weatherapi_history")
+WEATHERAPI_URL = "https://api.weatherapi.com/v1/history.json"
+# تقريب الموقع (2 خانات ≈ 1 كم) — مزارع نفس المنطقة تشارك نفس الأيام المخزنة
+WEATHERAPI_LOC_DECIMALS = int(os.environ.get("WEATHERAPI_LOC_DECIMALS", "2"))
+WEATHERAPI_TIMEOUT_S = float(os.environ.get("WEATHERAPI_TIMEOUT_S", "20"))
+# طبقة retry وحدة (جلسة WeatherAPI) — بدون retry الـ executor فوقها، عشان التقرير له حد زمني معروف
+WEATHERAPI_RETRIES = int(os.environ.get("WEATHERAPI_RETRIES", "2"))
+WEATHERAPI_BACKOFF_S = 0.5
+# pool خاص بـ WeatherAPI (صغير) — ما يوقف بطابور مهام GEE وقت الجدولة
+WEATHERAPI_CONCURRENCY = int(os.environ.get("WEATHERAPI_CONCURRENCY", "4"))
+
+_session: Optional[requests.Session] = None
+_SESSION_LOCK = threading.Lock()
+
+_wapi_session: Optional[requests.Session] = None
+_WAPI_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_WAPI_LOCK = threading.Lock()
+
+_CELL_LOCKS: Dict[str, threading.Lock] = {}
+_CELL_LOCKS_GUARD = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _SESSION_LOCK:
+            if _session is None:
+                s = requests.Session()
+                retries = Retry(
+                    total=6,
+                    backoff_factor=0.8,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                )
+                adapter = HTTPAdapter(max_retries=retries)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                _session = s
+    return _session
+
+
+def _get_wapi_session() -> requests.Session:
+    global _wapi_session
+    if _wapi_session is None:
+        with _WAPI_LOCK:
+            if _wapi_session is None:
+                s = requests.Session()
+                retries = Retry(
+                    total=WEATHERAPI_RETRIES,
+                    backoff_factor=WEATHERAPI_BACKOFF_S,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    respect_retry_after_header=False,
+                )
+                adapter = HTTPAdapter(max_retries=retries, pool_maxsize=max(1, WEATHERAPI_CONCURRENCY))
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                _wapi_session = s
+    return _wapi_session
+
+
+def _get_wapi_executor() -> ThreadPoolExecutor:
+    global _WAPI_EXECUTOR
+    if _WAPI_EXECUTOR is None:
+        with _WAPI_LOCK:
+            if _WAPI_EXECUTOR is None:
+                _WAPI_EXECUTOR = ThreadPoolExecutor(
+                    max_workers=max(1, WEATHERAPI_CONCURRENCY),
+                    thread_name_prefix="wapi",
+                )
+    return _WAPI_EXECUTOR
+
+
+def _wapi_wait_s() -> float:
+    # أسوأ حالة لطلب واحد: كل المحاولات تاخذ المهلة كاملة + backoff بينها
+    attempts = WEATHERAPI_RETRIES + 1
+    backoff = sum(WEATHERAPI_BACKOFF_S * (2 ** i) for i in range(WEATHERAPI_RETRIES))
+    return WEATHERAPI_TIMEOUT_S * attempts + backoff
+
+
+def snap_cell(lat: float, lon: float, deg: float = ERA5_CELL_DEG) -> Tuple[float, float]:
+    return round(round(float(lat) / deg) * deg, 4), round(round(float(lon) / deg) * deg, 4)
+
+
+def _cell_key(lat: float, lon: float) -> str:
+    return f"{lat:.2f}_{lon:.2f}"
+
+
+def _cell_lock(key: str) -> threading.Lock:
+    with _CELL_LOCKS_GUARD:
+        if key not in _CELL_LOCKS:
+            _CELL_LOCKS[key] = threading.Lock()
+        return _CELL_LOCKS[key]
+
+
+def _cell_path(key: str) -> str:
+    return os.path.join(ERA5_ROOT, f"era5_{key}.parquet")
+
+
+def _es_kPa(Tc):
+    return 0.6108 * np.exp((17.27 * Tc) / (Tc + 237.3))
+
+
+def _fetch_era5_daily(lat: float, lon: float, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+    """
+    طلب Open-Meteo ERA5 لأيام [start, end] ويرجّع أعمدة DAILY_COLUMNS (مع rh2m_mean و vpd_kPa المشتقة).
+    """
+    params = {
+        "latitude": float(lat),
+        "longitude": float(lon),
+        "start_date": str(pd.to_datetime(start).date()),
+        "end_date":   str(pd.to_datetime(end).date()),
+        "daily": ",".join(ERA5_DAILY_VARS),
+        "timezone": "UTC",
+    }
+    r = _get_session().get(ERA5_URL, params=params, timeout=60)
+    r.raise_for_status()
+    js = r.json()
+    if "daily" not in js or not js["daily"].get("time"):
+        return pd.DataFrame(columns=DAILY_COLUMNS)
+
+    daily = pd.DataFrame(js["daily"])
+    daily["date"] = pd.to_datetime(daily["time"]).dt.normalize()
+
+    if "relative_humidity_2m_mean" in daily.columns:
+        daily["rh2m_mean"] = daily["relative_humidity_2m_mean"]
+    elif "dew_point_2m_mean" in daily.columns:
+        t = daily["temperature_2m_mean"].astype(float)
+        d = daily["dew_point_2m_mean"].astype(float)
+        es = 6.112 * np.exp((17.67 * t) / (t + 243.5))
+        e = 6.112 * np.exp((17.67 * d) / (d + 243.5))
+        daily["rh2m_mean"] = 100.0 * (e / (es + 1e-6))
+    else:
+        daily["rh2m_mean"] = np.nan
+
+    if "dew_point_2m_mean" in daily.columns:
+        t_C = daily["temperature_2m_mean"].astype(float)
+        d_C = daily["dew_point_2m_mean"].astype(float)
+        daily["vpd_kPa"] = _es_kPa(t_C) - _es_kPa(d_C)
+    else:
+        daily["vpd_kPa"] = np.nan
+
+    daily = daily.rename(columns={
+        "precipitation_sum": "precip_mm",
+        "temperature_2m_mean": "t2m_mean",
+        "temperature_2m_max": "t2m_max",
+        "temperature_2m_min": "t2m_min",
+        "shortwave_radiation_sum": "ssrd_MJ",
+        "wind_speed_10m_mean": "wind10_ms",
+    })
+    for c in DAILY_COLUMNS:
+        if c not in daily.columns:
+            daily[c] = np.nan
+    return daily[DAILY_COLUMNS]
+
+
+def _load_cell(key: str) -> pd.DataFrame:
+    path = _cell_path(key)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=DAILY_COLUMNS)
+    try:
+        df = pd.read_parquet(path)
+    except Exception as e:
+        print(f"[WEATHER] ERROR reading {path}: {type(e).__name__}: {e}")
+        return pd.DataFrame(columns=DAILY_COLUMNS)
+    df["date"] = pd.to_datetime(df["date"]).dt.normalize()
+    return df
+
+
+def _save_cell(key: str, df: pd.DataFrame) -> None:
+    path = _cell_path(key)
+    try:
+        os.makedirs(ERA5_ROOT, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".parquet", dir=ERA5_ROOT)
+        os.close(fd)
+        try:
+            df.reset_index(drop=True).to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    except Exception as e:
+        print(f"[WEATHER] ERROR writing {path}: {type(e).__name__}: {e}")
+
+
+def _missing_runs(days: pd.DatetimeIndex) -> List[Tuple[pd.Timestamp, pd.Timestamp]]:
+    """يقسم الأيام الناقصة لفترات متصلة — كل فترة = طلب واحد."""
+    runs: List[Tuple[pd.Timestamp, pd.Timestamp]] = []
+    for d in days.sort_values():
+        if runs and d - runs[-1][1] == pd.Timedelta(days=1):
+            runs[-1] = (runs[-1][0], d)
+        else:
+            runs.append((d, d))
+    return runs
+
+
+def daily_weather(lat: float, lon: float, start, end, today: Optional[pd.Timestamp] = None) -> Optional[pd.DataFrame]:
+    """
+    طقس يومي (DAILY_COLUMNS) لخلية ERA5 اللي فيها (lat, lon) للفترة [start, end].
+    الأيام المخزنة تنقرأ من الملف، والناقصة بس تنطلب من Open-Meteo؛ الأيام المكتملة
+    (أقدم من ERA5_FINAL_LAG_DAYS) تنضاف للملف وما تنطلب مرة ثانية.
+    يرجّع None لو ما قدرنا نجيب ولا يوم.
+    """
+    start = pd.to_datetime(start).normalize()
+    end = pd.to_datetime(end).normalize()
+    if today is None:
+        today = pd.Timestamp.now(tz="UTC").tz_localize(None).normalize()
+    final_cutoff = today - pd.Timedelta(days=ERA5_FINAL_LAG_DAYS)
+
+    cell_lat, cell_lon = snap_cell(lat, lon)
+    key = _cell_key(cell_lat, cell_lon)
+
+    with _cell_lock(key):
+        stored = _load_cell(key)
+        needed = pd.date_range(start, end, freq="D")
+        missing = needed.difference(pd.DatetimeIndex(stored["date"]))
+
+        fetched = []
+        for run_from, run_to in _missing_runs(missing):
+            try:
+                fetched.append(_fetch_era5_daily(cell_lat, cell_lon, run_from, run_to))
+            except Exception as e:
+                print(f"[WEATHER] ERROR fetching ERA5 cell={key} {run_from.date()}..{run_to.date()}: {type(e).__name__}: {e}")
+
+        fresh = [f for f in fetched if not f.empty]
+        new = pd.concat(fresh, ignore_index=True) if fresh else pd.DataFrame(columns=DAILY_COLUMNS)
+        new_final = new[(new["date"] <= final_cutoff) & new["t2m_mean"].notna()]
+        if not new_final.empty:
+            parts = [p for p in (stored, new_final) if not p.empty]
+            merged = pd.concat(parts, ignore_index=True)
+            merged = merged.drop_duplicates("date", keep="last").sort_values("date")
+            _save_cell(key, merged)
+
+    print(f"[WEATHER] cell={key} days={len(needed)} stored_hit={len(needed) - len(missing)} "
+          f"fetched={len(new)} appended={len(new_final)}")
+
+    parts = [p for p in (stored, new) if not p.empty]
+    if not parts:
+        return None
+    out = pd.concat(parts, ignore_index=True).drop_duplicates("date", keep="last")
+    out = out[(out["date"] >= start) & (out["date"] <= end)].sort_values("date")
+    return out.reset_index(drop=True) if not out.empty else None
+
+
+# ──────────────────────────────────────────────
+# WeatherAPI history (طقس آخر أيام للتقارير)
+# ──────────────────────────────────────────────
+
+def _wapi_key(lat: float, lon: float) -> Tuple[float, float, str]:
+    lat_r = round(float(lat), WEATHERAPI_LOC_DECIMALS)
+    lon_r = round(float(lon), WEATHERAPI_LOC_DECIMALS)
+    return lat_r, lon_r, f"{lat_r:.{WEATHERAPI_LOC_DECIMALS}f}_{lon_r:.{WEATHERAPI_LOC_DECIMALS}f}"
+
+
+def _wapi_path(key: str) -> str:
+    return os.path.join(WEATHERAPI_ROOT, f"wapi_{key}.json")
+
+
+def _load_wapi_days(key: str) -> Dict[str, Dict[str, float]]:
+    path = _wapi_path(key)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"[WEATHER] ERROR reading {path}: {type(e).__name__}: {e}")
+        return {}
+
+
+def _save_wapi_days(key: str, days: Dict[str, Dict[str, float]]) -> None:
+    path = _wapi_path(key)
+    try:
+        os.makedirs(WEATHERAPI_ROOT, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".json", dir=WEATHERAPI_ROOT)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(days, f, sort_keys=True)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    except Exception as e:
+        print(f"[WEATHER] ERROR writing {path}: {type(e).__name__}: {e}")
+
+
+def _fetch_weatherapi_day(lat: float, lon: float, day: str, api_key: str) -> Dict[str, float]:
+    params = {
+        "key": api_key,
+        "q": f"{lat},{lon}",
+        "dt": day,
+    }
+    r = _get_wapi_session().get(WEATHERAPI_URL, params=params, timeout=WEATHERAPI_TIMEOUT_S)
+    r.raise_for_status()
+    data = r.json()
+
+    d = ((data.get("forecast") or {}).get("forecastday") or [{}])[0].get("day", {})
+    return {
+        "precip_mm": float(d.get("totalprecip_mm", 0) or 0),
+        "t2m_mean": float(d.get("avgtemp_c", 0) or 0),
+    }
+
+
+def weatherapi_history(lat: float, lon: float, api_key: str, n_days: int = 7, today=None) -> pd.DataFrame:
+    """
+    طقس WeatherAPI اليومي من (اليوم - n_days) لليوم (شامل) للموقع بعد التقريب.
+    الأيام الماضية المكتملة تنخزن دايم، فالطلب الحي الوحيد عادةً هو "اليوم".
+    الأيام الناقصة تنطلب بالتوازي (pool خاص بـ WeatherAPI)، وأي يوم يفشل يرفع الخطأ للمستدعي.
+    """
+    if today is None:
+        today = pd.Timestamp.now(tz="UTC").tz_localize(None).normalize()
+    today = pd.to_datetime(today).normalize()
+    days = [d.strftime("%Y-%m-%d") for d in pd.date_range(today - pd.Timedelta(days=n_days), today, freq="D")]
+    today_s = today.strftime("%Y-%m-%d")
+
+    lat_r, lon_r, key = _wapi_key(lat, lon)
+    with _cell_lock(f"wapi_{key}"):
+        stored = _load_wapi_days(key)
+
+    missing = [d for d in days if d not in stored or d >= today_s]
+    ex = _get_wapi_executor()
+    futures = [ex.submit(_fetch_weatherapi_day, lat_r, lon_r, d, api_key) for d in missing]
+    # الأيام تنطلب مع بعض (حتى WEATHERAPI_CONCURRENCY)، فالانتظار الكلي ≈ أسوأ طلب × عدد الموجات
+    deadline = time.monotonic() + _wapi_wait_s() * -(-max(len(missing), 1) // max(1, WEATHERAPI_CONCURRENCY))
+    fetched = [f.result(timeout=max(0.0, deadline - time.monotonic())) for f in futures]
+    got = dict(zip(missing, fetched))
+
+    past = {d: v for d, v in got.items() if d < today_s}
+    if past:
+        with _cell_lock(f"wapi_{key}"):
+            merged = _load_wapi_days(key)
+            merged.update(past)
+            _save_wapi_days(key, merged)
+
+    print(f"[WEATHER] weatherapi loc={key} days={len(days)} cached={len(days) - len(missing)} fetched={len(missing)}")
+
+    rows = [{"date": d, **(got.get(d) or stored[d])} for d in days]
+    return pd.DataFrame(rows)
+
+
+def weatherapi_summary(lat: float, lon: float, api_key: str, n_days: int = 7) -> Dict[str, float]:
+    """ملخص التقرير: مجموع المطر ومتوسط الحرارة لآخر n_days + اليوم."""
+    df = weatherapi_history(lat, lon, api_key, n_days=n_days)
+    if df.empty:
+        return {"rain_mm": 0.0, "t_mean": 0.0}
+    return {
+        "rain_mm": round(float(df["precip_mm"].sum()), 1),
+        "t_mean": round(float(df["t2m_mean"].mean()), 1),
+    }
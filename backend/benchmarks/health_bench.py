@@ -0,0 +1,244 @@
+"""
+قياس أداء مراحل تحليل الصحة بدون GEE (بيانات بكسلات صناعية).
+
+التشغيل من مجلد backend:
+    python benchmarks/health_bench.py --sizes 1000,10000 --out bench_health.json
+    python benchmarks/health_bench.py --sizes 100000 --no-memory
+
+لكل حجم مزرعة (بكسلات × أسابيع) يطلع لكل مرحلة: wall time و peak memory (tracemalloc) وعدد الأسطر الخارجة.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import contextlib
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import joblib
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# app.health يهيّئ Earth Engine عند أول استخدام فقط، والمراحل اللي نقيسها ما تلمس GEE
+from app import health, pixel_cube  # noqa: E402
+
+
+SITE = "bench_farm"
+LON0, LAT0 = 46.70, 24.60
+PIXEL_DEG = 0.0001            # ~10 م (نفس RESOLUTION)
+START = pd.Timestamp("2025-01-06")   # اثنين
+
+NO_SCENE_P = 0.25      # أسبوع كامل بدون مشهد صالح
+CLOUD_BLOB_P = 0.30    # أسبوع فيه غيمة تغطي جزء من المزرعة
+VALUE_NAN_P = 0.01     # قيم ناقصة متفرقة داخل المؤشرات
+STRESSED_P = 0.03      # بكسلات فيها تدهور بآخر الأسابيع
+LST_P = 0.35           # نسبة الأسابيع اللي فيها قيمة Landsat
+
+
+def _load_models() -> None:
+    """يحمّل نموذج IF والمتوسطات من ملفات backend بدل GCS."""
+    health._IF_MODEL = joblib.load(os.path.join(BACKEND_DIR, "if_baseline_model.joblib"))
+    health._IF_FEATURE_MEANS = {
+        str(k): float(v)
+        for k, v in joblib.load(os.path.join(BACKEND_DIR, "if_feature_means.joblib")).items()
+    }
+
+
+def synthetic_pixels(n_pixels: int, n_weeks: int = 52, seed: int = 0) -> pd.DataFrame:
+    """
+    جدول طويل بنفس شكل df_all قبل add_features (بكسلات S2 + طقس + canopy_temp):
+    - منحنى موسمي لكل بكسل (طور وإزاحة عشوائية) + ضجيج.
+    - أسابيع كاملة ناقصة (ما فيه مشهد) + غيوم دائرية تشيل مجموعة بكسلات متجاورة.
+    - قيم NaN متفرقة + بكسلات متدهورة في آخر 8 أسابيع (عشان يطلع Monitor/Critical).
+    """
+    rng = np.random.default_rng(seed)
+
+    side = int(np.ceil(np.sqrt(n_pixels)))
+    ix = np.arange(n_pixels) % side
+    iy = np.arange(n_pixels) // side
+    x = LON0 + ix * PIXEL_DEG
+    y = LAT0 + iy * PIXEL_DEG
+
+    dates = pd.DatetimeIndex([START + pd.Timedelta(weeks=i) for i in range(n_weeks)])
+    doy = dates.dayofyear.to_numpy()[None, :]
+
+    # وجود البكسل بكل أسبوع (SCL mask يشيل البكسل من العينة)
+    present = np.ones((n_pixels, n_weeks), dtype=bool)
+    present[:, rng.random(n_weeks) < NO_SCENE_P] = False
+    for w in np.flatnonzero(rng.random(n_weeks) < CLOUD_BLOB_P):
+        cx, cy = rng.uniform(0, side, 2)
+        r = rng.uniform(0.1, 0.5) * side
+        present[((ix - cx) ** 2 + (iy - cy) ** 2) < r * r, w] = False
+
+    phase = rng.normal(0.0, 0.3, (n_pixels, 1))
+    season = np.sin(2 * np.pi * doy / 365.0 + phase)
+    vigour = rng.normal(0.0, 0.05, (n_pixels, 1))
+    wet = np.sin(2 * np.pi * doy / 365.0 + phase + 1.0)
+
+    ndvi = 0.38 + 0.10 * season + vigour + rng.normal(0, 0.02, present.shape)
+    ndmi = 0.07 + 0.06 * wet + 0.5 * vigour + rng.normal(0, 0.02, present.shape)
+
+    stressed = rng.random(n_pixels) < STRESSED_P
+    decline = np.clip((np.arange(n_weeks) - (n_weeks - 8)) / 8.0, 0, 1)[None, :]
+    ndvi[stressed] *= 1.0 - 0.5 * decline
+    ndmi[stressed] -= 0.15 * decline
+
+    noise = lambda s: rng.normal(0, s, present.shape)  # noqa: E731
+    cols = {
+        "NDVI": ndvi,
+        "GNDVI": 0.85 * ndvi + 0.05 + noise(0.01),
+        "NDRE": 0.65 * ndvi + noise(0.01),
+        "NDRE740": 0.40 * ndvi + noise(0.01),
+        "MTCI": 1.0 + 4.0 * ndvi + noise(0.1),
+        "NDMI": ndmi,
+        "NDWI_Gao": ndmi,
+        "SIWSI1": ndmi,
+        "SIWSI2": ndmi + 0.02 + noise(0.01),
+        "SRWI": (1 + ndmi) / (1 - ndmi),
+        "NMDI": 0.69 + 0.3 * ndmi + noise(0.01),
+    }
+    for arr in cols.values():
+        arr[rng.random(present.shape) < VALUE_NAN_P] = np.nan
+
+    p_idx, w_idx = np.nonzero(present)
+    df = pd.DataFrame({
+        "x": x[p_idx],
+        "y": y[p_idx],
+        **{name: arr[p_idx, w_idx] for name, arr in cols.items()},
+    })
+    df["site"] = SITE
+    df["date"] = dates[w_idx]
+    df = pixel_cube.add_pixel_id(df)
+
+    wk = pd.DataFrame({"site": SITE, "date": dates})
+    t = 30.0 + 10.0 * np.sin(2 * np.pi * dates.dayofyear.to_numpy() / 365.0 - 1.3)
+    wk["precip_mm"] = np.where(rng.random(n_weeks) < 0.15, rng.gamma(2.0, 4.0, n_weeks), 0.0)
+    wk["t2m_mean"] = t
+    wk["t2m_max"] = t + 7.0
+    wk["t2m_min"] = t - 8.0
+    wk["ssrd_MJ"] = 150.0 + 30.0 * np.sin(2 * np.pi * dates.dayofyear.to_numpy() / 365.0 - 1.3)
+    wk["wind10_ms"] = rng.uniform(2, 6, n_weeks)
+    wk["vpd_kPa"] = rng.uniform(1, 5, n_weeks)
+    wk["rh2m_mean"] = rng.uniform(10, 50, n_weeks)
+    wk["wx_source"] = "OpenMeteo_ERA5"
+    wk["canopy_temp"] = np.where(rng.random(n_weeks) < LST_P, t + rng.normal(3, 2, n_weeks), np.nan)
+
+    return df.merge(wk, on=["site", "date"], how="left")
+
+
+# مراحل البكسلات نفسها اللي في الإنتاج (health.PIXEL_STAGES: (df, series) → (df, series))،
+# وبعدها مراحل التقرير اللي تاخذ df_all الأخير وما يكمل عليها شي
+REPORT_STAGES: List[Tuple[str, Callable[[pd.DataFrame], Any]]] = [
+    ("build_alert_signals", health.build_alert_signals),
+    ("get_health_map_points", health.get_health_map_points),
+]
+STAGES: List[Tuple[str, Callable[..., Any]]] = list(health.PIXEL_STAGES) + REPORT_STAGES
+REPORT_NAMES = {name for name, _ in REPORT_STAGES}
+
+
+def _rows(out: Any) -> int:
+    if isinstance(out, tuple):
+        out = out[0]
+    if isinstance(out, pd.DataFrame):
+        return int(len(out))
+    if isinstance(out, (list, dict)):
+        return int(len(out))
+    return 0
+
+
+def _run_pipeline(df: pd.DataFrame, track_memory: bool, verbose: bool) -> Dict[str, Dict[str, float]]:
+    res: Dict[str, Dict[str, float]] = {}
+    state: Tuple[pd.DataFrame, Any] = (df.copy(), None)
+    for name, fn in STAGES:
+        quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        with quiet:
+            if track_memory:
+                tracemalloc.start()
+                tracemalloc.reset_peak()
+            t0 = time.perf_counter()
+            out = fn(state[0]) if name in REPORT_NAMES else fn(*state)
+            wall = time.perf_counter() - t0
+            if track_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+        row = {"wall_s": round(wall, 4), "rows_out": _rows(out)}
+        if track_memory:
+            row["peak_mb"] = round(peak / 1024 / 1024, 2)
+        res[name] = row
+        if name not in REPORT_NAMES:
+            state = out
+    return res
+
+
+def bench_size(n_pixels: int, n_weeks: int, repeat: int, seed: int, track_memory: bool, verbose: bool) -> Dict[str, Any]:
+    df = synthetic_pixels(n_pixels, n_weeks, seed)
+    print(f"[BENCH] pixels={n_pixels} weeks={n_weeks} rows={len(df)}")
+
+    runs = [_run_pipeline(df, False, verbose) for _ in range(max(1, repeat))]
+    stages: Dict[str, Dict[str, float]] = {}
+    for name, _ in STAGES:
+        walls = [r[name]["wall_s"] for r in runs]
+        stages[name] = {"wall_s": min(walls), "wall_s_all": walls, "rows_out": runs[-1][name]["rows_out"]}
+
+    if track_memory:
+        mem = _run_pipeline(df, True, verbose)
+        for name, _ in STAGES:
+            stages[name]["peak_mb"] = mem[name]["peak_mb"]
+
+    for name, r in stages.items():
+        print(f"[BENCH]   {name:<28} {r['wall_s']:>9.3f}s  peak={r.get('peak_mb', '-')}MB  rows={r['rows_out']}")
+
+    return {
+        "pixels": n_pixels,
+        "weeks": n_weeks,
+        "rows_in": int(len(df)),
+        "input_mb": round(df.memory_usage(deep=True).sum() / 1024 / 1024, 2),
+        "stages": stages,
+        "total_wall_s": round(sum(r["wall_s"] for r in stages.values()), 4),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Offline benchmark for the health pipeline stages")
+    ap.add_argument("--sizes", default="1000,10000,100000", help="عدد البكسلات، مفصولة بفواصل")
+    ap.add_argument("--weeks", type=int, default=52)
+    ap.add_argument("--repeat", type=int, default=1, help="تكرار قياس الوقت (نأخذ الأقل)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--no-memory", action="store_true", help="بدون tracemalloc (أسرع للأحجام الكبيرة)")
+    ap.add_argument("--verbose", action="store_true", help="لا تخفي print حق المراحل")
+    ap.add_argument("--out", default="bench_health.json")
+    args = ap.parse_args()
+
+    _load_models()
+
+    results = [
+        bench_size(int(n), args.weeks, args.repeat, args.seed, not args.no_memory, args.verbose)
+        for n in args.sizes.split(",") if n.strip()
+    ]
+
+    report = {
+        "meta": {
+            "timestamp": pd.Timestamp.now(tz="UTC").isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "seed": args.seed,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[BENCH] wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+مقارنة backends عدّ النخيل (torch / onnx / openvino) على صور عينة بدون GCS.
+
+التشغيل من مجلد backend:
+    python benchmarks/yolo_backends_bench.py --weights best.pt --images samples/ --out bench_yolo.json
+    python benchmarks/yolo_backends_bench.py --weights a.pt,b.pt --images "samples/*.jpg" --backends torch,onnx --batch 4
+
+كل backend يشتغل في process مستقل (YOLO_BACKEND يتقرا وقت import، وقياس RSS يكون نظيف).
+لكل موديل × backend: وقت التحميل (التصدير يصير قبل في process لحاله)، latency لكل صورة (p50/mean) وللدفعات (predict_tiles)،
+RSS بعد التحميل وأعلى RSS، والعدد لكل صورة — والتطابق يتقارن مع torch.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+from typing import Any, Dict, List
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".tif", ".tiff")
+
+
+def _image_paths(spec: str) -> List[str]:
+    if os.path.isdir(spec):
+        paths = [os.path.join(spec, f) for f in os.listdir(spec) if f.lower().endswith(IMAGE_EXTS)]
+    else:
+        paths = glob.glob(spec)
+    return sorted(paths)
+
+
+def _rss_mb() -> float:
+    import psutil
+    return psutil.Process().memory_info().rss / 1024 / 1024
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss بالكيلوبايت على لينكس
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _worker(backend: str, weights: str, images: List[str], repeat: int, batch: int) -> Dict[str, Any]:
+    """يشتغل داخل الـ subprocess بعد ما YOLO_BACKEND انضبط."""
+    rss0 = _rss_mb()
+    from PIL import Image
+    from app import inference as inf  # noqa: E402  (بعد ضبط YOLO_BACKEND)
+
+    # التصدير صار قبل (--export-only)، هنا يرجع الملف الموجود
+    t0 = time.perf_counter()
+    path = inf.export_weights(weights, backend)
+    resolve_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    model = inf.load_yolo(path)
+    load_s = time.perf_counter() - t0
+
+    # نفس تجهيز صورة المستخدم في get_sat_image_for_farm
+    imgs = [Image.open(p).convert("RGB").resize((inf.TILE_SIZE, inf.TILE_SIZE)) for p in images]
+    inf._predict_batch(model, [imgs[0]])  # warm-up
+    rss_loaded = _rss_mb()
+
+    per_image: List[float] = []
+    counts: List[int] = []
+    scores: List[float] = []
+    for r in range(max(1, repeat)):
+        for img in imgs:
+            t0 = time.perf_counter()
+            res = inf._summarize(inf._predict_batch(model, [img])[0])
+            per_image.append(time.perf_counter() - t0)
+            if r == 0:
+                counts.append(res["count"])
+                scores.append(res["score"])
+
+    tiles = [(img, (0, 0)) for img in imgs]
+    batch_walls: List[float] = []
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        inf.predict_tiles(model, tiles, batch)
+        batch_walls.append(time.perf_counter() - t0)
+
+    lat = np.asarray(per_image)
+    return {
+        "backend": backend,
+        "weights": os.path.basename(weights),
+        "resolve_s": round(resolve_s, 3),
+        "load_s": round(load_s, 3),
+        "latency_ms": {
+            "p50": round(float(np.percentile(lat, 50)) * 1000, 1),
+            "p90": round(float(np.percentile(lat, 90)) * 1000, 1),
+            "mean": round(float(lat.mean()) * 1000, 1),
+        },
+        "batch": batch,
+        "batch_ms_per_image": round(min(batch_walls) / len(imgs) * 1000, 1),
+        "rss_start_mb": round(rss0, 1),
+        "rss_loaded_mb": round(rss_loaded, 1),
+        "rss_peak_mb": round(_peak_rss_mb(), 1),
+        "counts": counts,
+        "scores": [round(s, 4) for s in scores],
+    }
+
+
+def _run_backend(backend: str, weights: str, args) -> Dict[str, Any]:
+    cmd = [
+        sys.executable, os.path.abspath(__file__),
+        "--worker", backend,
+        "--weights", weights,
+        "--images", args.images,
+        "--repeat", str(args.repeat),
+        "--batch", str(args.batch),
+    ]
+    env = {**os.environ, "YOLO_BACKEND": backend}
+    if backend != "torch":
+        # التصدير (يحمّل الـ .pt بـ torch) في process لحاله عشان ما يدخل في RSS حق الـ backend
+        subprocess.run(cmd + ["--export-only"], env=env, cwd=BACKEND_DIR, capture_output=True, text=True)
+    proc = subprocess.run(cmd, env=env, cwd=BACKEND_DIR, capture_output=True, text=True)
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith("[RESULT] "):
+            return json.loads(line[len("[RESULT] "):])
+    err = (proc.stderr or proc.stdout).strip().splitlines()[-5:]
+    return {"backend": backend, "weights": os.path.basename(weights), "error": " | ".join(err) or f"exit={proc.returncode}"}
+
+
+def _parity(ref: List[int], other: List[int]) -> Dict[str, Any]:
+    if not ref or len(ref) != len(other):
+        return {}
+    a = np.asarray(ref, dtype=float)
+    b = np.asarray(other, dtype=float)
+    diff = np.abs(a - b)
+    return {
+        "exact_match": round(float((diff == 0).mean()), 3),
+        "mean_abs_diff": round(float(diff.mean()), 2),
+        "max_abs_diff": int(diff.max()),
+        "total_rel_diff": round(float((b.sum() - a.sum()) / max(a.sum(), 1.0)), 4),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Latency / RSS / count parity for YOLO backends")
+    ap.add_argument("--weights", required=True, help="ملف .pt محلي (أو أكثر مفصولة بفواصل: A,B)")
+    ap.add_argument("--images", required=True, help="مجلد صور أو glob")
+    ap.add_argument("--backends", default="torch,onnx,openvino")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--batch", type=int, default=4, help="حجم الدفعة لقياس predict_tiles")
+    ap.add_argument("--out", default="bench_yolo.json")
+    ap.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    ap.add_argument("--export-only", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    images = _image_paths(args.images)
+    if not images:
+        raise SystemExit(f"no images under {args.images}")
+
+    if args.worker and args.export_only:
+        from app import inference as inf
+        print(f"[EXPORT] {inf.export_weights(args.weights, args.worker)}")
+        return
+    if args.worker:
+        res = _worker(args.worker, args.weights, images, args.repeat, args.batch)
+        print(f"[RESULT] {json.dumps(res)}")
+        return
+
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    results: List[Dict[str, Any]] = []
+    for weights in [w.strip() for w in args.weights.split(",") if w.strip()]:
+        ref = None
+        for backend in backends:
+            print(f"[BENCH] weights={os.path.basename(weights)} backend={backend} images={len(images)}")
+            res = _run_backend(backend, weights, args)
+            if "error" in res:
+                print(f"[BENCH]   ❌ {res['error']}")
+            else:
+                if backend == "torch":
+                    ref = res["counts"]
+                elif ref is not None:
+                    res["parity_vs_torch"] = _parity(ref, res["counts"])
+                print(
+                    f"[BENCH]   p50={res['latency_ms']['p50']}ms batch={res['batch_ms_per_image']}ms/img "
+                    f"load={res['load_s']}s rss={res['rss_loaded_mb']}MB peak={res['rss_peak_mb']}MB "
+                    f"count={sum(res['counts'])} parity={res.get('parity_vs_torch', '-')}"
+                )
+            results.append(res)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "images": len(images),
+            "repeat": args.repeat,
+            "batch": args.batch,
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[BENCH] wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
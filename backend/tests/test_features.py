@@ -0,0 +1,85 @@
+"""
+تطابق add_features (مسار المكعب) مع _add_features_frame (groupby) على جدول صغير فيه أسابيع ناقصة وقيم NaN.
+
+التشغيل من مجلد backend:
+    python -m pytest -q tests/test_features.py
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import pixel_cube  # noqa: E402
+from app.health import INDEX_COLS_ALL, add_features, _add_features_frame  # noqa: E402
+
+
+def _frame(seed: int, n_pixels: int = 40, n_weeks: int = 30) -> pd.DataFrame:
+    """
+    كل مؤشرات INDEX_COLS_ALL بـ float32: أسابيع ما لها سطر، NaN متفرقة، أسطر كل مؤشراتها NaN،
+    وبكسلات قصيرة (أقل من 4 أسابيع) — على كذا شهر عشان month_mean ينختبر.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2025-01-06", periods=n_weeks, freq="7D")
+    rows = []
+    for p in range(n_pixels):
+        if p % 8 == 0:
+            weeks = np.sort(rng.choice(n_weeks, size=int(rng.integers(1, 4)), replace=False))
+        else:
+            weeks = np.flatnonzero(rng.random(n_weeks) > rng.uniform(0.0, 0.5))
+        level = rng.uniform(0.2, 0.6)
+        trend = rng.normal(0, 0.01)
+        for wk in weeks:
+            base = level + trend * wk
+            row = {"x": 46.7 + (p % 8) * 1e-4, "y": 24.6 + (p // 8) * 1e-4, "date": dates[wk]}
+            for j, col in enumerate(INDEX_COLS_ALL):
+                row[col] = base * (1.0 + 0.1 * j) + rng.normal(0, 0.02)
+                if rng.random() < 0.1:
+                    row[col] = np.nan
+            if rng.random() < 0.05:
+                for col in INDEX_COLS_ALL:
+                    row[col] = np.nan
+            rows.append(row)
+    df = pd.DataFrame(rows)
+    df[INDEX_COLS_ALL] = df[INDEX_COLS_ALL].astype(np.float32)
+    return df.sample(frac=1.0, random_state=seed).reset_index(drop=True)
+
+
+def _sorted(df: pd.DataFrame) -> pd.DataFrame:
+    return df.sort_values(["pixel_id", "date"]).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_add_features_cube_matches_frame(seed):
+    df = _frame(seed)
+    expected = _sorted(_add_features_frame(df.copy()))
+    actual = _sorted(add_features(df.copy()))
+
+    feature_cols = [c for c in expected.columns if c not in df.columns and c != "pixel_id"]
+    assert set(feature_cols) <= set(actual.columns)
+    np.testing.assert_array_equal(actual["pixel_id"].to_numpy(), expected["pixel_id"].to_numpy())
+
+    for col in feature_cols:
+        a = actual[col].to_numpy(dtype=np.float64)
+        e = expected[col].to_numpy(dtype=np.float64)
+        np.testing.assert_array_equal(np.isnan(a), np.isnan(e), err_msg=col)
+        np.testing.assert_allclose(a, e, rtol=1e-4, atol=1e-5, equal_nan=True, err_msg=col)
+
+
+def test_add_features_with_series_index_matches_frame():
+    """نفس النتيجة لو الفهرس انحسب برا (زي _stage_prepare في الإنتاج)."""
+    df = pixel_cube.add_pixel_id(_frame(3))
+    df = df.sort_values(["pixel_id", "date"]).reset_index(drop=True)
+    series = pixel_cube.series_index(df)
+    assert series is not None
+
+    expected = _sorted(_add_features_frame(df.copy()))
+    actual = _sorted(add_features(df.copy(), series))
+    for col in ["NDVI_std8", "k_NDMI", "slope8_NDVI", "NDVI_base", "NDMI_drop_3w", "history_weeks"]:
+        np.testing.assert_allclose(
+            actual[col].to_numpy(dtype=np.float64), expected[col].to_numpy(dtype=np.float64),
+            rtol=1e-4, atol=1e-5, equal_nan=True, err_msg=col,
+        )
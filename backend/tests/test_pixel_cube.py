@@ -0,0 +1,140 @@
+"""
+تطابق دوال pixel_cube مع المرجع (slope_s_np في health و groupby حق pandas) على سلاسل غير منتظمة.
+
+التشغيل من مجلد backend:
+    python -m pytest -q tests/test_pixel_cube.py
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import pixel_cube  # noqa: E402
+from app.health import slope_s_np  # noqa: E402
+
+
+def _ragged_frame(seed: int, n_pixels: int = 60, n_weeks: int = 30) -> pd.DataFrame:
+    """
+    بكسلات بأطوال مختلفة: أسابيع ناقصة (ما لها سطر)، قيم NaN داخل السلسلة،
+    وبكسلات فيها أقل من 4 قيم صالحة (لازم تطلع NaN بالكامل).
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2025-01-06", periods=n_weeks, freq="7D")
+    rows = []
+    for p in range(n_pixels):
+        if p % 10 == 0:
+            weeks = np.sort(rng.choice(n_weeks, size=int(rng.integers(1, 4)), replace=False))
+        else:
+            weeks = np.flatnonzero(rng.random(n_weeks) > rng.uniform(0.0, 0.6))
+        trend = rng.normal(0, 0.01)
+        for wk in weeks:
+            v = 0.4 + trend * wk + rng.normal(0, 0.02)
+            if rng.random() < 0.15:
+                v = np.nan
+            rows.append({"x": 46.7 + p * 1e-4, "y": 24.6, "date": dates[wk], "NDVI": v})
+    df = pd.DataFrame(rows)
+    df["NDVI"] = df["NDVI"].astype(np.float32)
+    df = pixel_cube.add_pixel_id(df)
+    return df.sort_values(["pixel_id", "date"]).reset_index(drop=True)
+
+
+def _expected(df: pd.DataFrame, w: int) -> np.ndarray:
+    return (
+        df.groupby("pixel_id")["NDVI"]
+        .transform(lambda s: pd.Series(slope_s_np(s.to_numpy(dtype=np.float64), w), index=s.index))
+        .to_numpy()
+    )
+
+
+def _actual(df: pd.DataFrame, w: int) -> np.ndarray:
+    cube = pixel_cube.build_cube(df, ["NDVI"])
+    assert cube is not None
+    return pixel_cube.to_rows(cube, pixel_cube.rolling_slope(cube, pixel_cube.band(cube, "NDVI"), w, 4))
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("w", [8, 5])
+def test_rolling_slope_matches_slope_s_np(seed, w):
+    df = _ragged_frame(seed)
+    expected = _expected(df, w)
+    actual = _actual(df, w)
+
+    np.testing.assert_array_equal(np.isnan(actual), np.isnan(expected))
+    np.testing.assert_allclose(actual, expected, rtol=1e-6, atol=1e-9, equal_nan=True)
+
+
+def test_rolling_slope_short_series_all_nan():
+    df = _ragged_frame(3)
+    short = df.groupby("pixel_id")["NDVI"].transform(lambda s: s.notna().sum() < 4).to_numpy()
+    assert short.any()
+    assert np.isnan(_actual(df, 8)[short]).all()
+
+
+def _cube_rows(df: pd.DataFrame, fn, *args) -> np.ndarray:
+    cube = pixel_cube.build_cube(df, ["NDVI"])
+    assert cube is not None
+    return pixel_cube.to_rows(cube, fn(cube, pixel_cube.band(cube, "NDVI"), *args))
+
+
+def _pandas_rolling(df: pd.DataFrame, w: int, min_periods: int, how: str) -> np.ndarray:
+    rolled = getattr(df.groupby("pixel_id")["NDVI"].rolling(w, min_periods=min_periods), how)()
+    return rolled.reset_index(level=0, drop=True).reindex(df.index).to_numpy(dtype=np.float64)
+
+
+def _assert_same(actual: np.ndarray, expected: np.ndarray) -> None:
+    np.testing.assert_array_equal(np.isnan(actual), np.isnan(expected))
+    np.testing.assert_allclose(actual, expected, rtol=1e-6, atol=1e-9, equal_nan=True)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("w,min_periods", [(8, 4), (3, 2)])
+def test_rolling_std_matches_pandas(seed, w, min_periods):
+    df = _ragged_frame(seed)
+    _assert_same(_cube_rows(df, pixel_cube.rolling_std, w, min_periods), _pandas_rolling(df, w, min_periods, "std"))
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("w,min_periods", [(8, 4), (3, 2)])
+def test_rolling_median_matches_pandas(seed, w, min_periods):
+    df = _ragged_frame(seed)
+    _assert_same(
+        _cube_rows(df, pixel_cube.rolling_median, w, min_periods), _pandas_rolling(df, w, min_periods, "median")
+    )
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_month_mean_matches_pandas(seed):
+    df = _ragged_frame(seed)
+    expected = (
+        df.assign(month=df["date"].dt.month)
+        .groupby(["pixel_id", "month"])["NDVI"]
+        .transform("mean")
+        .to_numpy(dtype=np.float64)
+    )
+    _assert_same(_cube_rows(df, pixel_cube.month_mean), expected)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("q", [0.8, 0.5])
+def test_pixel_quantile_matches_pandas(seed, q):
+    df = _ragged_frame(seed)
+
+    def _q(s):
+        arr = s.to_numpy(dtype=np.float64)
+        arr = arr[np.isfinite(arr)]
+        return np.quantile(arr, q) if len(arr) >= 4 else np.nan
+
+    expected = df.groupby("pixel_id")["NDVI"].transform(_q).to_numpy(dtype=np.float64)
+    _assert_same(_cube_rows(df, pixel_cube.pixel_quantile, q, 4), expected)
+
+
+def test_series_index_none_on_duplicate_rows():
+    df = _ragged_frame(0)
+    assert pixel_cube.series_index(df) is not None
+    dup = pd.concat([df, df.iloc[[5]]], ignore_index=True).sort_values(["pixel_id", "date"]).reset_index(drop=True)
+    assert pixel_cube.series_index(dup) is None
+    assert pixel_cube.build_cube(dup, ["NDVI"]) is None